@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""benchmark for the quota culler and the spawn-page balance lookup
+
+Starts a local stand-in for the JupyterHub REST API (GET /users, with the state filter and
+offset/limit pagination, and the server DELETE endpoints) on its own thread, serving N synthetic
+users with M running servers spread over P quota profiles. It then drives full cull_idle cycles
+against it, followed by a number of spawn-page lookups (update_user_tokens + get_profiles_by_balance,
+as the hub's spawner hook does), and prints the results as JSON so that runs of different versions
+can be compared.
+
+Per cycle it reports the wall time, the sqlite statements executed and transactions committed
+(counted with a trace callback on every pooled connection), and p50/p99 of the per-server handling
+latency: the time from the culler receiving the page listing a server to its charge reaching the
+account stage (as observed in metrics.SERVER_LATENCY_SECONDS). The cycle's single apply and the
+culling after it are part of the wall time only.
+
+    python benchmarks/bench_cull.py --users=30000 --servers=2000 --profiles=20 --cycles=3 \\
+        --spawn_requests=200 --label=baseline --output=baseline.json
+
+Run it from the repository root (or with jhprofilequota installed).
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3 as sq3
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from tornado.ioloop import IOLoop
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from jhprofilequota import profile_db as db  # noqa: E402
+from jhprofilequota.__main__ import cull_idle  # noqa: E402
+from jhprofilequota.db_executor import DBExecutor  # noqa: E402
+from jhprofilequota.hub_client import HubClient  # noqa: E402
+
+
+def make_profiles(n_profiles, rng):
+    """n_profiles quota profiles with assorted policies, plus one without a quota"""
+    profiles = []
+    for i in range(n_profiles):
+        profiles.append({
+            "slug": "profile-%i" % i,
+            "display_name": "Profile %i" % i,
+            "quota": {
+                "costTokensPerHour": rng.choice([0.5, 1.0, 2.0, 4.0]),
+                "minBalanceToSpawn": rng.choice([0.0, 0.5, 1.0]),
+                "users": {
+                    "newTokensPerDay": rng.choice([2.0, 4.0, 8.0]),
+                    "initialBalance": rng.choice([4.0, 8.0, 16.0]),
+                    "maxBalance": rng.choice([24.0, 48.0, 96.0]),
+                },
+                "admins": {
+                    "newTokensPerDay": 48.0,
+                    "initialBalance": 96.0,
+                },
+            },
+        })
+    profiles.append({"slug": "unlimited", "display_name": "Unlimited"})
+    return profiles
+
+
+def make_users(n_users, n_servers, profiles, rng, admin_fraction=0.01):
+    """n_users user models in the shape of the Hub API's, n_servers running servers between them
+
+    Servers go to distinct users first; beyond n_users they become additional named servers.
+    """
+    now = datetime.now(timezone.utc)
+    users = [
+        {"name": "user-%05i" % i, "admin": rng.random() < admin_fraction, "servers": {}}
+        for i in range(n_users)
+    ]
+    order = list(range(n_users))
+    rng.shuffle(order)
+    for i in range(n_servers):
+        user = users[order[i % n_users]]
+        server_name = "" if i < n_users else "named-%i" % (i // n_users)
+        started = now - timedelta(seconds=rng.randrange(60, 48 * 3600))
+        user["servers"][server_name] = {
+            "name": server_name,
+            "ready": True,
+            "pending": None,
+            "url": "/user/%s/%s" % (user["name"], server_name),
+            "started": started.isoformat(),
+            "last_activity": now.isoformat(),
+            "state": {"profile_slug": rng.choice(profiles)["slug"]},
+        }
+    return users
+
+
+class FakeHub:
+    """The parts of the JupyterHub REST API the culler uses, on a thread of its own"""
+
+    def __init__(self, users, paginate=True):
+        self.users = users
+        self.active_users = [user for user in users if user["servers"]]
+        self.paginate = paginate
+        self.deletes = 0
+        self.requests = 0
+        self._loop = None
+        self._thread = None
+        self.url = None
+
+    def _app(self):
+        hub = self
+
+        class UsersHandler(RequestHandler):
+            def get(self):
+                hub.requests += 1
+                users = hub.users
+                if hub.paginate and self.get_argument("state", None) == "active":
+                    users = hub.active_users
+                total = len(users)
+                offset = 0
+                limit = total
+                if hub.paginate:
+                    offset = int(self.get_argument("offset", 0))
+                    limit = int(self.get_argument("limit", 200))
+                page = users[offset:offset + limit]
+
+                if hub.paginate and "jupyterhub-pagination" in self.request.headers.get("Accept", ""):
+                    next_page = None
+                    if offset + limit < total:
+                        next_page = {"offset": offset + limit, "limit": limit, "url": None}
+                    body = {
+                        "items": page,
+                        "_pagination": {"offset": offset, "limit": limit, "total": total, "next": next_page},
+                    }
+                else:
+                    body = page
+
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps(body))
+
+        class ServerHandler(RequestHandler):
+            def delete(self, name, server_name=""):
+                hub.deletes += 1
+                self.set_status(204)
+
+        return Application([
+            (r"/hub/api/users", UsersHandler),
+            (r"/hub/api/users/([^/]+)/server", ServerHandler),
+            (r"/hub/api/users/([^/]+)/servers/([^/]*)", ServerHandler),
+        ])
+
+    def start(self):
+        sockets = bind_sockets(0, "127.0.0.1")
+        port = sockets[0].getsockname()[1]
+        self.url = "http://127.0.0.1:%i/hub/api" % port
+        started = threading.Event()
+
+        def run():
+            import asyncio
+            asyncio.set_event_loop(asyncio.new_event_loop())
+            self._loop = IOLoop.current()
+            server = HTTPServer(self._app())
+            server.add_sockets(sockets)
+            started.set()
+            self._loop.start()
+            server.stop()
+
+        self._thread = threading.Thread(target=run, name="fake-hub", daemon=True)
+        self._thread.start()
+        started.wait()
+        return self.url
+
+    def stop(self):
+        self._loop.add_callback(self._loop.stop)
+        self._thread.join()
+
+
+class StatementCounter:
+    """Counts the statements run and transactions committed on every pooled connection"""
+
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def hook(self, conn):
+        db.add_trace_callback(conn, self.trace)
+
+    def trace(self, statement):
+        self.statements += 1
+        if statement.startswith("COMMIT"):
+            self.commits += 1
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of values (None if there are none)"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+def populate(db_filename, policies, users):
+    """Give every synthetic user their initial balances, as the hub would have over time"""
+    conn = db.get_connection(db_filename)
+    try:
+        for user in users:
+            db.ensure_initialized(conn, policies, user["name"], user["admin"])
+    finally:
+        db.close_connection(conn)
+
+
+def run_cycles(args, hub, policies, db_filename, counter):
+    db_executor = DBExecutor(db_filename)
+    snapshot = {}
+    hub_client = HubClient(max_concurrency=args.concurrency)
+    results = []
+    latencies = []
+
+    def cycle():
+        return cull_idle(
+            hub.url, "benchmark-token", profiles_list=policies, db_filename=db_filename,
+            check_every=args.check_every, concurrency=args.concurrency, db_executor=db_executor,
+            page_size=args.page_size, snapshot=snapshot, hub_client=hub_client, server_latencies=latencies,
+        )
+
+    try:
+        for _ in range(args.cycles):
+            counter.reset()
+            del latencies[:]
+            start = time.perf_counter()
+            IOLoop.current().run_sync(cycle)
+            wall = time.perf_counter() - start
+
+            results.append({
+                "wall_seconds": wall,
+                "statements": counter.statements,
+                "commits": counter.commits,
+                "servers_charged": len(latencies),
+                "latency_p50_seconds": percentile(latencies, 50),
+                "latency_p99_seconds": percentile(latencies, 99),
+            })
+    finally:
+        db_executor.shutdown()
+    return results
+
+
+def run_spawns(args, profiles, users, db_filename, counter, rng):
+    latencies = []
+    counter.reset()
+    for _ in range(args.spawn_requests):
+        user = rng.choice(users)
+        start = time.perf_counter()
+        conn = db.get_connection(db_filename)
+        try:
+            # the raw profiles list, as the hub's spawner hook passes it
+            db.update_user_tokens(conn, profiles, user["name"], user["admin"])
+            db.get_profiles_by_balance(conn, profiles, user["name"], user["admin"])
+        finally:
+            db.close_connection(conn)
+        latencies.append(time.perf_counter() - start)
+
+    return {
+        "requests": len(latencies),
+        "mean_seconds": sum(latencies) / len(latencies) if latencies else None,
+        "p50_seconds": percentile(latencies, 50),
+        "p99_seconds": percentile(latencies, 99),
+        "statements_per_request": counter.statements / len(latencies) if latencies else None,
+        "commits_per_request": counter.commits / len(latencies) if latencies else None,
+    }
+
+
+def summarize(cycles):
+    if not cycles:
+        return {}
+    return {
+        key: percentile([cycle[key] for cycle in cycles if cycle[key] is not None], 50)
+        for key in cycles[0]
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=5000, help="Registered users (N).")
+    parser.add_argument("--servers", type=int, default=500, help="Running servers (M).")
+    parser.add_argument("--profiles", type=int, default=10, help="Quota profiles (P).")
+    parser.add_argument("--cycles", type=int, default=3, help="Cull cycles to run.")
+    parser.add_argument("--spawn_requests", type=int, default=200, help="Spawn-page lookups to run.")
+    parser.add_argument("--check_every", type=int, default=600, help="check_every passed to the culler.")
+    parser.add_argument("--concurrency", type=int, default=10, help="concurrency passed to the culler.")
+    parser.add_argument("--page_size", type=int, default=200, help="page_size passed to the culler.")
+    parser.add_argument("--legacy_hub", action="store_true",
+                        help="Serve /users like jupyterhub < 1.3: no state filter, no pagination.")
+    parser.add_argument("--no_populate", action="store_true",
+                        help="Start from an empty db instead of one with balances for every user.")
+    parser.add_argument("--db_file", help="Quota db to use; defaults to a fresh temporary file.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic population.")
+    parser.add_argument("--label", default="", help="Free-form label stored with the results.")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    profiles = make_profiles(args.profiles, rng)
+    policies = db.compile_policies(profiles)
+    users = make_users(args.users, args.servers, profiles, rng)
+
+    tmpdir = None
+    db_filename = args.db_file
+    if not db_filename:
+        tmpdir = tempfile.TemporaryDirectory(prefix="jhprofilequota-bench-")
+        db_filename = os.path.join(tmpdir.name, "profile_quotas.db")
+
+    counter = StatementCounter()
+    db.add_connection_hook(counter.hook)
+    # as the culler does with its default --db_journal_mode
+    db.configure_pool(journal_mode=db.JOURNAL_MODE)
+    db.create_db(db_filename)
+
+    populate_seconds = None
+    if not args.no_populate:
+        start = time.perf_counter()
+        populate(db_filename, policies, users)
+        populate_seconds = time.perf_counter() - start
+
+    hub = FakeHub(users, paginate=not args.legacy_hub)
+    hub.start()
+    try:
+        cycles = run_cycles(args, hub, policies, db_filename, counter)
+        hub_requests = hub.requests
+        hub_deletes = hub.deletes
+    finally:
+        hub.stop()
+
+    spawn = run_spawns(args, profiles, users, db_filename, counter, rng)
+    db_size = os.path.getsize(db_filename)
+
+    db.configure_pool()  # closes the idle connections
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+    results = {
+        "label": args.label,
+        "params": {
+            key: getattr(args, key)
+            for key in ("users", "servers", "profiles", "cycles", "spawn_requests", "check_every",
+                        "concurrency", "page_size", "legacy_hub", "no_populate", "seed")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "sqlite": sq3.sqlite_version,
+            "platform": platform.platform(),
+        },
+        "populate_seconds": populate_seconds,
+        "cycles": cycles,
+        "cycle_median": summarize(cycles),
+        "hub_requests": hub_requests,
+        "hub_deletes": hub_deletes,
+        "spawn": spawn,
+        "db_bytes": db_size,
+    }
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,28 +26,48 @@ Or run it manually by generating an API token and storing it in `JUPYTERHUB_API_
     export JUPYTERHUB_API_TOKEN=$(jupyterhub token)
     python3 -m profilequota [--check_every=600] [--url=http://127.0.0.1:8081/hub/api] --db_file=profile_quotas.db
 
+Maintenance commands for the quota db are run the same way, see jhprofilequota/commands.py:
+
+    python3 -m jhprofilequota migrate --quota_db_filename=profile_quotas.db
+    python3 -m jhprofilequota report --quota_db_filename=profile_quotas.db --start=2020-09-01 --end=2020-10-01 --by=profile
+
 """
+import asyncio
 import json
 import os
+import signal
+import sys
+import time
 from datetime import datetime
 from datetime import timezone
 from functools import partial
 
 try:
-    from urllib.parse import quote
+    from urllib.parse import quote, urlencode
 except ImportError:
-    from urllib import quote # type: ignore
+    from urllib import quote, urlencode # type: ignore
 
 import dateutil.parser
 
-from tornado.gen import coroutine, multi # type: ignore
-from tornado.locks import Semaphore
 from tornado.log import app_log # type: ignore
 from tornado.httpclient import AsyncHTTPClient, HTTPRequest
-from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.options import define, options, parse_command_line # type: ignore
 
 from jhprofilequota import profile_db as db
+from jhprofilequota import commands
+from jhprofilequota import archive
+from jhprofilequota import metrics
+from jhprofilequota.db_executor import DBExecutor
+from jhprofilequota.hub_client import HubClient
+from jhprofilequota import hub_client as hub
+from jhprofilequota import profiling
+from jhprofilequota import balance_service
+from jhprofilequota.balance_service import BalanceService
+from jhprofilequota.profiles_file import ProfilesFile
+from jhprofilequota.profiling import CycleProfiler, NULL_SPANS
+
+# number of charges handed to the db thread at a time while a cycle is in progress
+STAGE_BATCH_SIZE = 500
 
 def parse_date(date_string):
     """Parse a timestamp
@@ -81,54 +101,167 @@ def format_td(td):
     return "{h:02}:{m:02}:{seconds:02}".format(h=h, m=m, seconds=seconds)
 
 
-@coroutine
-def cull_idle(
-    url, api_token, profiles_list = [], db_filename = "profile_quotas.db", check_every = 600, concurrency=10
+async def cull_idle(
+    url, api_token, profiles_list = [], db_filename = "profile_quotas.db", check_every = 600, concurrency=10,
+    db_executor=None, page_size=200, snapshot=None, hub_client=None, evaluate_workers=4, cull_workers=10,
+    queue_size=1000, profiler=None, server_latencies=None
 ):
 
-    """Shutdown idle single-user servers"""
+    """Shutdown idle single-user servers
+
+    snapshot, if given, is a dict that holds the servers charged by the last
+    cycle between cycles, so that only new servers need their users' balances
+    set up.
+
+    The cycle runs as a pipeline of stages joined by queues holding at most
+    queue_size items, so that a stage that falls behind holds up the ones
+    feeding it rather than letting work pile up:
+
+      - list: fetches the users with running servers from the Hub a page at
+        a time
+      - evaluate (evaluate_workers tasks): decides which of each user's
+        servers are charged
+      - account (one task, as the db has one thread): stages the charges on
+        the db thread as they come, then applies them all in one transaction
+      - cull (cull_workers tasks): decides on and stops servers by their
+        balances
+
+    The queues bound the user and server models in flight. What is kept for
+    every charged server until the cycle's charges are applied (its names
+    and profile, for culling and the next snapshot) still grows with the
+    number of servers, whatever queue_size is.
+
+    Cancelling the cycle cancels every stage, and whatever was staged but
+    not applied is thrown away.
+
+    profiler, if given, is a profiling.CycleProfiler whose spans time the
+    stages (the cycle as a whole is profiled by its caller).
+
+    Each charged server's latency, from its page of users arriving to its
+    charge reaching the account stage, is observed in
+    metrics.SERVER_LATENCY_SECONDS, and appended to server_latencies if
+    that is a list. Applying the charges and culling happen once for the
+    whole cycle, after the last page, so they're left to the cycle's
+    duration.
+    """
+
+    if db_executor is None:
+        # the service shares one executor between cycles, a one-off cycle gets its own
+        db_executor = DBExecutor(db_filename)
+        try:
+            return await cull_idle(
+                url, api_token, profiles_list, db_filename, check_every, concurrency, db_executor, page_size,
+                snapshot, hub_client, evaluate_workers, cull_workers, queue_size, profiler, server_latencies,
+            )
+        finally:
+            db_executor.shutdown()
+
+    if snapshot is None:
+        snapshot = {}
+    evaluate_workers = max(1, evaluate_workers)
+    cull_workers = max(1, cull_workers)
     
+    cycle_start = time.perf_counter()
     auth_header = {'Authorization': 'token %s' % api_token}
-    req = HTTPRequest(url=url + '/users', headers=auth_header)
     now = datetime.now(timezone.utc)
-    client = AsyncHTTPClient()
-
-    if concurrency:
-        semaphore = Semaphore(concurrency)
 
-        @coroutine
-        def fetch(req):
-            """client.fetch wrapped in a semaphore to limit concurrency"""
-            yield semaphore.acquire()
-            try:
-                return (yield client.fetch(req))
-            finally:
-                yield semaphore.release()
+    if hub_client is None:
+        # the service keeps one client, and what its limiter has learned, between cycles
+        hub_client = HubClient(max_concurrency=concurrency)
+    fetch = hub_client.fetch
 
+    if profiler is not None:
+        spans = profiler
+        server_spans = profiler.server_spans
     else:
-        fetch = client.fetch
+        spans = NULL_SPANS
+        server_spans = lambda: NULL_SPANS
 
-    resp = yield fetch(req)
-    users = json.loads(resp.body.decode('utf8', 'replace'))
-    futures = []
+    # profiles_list is normally compiled once at startup; this is a no-op then
+    policies = db.compile_policies(profiles_list)
 
-    @coroutine
-    def handle_server(user, server_name, server):
-        """Handle (maybe) culling a single server
+    # users with servers, from list to evaluate; charges, from evaluate to account; and servers with their balances,
+    # from account to cull; None marks the end of a queue for one of its consumers
+    users_queue = asyncio.Queue(queue_size)
+    charge_queue = asyncio.Queue(queue_size)
+    cull_queue = asyncio.Queue(queue_size)
 
-        "server" is the entire server model from the API.
+    seen = int(now.timestamp())
 
-        Returns True if server is now stopped (user removable),
-        False otherwise.
+    # every server listed this cycle, and the (started, profile_slug, admin) of those charged, to become the
+    # next cycle's snapshot
+    listed = set()
+    current = {}
+    # when each user's page of the listing arrived, for the servers' latencies
+    received = {}
+
+    async def list_users():
+        """Fetch the users with running servers from the Hub a page at a time
+
+        Each page is passed on as soon as it arrives, while the next one is
+        being fetched.
+
+        Hubs that don't know the state filter (jupyterhub < 1.3) return
+        every user, and hubs that don't paginate (< 2.0) return all of them
+        at once, as a plain list rather than a paginated model.
+        """
+        headers = dict(auth_header)
+        headers['Accept'] = 'application/jupyterhub-pagination+json'
+
+        def page_request(offset):
+            params = {'state': 'active', 'offset': offset}
+            if page_size:
+                params['limit'] = page_size
+            return HTTPRequest(url=url + '/users?' + urlencode(params), headers=headers)
+
+        next_page = asyncio.ensure_future(fetch(page_request(0)))
+        try:
+            while next_page is not None:
+                with spans.span("list.page"):
+                    resp = await next_page
+                next_page = None
+                received_at = time.perf_counter()
+                body = json.loads(resp.body.decode('utf8', 'replace'))
+                if isinstance(body, list):
+                    users = body
+                else:
+                    users = body['items']
+                    pagination = body.get('_pagination') or {}
+                    if pagination.get('next'):
+                        next_page = asyncio.ensure_future(fetch(page_request(pagination['next']['offset'])))
+                for user in users:
+                    if not user.get('servers') and not user.get('server'):
+                        # nothing running (hubs that can't filter by state list every user)
+                        continue
+                    received[user['name']] = received_at
+                    await users_queue.put(user)
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+        for _ in range(evaluate_workers):
+            await users_queue.put(None)
+
+    def handle_server(user, server_name, server, sampled=NULL_SPANS):
+        """Handle (maybe) charging a single server
+
+        "server" is the entire server model from the API; its handling is
+        timed in sampled's spans.
+
+        The charge itself is only queued here; it is worked out and applied with
+        the rest of the cycle's charges by the account stage.
+
+        Returns the server's charge if it is to be charged, None otherwise.
         """
         log_name = user['name']
         if server_name:
             log_name = '%s/%s' % (user['name'], server_name)
+        listed.add((user['name'], server_name))
         if server.get('pending'):
             app_log.warning(
                 "Not culling server %s with pending %s", log_name, server['pending']
             )
-            return False
+            return None
 
         # jupyterhub < 0.9 defined 'server.url' once the server was ready
         # as an *implicit* signal that the server was ready.
@@ -141,14 +274,156 @@ def cull_idle(
             app_log.warning(
                 "Not culling not-ready not-pending server %s: %s", log_name, server
             )
-            return False
+            return None
 
         if server.get('started'):
-            age = now - parse_date(server['started'])
+            with sampled.span("server.parse_date"):
+                started = int(parse_date(server['started']).timestamp())
+            since = started
         else:
-            # started may be undefined on jupyterhub < 0.9
-            age = None
+            # started may be undefined on jupyterhub < 0.9; such servers are charged
+            # from the last time they were charged, or for one interval if never
+            started = 0
+            since = seen - check_every
 
+        # if there's no profile info in the server state to base the determinaton on, we got nothing to go on
+        with sampled.span("server.policy"):
+            profile_slug = server.get("state", {}).get("profile_slug", None)
+            has_quota = profile_slug in policies.quota_slugs
+
+        if not has_quota:
+            app_log.debug(
+                "Not charging server %s (profile %s has no quota)", log_name, profile_slug
+            )
+            return None
+
+        key = (user['name'], server_name)
+        current[key] = (started, profile_slug, user['admin'])
+        new = snapshot.get(key) != current[key]
+        # (user, is_admin, server_name, profile_slug, started, since, seen, new), as db.stage_server_runtimes
+        # takes them, and the server to decide on culling once the balances are known (just its names, rather than
+        # the models, since they're kept until the cycle's charges are applied)
+        return (
+            (user['name'], user['admin'], server_name, profile_slug, started, since, seen, new),
+            (user['name'], server_name, profile_slug),
+        )
+
+    def handle_user(user):
+        """Handle one user.
+
+        Return the charges for their servers.
+        """
+        # jupyterhub 0.9 always provides a 'servers' model.
+        # 0.8 only does this when named servers are enabled.
+        if 'servers' in user:
+            servers = user['servers']
+        else:
+            # jupyterhub < 0.9 without named servers enabled.
+            # create servers dict with one entry for the default server
+            # from the user model.
+            # only if the server is running.
+            servers = {}
+            if user['server']:
+                servers[''] = {
+                    'last_activity': user['last_activity'],
+                    'pending': user['pending'],
+                    'url': user['server'],
+                }
+        charges = []
+        for server_name, server in servers.items():
+            sampled = server_spans()
+            with sampled.span("server"):
+                charge = handle_server(user, server_name, server, sampled)
+            if charge is not None:
+                charges.append(charge)
+        return charges
+
+    async def evaluate():
+        while True:
+            user = await users_queue.get()
+            if user is None:
+                break
+            try:
+                charges = handle_user(user)
+            except Exception:
+                app_log.exception("Error processing %s", user['name'])
+                continue
+            for charge in charges:
+                await charge_queue.put(charge)
+
+        await charge_queue.put(None)
+
+    async def account():
+        """Stage the charges in chunks as they come and apply them once every
+        user has been handled
+
+        Running servers are charged for the time they have run since they
+        were last charged, in a single transaction (see
+        db.stage_server_runtimes); each server's (user name, server name,
+        profile) is kept so that culling can be decided on the resulting
+        balances.
+        """
+        charges = []
+        charged_servers = []
+        finished = 0
+        while finished < evaluate_workers:
+            item = await charge_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            charge, charged_server = item
+            latency = time.perf_counter() - received[charge[0]]
+            metrics.SERVER_LATENCY_SECONDS.observe(latency)
+            if server_latencies is not None:
+                server_latencies.append(latency)
+            charges.append(charge)
+            charged_servers.append(charged_server)
+            if len(charges) >= STAGE_BATCH_SIZE:
+                with spans.span("account.stage"):
+                    await db_executor.run(db.stage_server_runtimes, charges)
+                charges = []
+        if charges:
+            with spans.span("account.stage"):
+                await db_executor.run(db.stage_server_runtimes, charges)
+
+        # one transaction for the whole cycle; only the charged balances are written,
+        # the others accrue on read
+        totals = {}
+        with spans.span("account.apply"):
+            balances = await db_executor.run(db.apply_staged_charges, policies, totals)
+        app_log.info("Charged %i servers", sum(charged for charged, hours, tokens in totals.values()))
+
+        # stopped servers' watermarks are left to expire (see db.WATERMARK_RETENTION)
+        stopped = [key for key in snapshot if key not in listed]
+        app_log.debug(
+            "%i new, %i continuing and %i stopped servers",
+            sum(1 for key in current if snapshot.get(key) != current[key]),
+            sum(1 for key in current if snapshot.get(key) == current[key]),
+            len(stopped),
+        )
+        snapshot.clear()
+        snapshot.update(current)
+
+        for profile_slug, (charged, hours, tokens) in totals.items():
+            metrics.SERVERS_CHARGED.labels(profile=profile_slug).inc(charged)
+            metrics.TOKENS_CHARGED.labels(profile=profile_slug).inc(tokens)
+
+        for (user_name, server_name, profile_slug) in charged_servers:
+            balance = balances.get((user_name, profile_slug), float("inf"))
+            await cull_queue.put((user_name, server_name, profile_slug, balance))
+
+        for _ in range(cull_workers):
+            await cull_queue.put(None)
+
+    async def cull_server(user_name, server_name, profile_slug, balance):
+        """Handle (maybe) culling a single server once the cycle's charges are applied
+
+        Returns True if server is now stopped (user removable),
+        False otherwise.
+        """
+        log_name = user_name
+        if server_name:
+            log_name = '%s/%s' % (user_name, server_name)
 
         # CUSTOM CULLING TEST CODE HERE
         # Add in additional server tests here.  Return False to mean "don't
@@ -158,7 +433,8 @@ def cull_idle(
         # Here, server['state'] is the result of the get_state method
         # on the spawner.  This does *not* contain the below by
         # default, you may have to modify your spawner to make this
-        # work.  The `user` variable is the user model from the API.
+        # work.  The server and user models from the API are not kept
+        # until culling; pass what you need along from handle_server.
         #
         # if server['state']['profile_name'] == 'unlimited'
         #     return False
@@ -166,26 +442,10 @@ def cull_idle(
 
         should_cull = False
 
-        # if there's no profile info in the server state to base the determinaton on, we got nothing to go on
-        profile_slug = server.get("state", {}).get("profile_slug", None)
-        balance = float("inf")
-
-        if profile_slug:
-            conn = db.get_connection(db_filename)
-            db.update_user_tokens(conn, profiles_list, user['name'], user['admin'])
-            
-            for profile in profiles_list:
-                if profile["slug"] == profile_slug and "quota" in profile:
-                    hours = (check_every / 60 / 60)
-                    db.log_usage(conn, profiles_list, user['name'], profile_slug, hours, user['admin'])
-                    db.charge_tokens(conn, profiles_list, user['name'], profile_slug, hours, user['admin'])
-                    current_balance = db.get_balance(conn, profiles_list, user['name'], profile_slug, user['admin'])
-
-                    if current_balance < 0.0:
-                        pass
-                        # don't actually cull, let the balance go negative (since we don't have a way to alert the user that their server is about to be killed)
-                        # should_cull = True
-            db.close_connection(conn)
+        if balance < 0.0:
+            pass
+            # don't actually cull, let the balance go negative (since we don't have a way to alert the user that their server is about to be killed)
+            # should_cull = True
 
         if should_cull:
             app_log.info(
@@ -204,74 +464,119 @@ def cull_idle(
         if server_name:
             # culling a named server
             delete_url = url + "/users/%s/servers/%s" % (
-                quote(user['name']),
-                quote(server['name']),
+                quote(user_name),
+                quote(server_name),
             )
         else:
-            delete_url = url + '/users/%s/server' % quote(user['name'])
+            delete_url = url + '/users/%s/server' % quote(user_name)
 
         req = HTTPRequest(url=delete_url, method='DELETE', headers=auth_header)
-        resp = yield fetch(req)
+        resp = await fetch(req)
         if resp.code == 202:
             app_log.warning("Server %s is slow to stop", log_name)
             # return False to prevent culling user with pending shutdowns
             return False
         return True
 
-    @coroutine
-    def handle_user(user):
-        """Handle one user.
+    async def cull():
+        while True:
+            item = await cull_queue.get()
+            if item is None:
+                break
+            user_name = item[0]
+            try:
+                with spans.span("cull.server"):
+                    result = await cull_server(*item)
+            except asyncio.CancelledError:
+                # an Exception before python 3.8
+                raise
+            except Exception:
+                app_log.exception("Error culling %s", user_name)
+            else:
+                if result:
+                    app_log.debug("Finished culling %s", user_name)
+
+    stages = (
+        [asyncio.ensure_future(list_users())]
+        + [asyncio.ensure_future(evaluate()) for _ in range(evaluate_workers)]
+        + [asyncio.ensure_future(account())]
+        + [asyncio.ensure_future(cull()) for _ in range(cull_workers)]
+    )
+    try:
+        await asyncio.gather(*stages)
+    finally:
+        # a stage failed or the cycle was cancelled; stop the others, and don't leave charges staged on the db
+        # thread for the next cycle to apply
+        for stage in stages:
+            stage.cancel()
+        db_executor.submit(db.discard_staged_charges)
 
-        Create a list of their servers, and async exec them.  Wait for
-        that to be done, and if all servers are stopped, possibly cull
-        the user.
-        """
-        # shutdown servers first.
-        # Hub doesn't allow deleting users with running servers.
-        # jupyterhub 0.9 always provides a 'servers' model.
-        # 0.8 only does this when named servers are enabled.
-        if 'servers' in user:
-            servers = user['servers']
-        else:
-            # jupyterhub < 0.9 without named servers enabled.
-            # create servers dict with one entry for the default server
-            # from the user model.
-            # only if the server is running.
-            servers = {}
-            if user['server']:
-                servers[''] = {
-                    'last_activity': user['last_activity'],
-                    'pending': user['pending'],
-                    'url': user['server'],
-                }
-        server_futures = [
-            handle_server(user, server_name, server)
-            for server_name, server in servers.items()
-        ]
-        results = yield multi(server_futures)
-    
-    
-    
-    
-    for user in users:
-        futures.append((user['name'], handle_user(user)))
+    metrics.CULL_CYCLE_DURATION_SECONDS.observe(time.perf_counter() - cycle_start)
+
+
+async def archive_old_usage(db_executor, archive_dir, retention_days):
+    """Move usage older than the retention period out to the monthly archives"""
+    before = int(db.now_epoch() - retention_days * db.DAY)
+    try:
+        archived = await db_executor.run(archive.archive_usage, archive_dir, before)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        app_log.exception("Error archiving usage to %s", archive_dir)
+    else:
+        for month, rows in archived:
+            app_log.info("Archived %i usage rows to %s", rows, archive.archive_filename(month))
+
+
+async def count_negative_balances(db_executor, policies):
+    """Set the negative balance gauge
+
+    This scans every balance, so it runs on an interval of its own
+    (--negative_balances_interval) rather than with every cull cycle.
+    """
+    negative = await db_executor.run(db.count_negative_balances)
+    for profile_slug in policies().quota_slugs:
+        metrics.NEGATIVE_BALANCE_USERS.labels(profile=profile_slug).set(negative.get(profile_slug, 0))
 
-    for (name, f) in futures:
+
+async def run_every(interval, callback, name):
+    """Run callback now and then every interval seconds
+
+    Runs don't overlap: one that takes longer than the interval is followed
+    by the next straight away.
+    """
+    while True:
+        start = time.monotonic()
         try:
-            result = yield f
+            await callback()
+        except asyncio.CancelledError:
+            raise
         except Exception:
-            app_log.exception("Error processing %s", name)
-        else:
-            if result:
-                app_log.debug("Finished culling %s", name)
+            app_log.exception("Error in %s", name)
+        await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
 
 
 if __name__ == '__main__':
+    if sys.argv[1:2] and sys.argv[1] in commands.COMMANDS:
+        sys.exit(commands.main(sys.argv[1:]))
+
     define(
         'profiles_json',
         default=os.environ.get('JUPYTERHUB_PROFILES_JSON', '[]'),
         help="Hub profiles as JSON, for use in quota determination (which are stored with profiles)."
     )
+    define(
+        'profiles_file',
+        default=os.environ.get('JUPYTERHUB_PROFILES_FILE', ''),
+        help="""A JSON file holding the Hub profiles, used instead of --profiles_json. Changes to it are picked
+                up between cull cycles, without restarting (see jhprofilequota/profiles_file.py).
+                """,
+    )
+    define(
+        'profiles_reload_interval',
+        default=10,
+        help="Seconds between checks of --profiles_file for changes.",
+    )
     define(
         'url',
         default=os.environ.get('JUPYTERHUB_API_URL'),
@@ -280,7 +585,9 @@ if __name__ == '__main__':
     define(
         'check_every',
         default=600,
-        help="The interval (in seconds) for checking for idle servers to cull",
+        help="""The interval (in seconds) for checking for idle servers to cull. Servers are charged for
+                the time they have actually run since they were last charged, however long that is.
+                """,
     )
     define(
         'concurrency',
@@ -289,6 +596,75 @@ if __name__ == '__main__':
 
                 Deleting a lot of users at the same time can slow down the Hub,
                 so limit the number of API requests we have outstanding at any given time.
+                This is the most the adaptive limit (see --min_concurrency) goes up to. 0 means no limit.
+                """,
+    )
+    define(
+        'min_concurrency',
+        default=1,
+        help="""The fewest concurrent requests the adaptive limit goes down to. The limit backs off
+                (see --concurrency_decrease_factor) when the Hub is slow or failing, and creeps back up
+                by about one request per round of requests while it responds in time.
+                Set it to --concurrency for a fixed limit.
+                """,
+    )
+    define(
+        'hub_latency_target',
+        default=hub.LATENCY_TARGET,
+        help="""Hub API responses slower than this many seconds lower the concurrency limit, as server
+                errors do. 0 only backs off on errors.
+                """,
+    )
+    define(
+        'concurrency_decrease_factor',
+        default=hub.DECREASE_FACTOR,
+        help="What to multiply the concurrency limit by when backing off.",
+    )
+    define(
+        'hub_retries',
+        default=hub.RETRIES,
+        help="""How many times to retry an idempotent Hub API request (GET, DELETE, ...) after a connection
+                error, a timeout, a 429 or a 502-504 response. 0 disables retries.
+                """,
+    )
+    define(
+        'hub_retry_delay',
+        default=hub.RETRY_DELAY,
+        help="""Delay (in seconds) before the first retry; each further retry doubles it, up to
+                --hub_max_retry_delay. The actual delay is random between 0 and that, so that
+                requests failing together don't retry together.
+                """,
+    )
+    define(
+        'hub_max_retry_delay',
+        default=hub.MAX_RETRY_DELAY,
+        help="The longest delay (in seconds) before a retry.",
+    )
+    define(
+        'page_size',
+        default=200,
+        help="""Number of users to request from the Hub at a time (jupyterhub >= 2.0; older hubs
+                return all users at once). 0 leaves the page size up to the Hub.
+                """,
+    )
+    define(
+        'evaluate_workers',
+        default=4,
+        help="Number of tasks working out each cycle's charges from the users listed by the Hub.",
+    )
+    define(
+        'cull_workers',
+        default=10,
+        help="""Number of tasks deciding on and stopping servers once each cycle's charges are applied
+                (requests to the Hub are still limited by --concurrency).
+                """,
+    )
+    define(
+        'pipeline_queue_size',
+        default=1000,
+        help="""The most users, charges or servers waiting between the stages of a cycle. A stage that
+                falls behind holds up the ones before it, so that users are listed no faster than they can
+                be handled.
                 """,
     )
     define(
@@ -297,40 +673,255 @@ if __name__ == '__main__':
         help="File path for sqlite3 database to use for quota storage; will be created if it doesn't exist.",
     )
 
+    define(
+        'usage_retention_days',
+        default=0.0,
+        help="""Keep this many days of usage in the quota db's usage table; whole months older than
+                that are moved to compressed monthly archives once a day. 0 keeps everything in the db.
+                """,
+    )
+    define(
+        'usage_archive_dir',
+        default='',
+        help="Directory for the monthly usage archives. Defaults to <quota_db_filename>-archive.",
+    )
+    define(
+        'db_busy_timeout',
+        default=db.BUSY_TIMEOUT,
+        help="""How long (in seconds) to wait for the quota db to be unlocked by another process
+                (e.g. the hub rendering a spawn page) before giving up on a write.
+                """,
+    )
+    define(
+        'db_journal_mode',
+        default=db.JOURNAL_MODE,
+        help="""sqlite journal mode for the quota db. WAL lets the hub read balances while the culler
+                is writing charges; use DELETE if the db lives on a filesystem without WAL support (e.g. NFS).
+                """,
+    )
+
+    define(
+        'metrics_port',
+        default=0,
+        help="""Serve Prometheus metrics (cycle durations, Hub API and quota db latencies, charges and
+                negative balances) at /metrics on this port. 0 disables the metrics endpoint.
+                """,
+    )
+    define(
+        'metrics_ip',
+        default='127.0.0.1',
+        help="The address to serve the metrics endpoint on.",
+    )
+    define(
+        'negative_balances_interval',
+        default=3600,
+        help="""Seconds between counts of the users with negative balances for the metrics endpoint. Each count
+                reads every balance in the quota db, so it doesn't run with every cull cycle.
+                """,
+    )
+
+    define(
+        'balance_port',
+        default=0,
+        help="""Serve users' balances as JSON to the hub (see jhprofilequota/balance_service.py and
+                balance_client.py) on this port, so that spawn pages don't read the quota db. 0 disables it.
+                """,
+    )
+    define(
+        'balance_ip',
+        default='127.0.0.1',
+        help="The address to serve balances on with --balance_port.",
+    )
+    define(
+        'balance_socket',
+        default='',
+        help="Serve users' balances on this Unix socket (readable by this service's user only). Empty disables it.",
+    )
+    define(
+        'balance_refresh_interval',
+        default=balance_service.REFRESH_INTERVAL,
+        help="""Seconds between the balance service's checks for changes to balances in the quota db, i.e. how
+                far behind the db its answers may be.
+                """,
+    )
+
+    define(
+        'profile_dir',
+        default='',
+        help="""Profile every cull cycle, writing a file per cycle into this directory (see
+                jhprofilequota/profiling.py). Empty turns profiling off.
+                """,
+    )
+    define(
+        'profile_mode',
+        default='spans',
+        help="""What to profile cycles with: 'spans' times the stages of the cycle and of handling
+                (a sample of) the servers, 'cprofile' dumps cProfile stats for everything run on the event loop.
+                """,
+    )
+    define(
+        'profile_keep',
+        default=profiling.KEEP,
+        help="Number of cycle profiles to keep in --profile_dir; older ones are removed.",
+    )
+    define(
+        'profile_sample_rate',
+        default=profiling.SAMPLE_RATE,
+        help="Fraction of servers whose handling is timed in 'spans' mode.",
+    )
+    define(
+        'slow_query_threshold',
+        default=0.0,
+        help="""Log quota db statements that take at least this many seconds (wall clock, including waits on
+                locks and commits), with their duration, to the jhprofilequota.profile_db.slow_queries logger.
+                0 turns the slow query log off.
+                """,
+    )
+
     parse_command_line()
     if not options.check_every:
         options.check_every = 600
     api_token = os.environ['JUPYTERHUB_API_TOKEN']
 
-    profiles_list = json.loads(options.profiles_json)
+    db.configure_pool(busy_timeout=options.db_busy_timeout, journal_mode=options.db_journal_mode)
+    if options.metrics_port:
+        if metrics.prometheus_client_missing:
+            sys.exit("--metrics_port needs prometheus_client (pip install prometheus_client)")
+        db.add_connection_hook(metrics.count_statements)
+    profiler = None
+    if options.profile_dir:
+        profiler = CycleProfiler(options.profile_dir, options.profile_mode, options.profile_keep, options.profile_sample_rate)
+
+    # creates the tables, or brings a db from an older version up to date
+    db.create_db(options.quota_db_filename)
+
+    # compiled once here rather than re-walked by every db call
+    profiles_file = None
+    if options.profiles_file:
+        profiles_file = ProfilesFile(options.profiles_file)
+        profiles_list = profiles_file.load()
+    else:
+        profiles_list = db.compile_policies(json.loads(options.profiles_json))
     #profiles_list = json.loads("[]")
 
+    # the curl client keeps a connection alive for each of its max_clients handles and reuses them from one request,
+    # and one cycle, to the next; with enough of them every request in flight gets one
+    max_clients = max(options.concurrency, 10)
     try:
-        AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient")
+        AsyncHTTPClient.configure("tornado.curl_httpclient.CurlAsyncHTTPClient", max_clients=max_clients)
     except ImportError as e:
+        AsyncHTTPClient.configure(None, max_clients=max_clients)
         app_log.warning(
             "Could not load pycurl: %s\n"
             "pycurl is recommended if you have a large number of users.",
             e,
         )
 
-    loop = IOLoop.current()
-    cull = partial(
-        cull_idle,
-        url=options.url,
-        api_token=api_token,
-        profiles_list=profiles_list,
-        db_filename=options.quota_db_filename,
-        check_every=options.check_every,
-        concurrency=options.concurrency,
-    )
-    # schedule first cull immediately
-    # because PeriodicCallback doesn't start until the end of the first interval
-    loop.add_callback(cull)
-    # schedule periodic cull
-    pc = PeriodicCallback(cull, 1e3 * options.check_every)
-    pc.start()
+    db_executor = DBExecutor(options.quota_db_filename, options.slow_query_threshold)
+    snapshot = {}
+    balances = None
+    if options.balance_port or options.balance_socket:
+        balances = BalanceService(options.quota_db_filename, profiles_list, options.balance_refresh_interval,
+                                  slow_query_threshold=options.slow_query_threshold)
+
+    async def serve():
+        if options.metrics_port:
+            metrics.start_metrics_server(options.metrics_port, options.metrics_ip)
+            app_log.info("Serving metrics on http://%s:%i/metrics", options.metrics_ip, options.metrics_port)
+        if balances is not None:
+            balance_service.start_balance_server(balances, options.balance_port, options.balance_ip, options.balance_socket)
+            if options.balance_port:
+                app_log.info("Serving balances on http://%s:%i/balances", options.balance_ip, options.balance_port)
+            if options.balance_socket:
+                app_log.info("Serving balances on %s", options.balance_socket)
+        # made on the running loop, which its limiter waits on
+        hub_client = HubClient(
+            max_concurrency=options.concurrency,
+            min_concurrency=options.min_concurrency,
+            latency_target=options.hub_latency_target,
+            decrease_factor=options.concurrency_decrease_factor,
+            retries=options.hub_retries,
+            retry_delay=options.hub_retry_delay,
+            max_retry_delay=options.hub_max_retry_delay,
+        )
+        cull_once = partial(
+            cull_idle,
+            url=options.url,
+            api_token=api_token,
+            db_filename=options.quota_db_filename,
+            check_every=options.check_every,
+            concurrency=options.concurrency,
+            db_executor=db_executor,
+            page_size=options.page_size,
+            snapshot=snapshot,
+            hub_client=hub_client,
+            evaluate_workers=options.evaluate_workers,
+            cull_workers=options.cull_workers,
+            queue_size=options.pipeline_queue_size,
+            profiler=profiler,
+        )
+        # cycles and profile reloads take turns, so that a cycle runs start to end under one set of policies and a
+        # reload never waits on, or holds up, more than the cycle in progress
+        cycle_lock = asyncio.Lock()
+
+        async def cull():
+            async with cycle_lock:
+                policies = profiles_file.policies if profiles_file is not None else profiles_list
+                if profiler is None:
+                    await cull_once(profiles_list=policies)
+                else:
+                    with profiler.cycle():
+                        await cull_once(profiles_list=policies)
+
+        async def reload_profiles():
+            update = profiles_file.check()
+            if update is None:
+                return
+            async with cycle_lock:
+                stamp, policies = update
+                # only the policies that are new or have changed are written
+                await db_executor.run(db.update_policies, policies)
+                profiles_file.accept(stamp, policies)
+                if balances is not None:
+                    balances.policies = policies
+                    await balances.refresh()
+
+        # the first cull runs immediately, then every check_every seconds
+        tasks = [asyncio.ensure_future(run_every(options.check_every, cull, "cull cycle"))]
+
+        if options.metrics_port:
+            current_policies = lambda: profiles_file.policies if profiles_file is not None else profiles_list
+            tasks.append(asyncio.ensure_future(run_every(
+                options.negative_balances_interval,
+                partial(count_negative_balances, db_executor, current_policies),
+                "negative balance count",
+            )))
+        if options.usage_retention_days:
+            archive_usage = partial(
+                archive_old_usage,
+                db_executor,
+                options.usage_archive_dir or archive.default_archive_dir(options.quota_db_filename),
+                options.usage_retention_days,
+            )
+            tasks.append(asyncio.ensure_future(run_every(db.DAY, archive_usage, "usage archiving")))
+        if balances is not None:
+            tasks.append(asyncio.ensure_future(balances.run_refresh()))
+        if profiles_file is not None:
+            tasks.append(asyncio.ensure_future(run_every(options.profiles_reload_interval, reload_profiles, "profiles reload")))
+
+        # the Hub stops services with SIGTERM; cancel whatever is in progress, as for ^C
+        service = asyncio.ensure_future(asyncio.gather(*tasks))
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, service.cancel)
+        try:
+            await service
+        except asyncio.CancelledError:
+            app_log.info("Shutting down")
+
     try:
-        loop.start()
+        asyncio.run(serve())
     except KeyboardInterrupt:
         pass
+    finally:
+        db_executor.shutdown()
+        if balances is not None:
+            balances.close()
@@ -0,0 +1,204 @@
+"""usage retention: moving old rows out of the usage table into compressed monthly archives
+
+Each archive, usage-YYYY-MM.db.gz in the archive directory, is a gzipped sqlite database with a usage table
+laid out like the quota db's, holding the rows dated in that (UTC) month. Only whole months are archived,
+and the quota db's usage_archives table records which months have been, so that reports can include them.
+
+The rollup tables are never archived, so reports that line up with hours or days don't need the archives;
+usage_totals here opens them (decompressed to a temporary file) only for ranges that don't.
+
+Moving a month is crash-safe: the new archive is written next to its final name first, then the rows are
+deleted and the month recorded in one transaction, and only then is the archive renamed into place.
+recover_archives, run before every archiving, finishes renames that a crash interrupted and removes
+archives that were written but never committed.
+"""
+from typing import List, Dict, Tuple, Optional, Sequence, Iterator
+from contextlib import contextmanager
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3 as sq3
+import tempfile
+
+from jhprofilequota import profile_db as db
+
+ARCHIVE_SUFFIX: str = ".db.gz"
+
+
+def default_archive_dir(db_filename: str) -> str:
+    return db_filename + "-archive"
+
+
+# the unix time of the start of the (UTC) month containing timestamp
+def month_start(timestamp: int) -> int:
+    dt: datetime.datetime = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    return int(dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0).timestamp())
+
+
+def next_month(month: int) -> int:
+    return month_start(month + 32 * db.DAY)
+
+
+def archive_filename(month: int) -> str:
+    return "usage-" + datetime.datetime.fromtimestamp(month, datetime.timezone.utc).strftime("%Y-%m") + ARCHIVE_SUFFIX
+
+
+def _compress(src: str, dest: str) -> None:
+    with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+        with gzip.GzipFile(fileobj=dest_file, mode="wb", mtime=0) as gz_file:
+            shutil.copyfileobj(src_file, gz_file, 1024 * 1024)
+        dest_file.flush()
+        os.fsync(dest_file.fileno())
+
+
+def _decompress(src: str, dest: str) -> None:
+    with gzip.open(src, "rb") as gz_file, open(dest, "wb") as dest_file:
+        shutil.copyfileobj(gz_file, dest_file, 1024 * 1024)
+
+
+# an archive decompressed to a temporary file, opened read-only for the duration of the with block
+@contextmanager
+def open_archive(path: str) -> Iterator[sq3.Connection]:
+    fd, work_filename = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        _decompress(path, work_filename)
+        conn: sq3.Connection = sq3.connect("file:" + work_filename + "?mode=ro", uri=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+    finally:
+        os.remove(work_filename)
+
+
+# finishes archivings interrupted by a crash: committed archives still under their temporary name are renamed into place,
+# and temporary archives that were never committed are removed
+def recover_archives(conn: sq3.Connection, archive_dir: str) -> None:
+    if not os.path.isdir(archive_dir):
+        return
+
+    c = conn.cursor()
+    c.execute("SELECT filename, archived FROM usage_archives;")
+    committed: Dict[str, str] = {filename + ".%d.tmp" % archived: filename for filename, archived in c.fetchall()}
+
+    name: str
+    for name in os.listdir(archive_dir):
+        if not name.endswith(".tmp"):
+            continue
+        if name in committed:
+            os.replace(os.path.join(archive_dir, name), os.path.join(archive_dir, committed[name]))
+        else:
+            os.remove(os.path.join(archive_dir, name))
+
+
+# moves the usage rows of one month into its archive (adding to the archive if there is one already); returns the number
+# of rows moved
+def archive_month(conn: sq3.Connection, archive_dir: str, month: int) -> int:
+    end: int = next_month(month)
+    c = conn.cursor()
+
+    c.execute("SELECT COUNT(*) FROM usage WHERE date >= ? AND date < ?;", (month, end))
+    moved: int = c.fetchone()[0]
+    if moved == 0:
+        return 0
+
+    archived_at: int = db.now_epoch()
+    filename: str = archive_filename(month)
+    final_path: str = os.path.join(archive_dir, filename)
+    tmp_path: str = final_path + ".%d.tmp" % archived_at
+
+    fd, work_filename = tempfile.mkstemp(suffix=".work.tmp", dir=archive_dir)
+    os.close(fd)
+    try:
+        if os.path.exists(final_path):
+            _decompress(final_path, work_filename)
+
+        c.execute("ATTACH DATABASE ? AS archive;", (work_filename,))
+        try:
+            c.execute('''CREATE TABLE IF NOT EXISTS archive.usage (
+                         user TEXT NOT NULL,
+                         date INTEGER NOT NULL,
+                         profile_slug TEXT NOT NULL,
+                         hours REAL NOT NULL,
+                         tokens REAL NOT NULL
+                         );''')
+            c.execute('''INSERT INTO archive.usage (user, date, profile_slug, hours, tokens)
+                         SELECT user, date, profile_slug, hours, tokens FROM main.usage
+                         WHERE date >= ? AND date < ? ORDER BY date;''', (month, end))
+            conn.commit()
+            c.execute("SELECT COUNT(*) FROM archive.usage;")
+            total_rows: int = c.fetchone()[0]
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            c.execute("DETACH DATABASE archive;")
+
+        _compress(work_filename, tmp_path)
+    finally:
+        os.remove(work_filename)
+
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        c.execute("DELETE FROM usage WHERE date >= ? AND date < ?;", (month, end))
+        c.execute("INSERT OR REPLACE INTO usage_archives (month, filename, rows, archived) VALUES (?, ?, ?, ?);",
+                  (month, filename, total_rows, archived_at))
+    except BaseException:
+        conn.rollback()
+        os.remove(tmp_path)
+        raise
+    conn.commit()
+
+    os.replace(tmp_path, final_path)
+    return moved
+
+
+# archives the usage rows of every whole month before the one containing `before` (a unix time; e.g. now minus the
+# retention period); returns the (month, rows moved) pairs archived
+def archive_usage(conn: sq3.Connection, archive_dir: str, before: int) -> List[Tuple[int, int]]:
+    os.makedirs(archive_dir, exist_ok=True)
+    recover_archives(conn, archive_dir)
+
+    cutoff: int = month_start(before)
+    c = conn.cursor()
+    c.execute("SELECT MIN(date) FROM usage WHERE date < ?;", (cutoff,))
+    oldest: Optional[int] = c.fetchone()[0]
+
+    archived: List[Tuple[int, int]] = []
+    if oldest is None:
+        return archived
+
+    month: int = month_start(oldest)
+    while month < cutoff:
+        moved: int = archive_month(conn, archive_dir, month)
+        if moved:
+            archived.append((month, moved))
+        month = next_month(month)
+    return archived
+
+
+# db.usage_totals, including the archived usage in archive_dir for ranges that have to be answered from raw usage rows
+def usage_totals(conn: sq3.Connection, archive_dir: str, start: int, end: int, group_by: Sequence[str] = ("user",),
+                 user: Optional[str] = None, profile_slug: Optional[str] = None) -> List[Tuple]:
+    rows: List[Tuple] = db.usage_totals(conn, start, end, group_by, user, profile_slug)
+    if db.rollup_table_for(start, end) is not None:
+        return rows
+
+    c = conn.cursor()
+    c.execute("SELECT filename FROM usage_archives WHERE month >= ? AND month < ? ORDER BY month;", (month_start(start), end))
+    filenames: List[str] = [filename for (filename,) in c.fetchall()]
+    if not filenames:
+        return rows
+
+    totals: Dict[Tuple, List[float]] = {}
+    for row in rows:
+        totals[row[:-2]] = [row[-2], row[-1]]
+    for filename in filenames:
+        with open_archive(os.path.join(archive_dir, filename)) as archive_conn:
+            for row in db.query_usage_totals(archive_conn, "usage", "date", start, end, group_by, user, profile_slug):
+                total: List[float] = totals.setdefault(row[:-2], [0.0, 0.0])
+                total[0] += row[-2]
+                total[1] += row[-1]
+
+    return [key + tuple(total) for key, total in sorted(totals.items())]
@@ -0,0 +1,150 @@
+"""client for the culler's balance service (see balance_service), for use in the hub process
+
+Asks the service for a user's balances and builds the spawn page's profiles list from them on the hub's own profiles,
+as profile_db.get_profiles_by_balance does; only when the service can't be reached (or answers with an error) within
+the timeout does it read the quota db itself. After a failure the service is left alone for retry_after seconds, so
+that spawn pages don't each wait out the timeout while the culler is down; a lookup that only times out falls back to
+the db on its own, and the service is only left alone once timeouts_before_down lookups in a row have timed out (a
+user's first lookup may wait on the culler's transaction to set up their balances). The connection to the service is
+kept open from one lookup to the next (one per thread).
+
+    from jhprofilequota.balance_client import BalanceClient
+    balances = BalanceClient("profile_quotas.db", socket_path="/run/jhprofilequota/balances.sock")
+
+    policies = compile_policies(profiles)  # once, rather than on every lookup
+
+    def profile_list(spawner):
+        return balances.get_profiles_by_balance(policies, spawner.user.name, spawner.user.admin)
+
+Only the standard library is used on this side.
+"""
+from typing import Dict, List, Optional, Union
+import http.client
+import json
+import logging
+import socket
+import threading
+import time
+from urllib.parse import urlencode, urlsplit
+
+from jhprofilequota import profile_db as db
+from jhprofilequota.policy import QuotaPolicies, compile_policies
+
+log: logging.Logger = logging.getLogger(__name__)
+
+TIMEOUT: float = 0.25
+RETRY_AFTER: float = 30.0
+TIMEOUTS_BEFORE_DOWN: int = 3
+
+
+# an http.client connection over a Unix socket
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float = TIMEOUT) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path: str = socket_path
+
+    def connect(self) -> None:  # type: ignore
+        sock: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+# url is the service's, e.g. http://127.0.0.1:9107 (with --balance_port=9107); socket_path is used instead if given;
+# with neither, every lookup reads the db
+class BalanceClient:
+    def __init__(self, db_filename: str, url: Optional[str] = None, socket_path: Optional[str] = None,
+                 timeout: float = TIMEOUT, retry_after: float = RETRY_AFTER, timeouts_before_down: int = TIMEOUTS_BEFORE_DOWN) -> None:
+        self.db_filename: str = db_filename
+        self.url: Optional[str] = url
+        self.socket_path: Optional[str] = socket_path
+        self.timeout: float = timeout
+        self.retry_after: float = retry_after
+        self.timeouts_before_down: int = timeouts_before_down
+        self._down_until: float = 0.0
+        # lookups in a row that have timed out
+        self._timeouts: int = 0
+        self._local: threading.local = threading.local()
+
+    # this thread's connection to the service, reconnecting (on the next request) if it has been closed
+    def _connection(self) -> http.client.HTTPConnection:
+        conn: Optional[http.client.HTTPConnection] = getattr(self._local, "conn", None)
+        if conn is None:
+            if self.socket_path:
+                conn = UnixHTTPConnection(self.socket_path, self.timeout)
+            else:
+                parts = urlsplit(self.url)
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=self.timeout)
+            self._local.conn = conn
+        return conn
+
+    def _request(self, path: str) -> bytes:
+        conn: http.client.HTTPConnection = self._connection()
+        try:
+            conn.request("GET", path)
+            resp: http.client.HTTPResponse = conn.getresponse()
+            body: bytes = resp.read()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # the service closed the kept-alive connection (e.g. it restarted); once more on a new one
+            conn.close()
+            try:
+                conn.request("GET", path)
+                resp = conn.getresponse()
+                body = resp.read()
+            except BaseException:
+                conn.close()
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        if resp.status != 200:
+            raise OSError("balance service answered %i: %s" % (resp.status, body[:200].decode("utf8", "replace")))
+        return body
+
+    # the balances from the service, or None if it couldn't be asked
+    def _fetch_balances(self, user: str, is_admin: bool) -> Optional[Dict[str, float]]:
+        if not (self.url or self.socket_path) or time.monotonic() < self._down_until:
+            return None
+        try:
+            body: bytes = self._request("/balances?" + urlencode({"user": user, "admin": int(bool(is_admin))}))
+            balances: Dict[str, float] = json.loads(body.decode("utf8"))["balances"]
+        except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+            if isinstance(e, socket.timeout):
+                self._timeouts += 1
+                if self._timeouts < self.timeouts_before_down:
+                    log.warning("Balance service slow to answer (%s), reading the quota db for %s's balances", e, user,
+                                extra={"event": "balance_service_slow", "user": user})
+                    return None
+            log.warning("Balance service unavailable (%s), reading the quota db for %s's balances for the next %is",
+                        e, user, self.retry_after, extra={"event": "balance_service_unavailable", "user": user})
+            self._down_until = time.monotonic() + self.retry_after
+            self._timeouts = 0
+            return None
+        self._timeouts = 0
+        return balances
+
+    # the user's current balances keyed by profile slug, for the profiles with a quota, as profile_db.get_user_balances
+    # returns them; from the service, with the db as fallback
+    def get_user_balances(self, profiles: Union[List, QuotaPolicies], user: str, is_admin: bool) -> Dict[str, float]:
+        policies: QuotaPolicies = compile_policies(profiles)
+        balances: Optional[Dict[str, float]] = self._fetch_balances(user, is_admin)
+        # the service goes by the culler's profiles, which may be missing one the hub has just been given
+        if balances is not None and all(profile_slug in balances for profile_slug in policies.quota_slugs):
+            return balances
+
+        conn = db.get_connection(self.db_filename)
+        try:
+            balances = db.get_user_balances(conn, policies, user, is_admin)
+            conn.commit()
+        finally:
+            db.close_connection(conn)
+        return balances
+
+    # the profiles list with the user's balances, as profile_db.get_profiles_by_balance returns it
+    def get_profiles_by_balance(self, profiles: Union[List, QuotaPolicies], user: str, is_admin: bool) -> List:
+        policies: QuotaPolicies = compile_policies(profiles)
+        return db.profiles_with_balances(policies, self.get_user_balances(policies, user, is_admin), is_admin)
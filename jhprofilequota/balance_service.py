@@ -0,0 +1,163 @@
+"""local balance service
+
+The culler can answer the hub's balance lookups itself, so that the hub process never opens the quota db: the service
+keeps the usertokens rows of the users it has been asked about in memory (accruing them on read, like
+profile_db.get_user_balances), and serves them as JSON over HTTP on a local port, a Unix socket, or both:
+
+    python3 -m jhprofilequota --balance_socket=/run/jhprofilequota/balances.sock ...
+    curl --unix-socket /run/jhprofilequota/balances.sock 'http://localhost/balances?user=alice&admin=0'
+    {"user": "alice", "is_admin": false, "balances": {"gpu": 7.5, ...}}
+
+/profiles takes the same arguments and returns the profiles list as profile_db.get_profiles_by_balance would for the
+culler's profiles. The hub side goes through balance_client, which falls back to reading the db itself when the service
+can't be reached.
+
+Rows are read on the service's own db thread (so the cull cycle's transactions on the culler's don't hold up spawn
+pages); a user's first lookup reads (and if need be initializes) their rows, later ones are answered from memory. Every
+refresh_interval seconds the service checks the db's balance_changes counter (see profile_db.BalanceCache), and when
+anything has charged or changed balances since, rereads the rows it holds in one go; so answers lag the db by at most
+that long.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+from collections import OrderedDict
+import asyncio
+import json
+import logging
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_unix_socket
+from tornado.web import Application, HTTPError, RequestHandler
+
+from jhprofilequota import profile_db as db
+from jhprofilequota.db_executor import DBExecutor
+from jhprofilequota.policy import QuotaPolicies, compile_policies
+
+log: logging.Logger = logging.getLogger(__name__)
+
+REFRESH_INTERVAL: float = 1.0
+# users whose rows are kept in memory; beyond that the least recently asked about are dropped
+MAX_USERS: int = 100000
+
+
+class BalanceService:
+    def __init__(self, db_filename: str, profiles: Union[List, QuotaPolicies], refresh_interval: float = REFRESH_INTERVAL,
+                 max_users: int = MAX_USERS, slow_query_threshold: float = 0.0) -> None:
+        self.db_filename: str = db_filename
+        self.policies: QuotaPolicies = compile_policies(profiles)
+        self.refresh_interval: float = refresh_interval
+        self.max_users: int = max_users
+        self._executor: DBExecutor = DBExecutor(db_filename, slow_query_threshold)
+        # user: (is_admin, {profile_slug: (count, last_add)}), least recently asked about first
+        self._rows: OrderedDict = OrderedDict()
+        self._changes: Optional[int] = None
+        # lookups of rows not in memory yet, so that concurrent requests for a user wait on the same one
+        self._loading: Dict[Tuple[str, bool], asyncio.Future] = {}
+
+    def _remember(self, changes: int, rows: Dict[str, Tuple[bool, Dict[str, Tuple[float, int]]]]) -> None:
+        for user, user_rows in rows.items():
+            self._rows[user] = user_rows
+            self._rows.move_to_end(user)
+        while len(self._rows) > self.max_users:
+            self._rows.popitem(last=False)
+        if self._changes is None or changes > self._changes:
+            self._changes = changes
+
+    async def _load(self, user: str, is_admin: bool) -> Dict[str, Tuple[float, int]]:
+        key: Tuple[str, bool] = (user, is_admin)
+        loading: Optional[asyncio.Future] = self._loading.get(key, None)
+        if loading is None:
+            loading = asyncio.ensure_future(self._executor.run(db.load_balance_rows, self.policies, [key]))
+            self._loading[key] = loading
+            loading.add_done_callback(lambda future: self._loading.pop(key, None))
+        changes, rows = await asyncio.shield(loading)
+        self._remember(changes, rows)
+        return rows[user][1]
+
+    # the user's current balances keyed by profile slug, for the profiles with a quota (as profile_db.get_user_balances)
+    async def get_user_balances(self, user: str, is_admin: bool) -> Dict[str, float]:
+        policies: QuotaPolicies = self.policies
+        entry: Optional[Tuple[bool, Dict[str, Tuple[float, int]]]] = self._rows.get(user, None)
+        rows: Dict[str, Tuple[float, int]]
+        # a role change or a new profile goes through the db, which records and initializes them
+        if entry is None or entry[0] != is_admin or not all(profile_slug in entry[1] for profile_slug in policies.quota_slugs):
+            rows = await self._load(user, is_admin)
+        else:
+            rows = entry[1]
+            self._rows.move_to_end(user)
+
+        nowtimestamp: int = db.now_epoch()
+        return {profile_slug: db.accrued_balance(rows[profile_slug][0], rows[profile_slug][1], policies.get(profile_slug, is_admin), nowtimestamp)
+                for profile_slug in policies.quota_slugs if profile_slug in rows}
+
+    async def get_profiles_by_balance(self, user: str, is_admin: bool) -> List:
+        policies: QuotaPolicies = self.policies
+        return db.profiles_with_balances(policies, await self.get_user_balances(user, is_admin), is_admin)
+
+    # rereads the rows in memory if balances have changed in the db since they were read
+    async def refresh(self) -> None:
+        changes: int = await self._executor.run(db.get_balance_changes)
+        if changes == self._changes:
+            return
+        users: Sequence[str] = list(self._rows)
+        changes, rows = await self._executor.run(db.read_balance_rows, users)
+        for user in users:
+            if user not in rows:
+                self._rows.pop(user, None)
+        # leaving out users dropped from memory meanwhile
+        for user, user_rows in rows.items():
+            if user in self._rows:
+                self._rows[user] = user_rows
+        if self._changes is None or changes > self._changes:
+            self._changes = changes
+        log.debug("Reread the balances of %i users", len(rows), extra={"event": "balances_refreshed", "users": len(rows)})
+
+    async def run_refresh(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                # an Exception before python 3.8
+                raise
+            except Exception:
+                log.exception("Error refreshing balances")
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+
+class BalanceHandler(RequestHandler):
+    def initialize(self, service: BalanceService, profiles: bool = False) -> None:
+        self.service: BalanceService = service
+        self.profiles: bool = profiles
+
+    async def get(self) -> None:
+        user: str = self.get_argument("user")
+        admin: str = self.get_argument("admin", "0").lower()
+        if admin not in ("0", "1", "false", "true"):
+            raise HTTPError(400, "admin must be 0 or 1")
+        is_admin: bool = admin in ("1", "true")
+
+        result: Union[Dict, List]
+        if self.profiles:
+            result = await self.service.get_profiles_by_balance(user, is_admin)
+        else:
+            result = {"user": user, "is_admin": is_admin, "balances": await self.service.get_user_balances(user, is_admin)}
+        self.set_header("Content-Type", "application/json")
+        # balances of profiles without a maxBalance can be infinite; json writes those as Infinity, which json reads back
+        self.write(json.dumps(result))
+
+
+# serves the service's balances on the current IOLoop, on a local port and/or a Unix socket (created with socket_mode)
+def start_balance_server(service: BalanceService, port: int = 0, address: str = '127.0.0.1', socket_path: str = '',
+                         socket_mode: int = 0o600) -> HTTPServer:
+    app: Application = Application([
+        (r'/balances', BalanceHandler, {"service": service}),
+        (r'/profiles', BalanceHandler, {"service": service, "profiles": True}),
+    ])
+    server: HTTPServer = HTTPServer(app)
+    if port:
+        server.listen(port, address)
+    if socket_path:
+        server.add_socket(bind_unix_socket(socket_path, mode=socket_mode))
+    return server
@@ -0,0 +1,461 @@
+"""maintenance subcommands for the quota db
+
+Run as `python -m jhprofilequota <command> [options]`; with no command, `python -m jhprofilequota`
+runs the culler service as before.
+
+    python -m jhprofilequota migrate --quota_db_filename=profile_quotas.db [--backup]
+    python -m jhprofilequota report --quota_db_filename=profile_quotas.db [--start=2020-09-01] [--end=2020-10-01]
+                                    [--by=user|profile|user,profile|total] [--user=NAME] [--profile=SLUG]
+                                    [--format=table|csv|json] [--archive_dir=DIR]
+    python -m jhprofilequota archive --quota_db_filename=profile_quotas.db --older_than_days=90 [--archive_dir=DIR]
+                                     [--vacuum]
+    python -m jhprofilequota admin grant --profile=SLUG --tokens=N [--user=NAME ...] [--users_file=FILE]
+    python -m jhprofilequota admin reset --profile=SLUG [--tokens=N] [--user=NAME ...] [--users_file=FILE]
+    python -m jhprofilequota admin set-max --profile=SLUG [--user=NAME ...] [--users_file=FILE]
+    python -m jhprofilequota admin balances [--user=NAME ...] [--users_file=FILE] [--format=table|csv|json]
+    python -m jhprofilequota admin export [--profile=SLUG] [--format=csv|jsonl] [--output=FILE]
+    python -m jhprofilequota admin import [--format=csv|jsonl] [--input=FILE]
+    python -m jhprofilequota forecast --quota_db_filename=profile_quotas.db [--days=28] [--horizon=7] [--by=user|profile]
+                                      [--format=table|csv|json]
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import sys
+from contextlib import contextmanager
+from datetime import timezone
+from typing import IO, Iterator, List, Optional, Tuple
+
+import dateutil.parser
+
+from jhprofilequota import profile_db as db
+from jhprofilequota import archive
+
+
+def add_db_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--quota_db_filename',
+        default='profile_quotas.db',
+        help="File path for the sqlite3 quota database.",
+    )
+
+
+def add_archive_dir_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--archive_dir',
+        help="Directory holding the monthly usage archives. Defaults to <quota_db_filename>-archive.",
+    )
+
+
+def archive_dir_for(args: argparse.Namespace) -> str:
+    return args.archive_dir or archive.default_archive_dir(args.quota_db_filename)
+
+
+def migrate(args: argparse.Namespace) -> int:
+    """Upgrade an existing quota db to the current schema in place"""
+    if args.backup:
+        backup_filename = args.quota_db_filename + '.bak'
+        shutil.copy2(args.quota_db_filename, backup_filename)
+        print("Copied %s to %s" % (args.quota_db_filename, backup_filename))
+
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        original_version = db.migrate_db(conn)
+    finally:
+        conn.close()
+
+    if original_version == 0:
+        print("%s has no quota tables; nothing to migrate" % args.quota_db_filename, file=sys.stderr)
+        return 1
+    if original_version == db.SCHEMA_VERSION:
+        print("%s is already at schema version %s" % (args.quota_db_filename, db.SCHEMA_VERSION))
+    else:
+        print("Migrated %s from schema version %s to %s" % (args.quota_db_filename, original_version, db.SCHEMA_VERSION))
+    return 0
+
+
+def parse_time(time_string: str) -> int:
+    """Parse a date or date and time into unix time, assuming UTC if no timezone is given"""
+    dt = dateutil.parser.parse(time_string)
+    if not dt.tzinfo:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+# --by choices and the usage_totals grouping they stand for
+REPORT_GROUPINGS = {
+    'user': ('user',),
+    'profile': ('profile_slug',),
+    'user,profile': ('user', 'profile_slug'),
+    'total': (),
+}
+
+
+def report(args: argparse.Namespace) -> int:
+    """Report hours and tokens used per user and/or profile over a date range"""
+    start = parse_time(args.start) if args.start else 0
+    if args.end:
+        end = parse_time(args.end)
+    else:
+        # the end of today, so that the daily rollups can be used
+        end = db.now_epoch() - db.now_epoch() % db.DAY + db.DAY
+    group_by = REPORT_GROUPINGS[args.by]
+
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        rows = archive.usage_totals(conn, archive_dir_for(args), start, end, group_by, user=args.user, profile_slug=args.profile)
+    finally:
+        db.close_connection(conn)
+
+    header = list(group_by) + ['hours', 'tokens']
+    write_rows(header, rows, args.format)
+    return 0
+
+
+def archive_usage(args: argparse.Namespace) -> int:
+    """Move usage rows older than a given age into compressed monthly archives"""
+    before = int(db.now_epoch() - args.older_than_days * db.DAY)
+    archive_dir = archive_dir_for(args)
+
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        archived = archive.archive_usage(conn, archive_dir, before)
+        if args.vacuum:
+            conn.execute("VACUUM;")
+    finally:
+        db.close_connection(conn)
+
+    for month, rows in archived:
+        print("Archived %i usage rows to %s" % (rows, archive.archive_filename(month)))
+    if not archived:
+        print("No usage older than %s days to archive" % args.older_than_days)
+    return 0
+
+
+# writes rows to stdout as aligned columns, csv or one json object per line; text columns are left-aligned and numbers
+# right-aligned in the table format, with two decimals for floats
+def write_rows(header: List[str], rows: List[Tuple], output_format: str) -> None:
+    if output_format == 'json':
+        for row in rows:
+            print(json.dumps(dict(zip(header, row))))
+    elif output_format == 'csv':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(header)
+        writer.writerows(rows)
+    else:
+        numeric = [bool(rows) and not isinstance(cell, str) for cell in (rows[0] if rows else header)]
+        cells = [header] + [[('%.2f' % cell) if numeric[i] and isinstance(cell, float) else str(cell) for i, cell in enumerate(row)] for row in rows]
+        widths = [max(len(row[i]) for row in cells) for i in range(len(header))]
+        for row in cells:
+            print('  '.join(cell.rjust(width) if numeric[i] else cell.ljust(width)
+                            for i, (cell, width) in enumerate(zip(row, widths))).rstrip())
+
+
+def forecast_balances(args: argparse.Namespace) -> int:
+    """Forecast which balances run out soon and how many hours each profile will serve, from recent usage"""
+    try:
+        from jhprofilequota import forecast
+    except ImportError as e:
+        print("forecasting needs numpy: %s" % e, file=sys.stderr)
+        return 1
+    if not args.profiles_json:
+        print("--profiles_json (or JUPYTERHUB_PROFILES_JSON) is needed for the quota policies", file=sys.stderr)
+        return 1
+
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        result = forecast.forecast(conn, json.loads(args.profiles_json), days=args.days)
+    finally:
+        db.close_connection(conn)
+
+    if args.by == 'user':
+        header = ['user', 'profile_slug', 'balance', 'burn_tokens_per_day', 'days_to_zero']
+        rows = result.running_out(args.horizon)
+    else:
+        header = ['profile_slug', 'users', 'active_users', 'running_out', 'demand_hours', 'funded_hours', 'funded_tokens']
+        rows = result.profile_demand(args.horizon)
+    write_rows(header, rows, args.format)
+    return 0
+
+
+# opens path for reading or writing, or hands out stdin/stdout for "-"
+@contextmanager
+def open_stream(path: str, mode: str) -> Iterator[IO]:
+    if path == '-':
+        yield sys.stdin if 'r' in mode else sys.stdout
+    else:
+        with open(path, mode, newline='') as f:
+            yield f
+
+
+# the users named with --user and in --users_file (one per line), or None for every user with a balance
+def selected_users(args: argparse.Namespace) -> Optional[List[str]]:
+    if not args.user and not args.users_file:
+        return None
+    users = list(args.user or [])
+    if args.users_file:
+        with open_stream(args.users_file, 'r') as f:
+            users.extend(line.strip() for line in f if line.strip())
+    return users
+
+
+def profiles_for(args: argparse.Namespace) -> Optional[List]:
+    return json.loads(args.profiles_json) if args.profiles_json else None
+
+
+def admin_grant(args: argparse.Namespace) -> int:
+    """Add tokens to (or with a negative number, take them from) users' balances for a profile"""
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        changed = db.grant_tokens(conn, args.profile, args.tokens, selected_users(args), profiles_for(args), args.chunk_size)
+    finally:
+        db.close_connection(conn)
+    print("Granted %s tokens to %i balances for %s" % (args.tokens, changed, args.profile))
+    return 0
+
+
+def admin_reset(args: argparse.Namespace) -> int:
+    """Set users' balances for a profile to a number of tokens, or to the profile's initial balance"""
+    profiles = profiles_for(args)
+    if args.tokens is None and profiles is None:
+        print("--tokens or --profiles_json is needed to reset balances", file=sys.stderr)
+        return 1
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        changed = db.reset_balances(conn, args.profile, args.tokens, selected_users(args), profiles, args.chunk_size)
+    finally:
+        db.close_connection(conn)
+    print("Reset %i balances for %s" % (changed, args.profile))
+    return 0
+
+
+def admin_set_max(args: argparse.Namespace) -> int:
+    """Top users' balances for a profile up to its maxBalance"""
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        changed = db.fill_balances(conn, args.profile, selected_users(args), profiles_for(args), args.chunk_size)
+    finally:
+        db.close_connection(conn)
+    print("Set %i balances for %s to their maximum" % (changed, args.profile))
+    return 0
+
+
+def admin_balances(args: argparse.Namespace) -> int:
+    """List users' current balances for every profile with a quota"""
+    profiles = profiles_for(args)
+    if profiles is None:
+        print("--profiles_json (or JUPYTERHUB_PROFILES_JSON) is needed for the quota policies", file=sys.stderr)
+        return 1
+    policies = db.compile_policies(profiles)
+
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        users = db.known_users(conn)
+        names = selected_users(args)
+        if names is not None:
+            roles = dict(users)
+            users = [(user, roles.get(user, False)) for user in names]
+        balances = db.get_balances(conn, policies, users)
+    finally:
+        db.close_connection(conn)
+
+    rows = [(user, profile_slug, balances[user][profile_slug])
+            for user, is_admin in users for profile_slug in policies.slugs
+            if profile_slug in balances[user] and args.profile in (None, profile_slug)]
+    write_rows(['user', 'profile_slug', 'balance'], rows, args.format)
+    return 0
+
+
+# the columns of exported balances; imports need user, profile_slug and either count and last_add or balance
+BALANCE_COLUMNS: List[str] = ['user', 'profile_slug', 'is_admin', 'count', 'last_add', 'balance']
+
+
+def admin_export(args: argparse.Namespace) -> int:
+    """Write every balance (or those of one profile) out as csv or json lines"""
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        with open_stream(args.output, 'w') as out:
+            if args.format == 'csv':
+                writer = csv.writer(out)
+                writer.writerow(BALANCE_COLUMNS)
+                for user, profile_slug, is_admin, count, last_add, balance in db.iter_balances(conn, args.profile):
+                    writer.writerow([user, profile_slug, int(is_admin), count, last_add, balance])
+            else:
+                for row in db.iter_balances(conn, args.profile):
+                    out.write(json.dumps(dict(zip(BALANCE_COLUMNS, row))) + '\n')
+    finally:
+        db.close_connection(conn)
+    return 0
+
+
+def parse_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+# reads balance records (dicts keyed by BALANCE_COLUMNS) into (user, profile_slug, is_admin, count, last_add) rows; a
+# record with only a balance is taken to be that balance as of now
+def balance_rows(records: Iterator[dict]) -> Iterator[Tuple[str, str, bool, float, int]]:
+    now = db.now_epoch()
+    for record in records:
+        if record.get('count') not in (None, '') and record.get('last_add') not in (None, ''):
+            count, last_add = float(record['count']), int(record['last_add'])
+        else:
+            count, last_add = float(record['balance']), now
+        yield (record['user'], record['profile_slug'], parse_bool(record.get('is_admin', False)), count, last_add)
+
+
+def admin_import(args: argparse.Namespace) -> int:
+    """Read balances from csv or json lines, as written by export, replacing those that exist"""
+    conn = db.get_connection(args.quota_db_filename)
+    try:
+        with open_stream(args.input, 'r') as f:
+            if args.format == 'csv':
+                records = csv.DictReader(f)
+            else:
+                records = (json.loads(line) for line in f if line.strip())
+            imported = db.import_balances(conn, balance_rows(records), args.chunk_size)
+    finally:
+        db.close_connection(conn)
+    print("Imported %i balances" % imported)
+    return 0
+
+
+def add_selection_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument('--profile', required=True, help="Profile slug whose balances to change.")
+    parser.add_argument('--user', action='append', help="A user whose balance to change; may be repeated. Defaults to every user with a balance for the profile.")
+    parser.add_argument('--users_file', help="File with a user to change per line, or - for stdin.")
+    parser.add_argument(
+        '--profiles_json',
+        default=os.environ.get('JUPYTERHUB_PROFILES_JSON'),
+        help="""Hub profiles as JSON. If given, listed users without a balance for the profile get their initial
+                one first, and the profiles' quota policies are recorded as the culler does.""",
+    )
+
+
+def add_chunk_size_argument(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        default=db.BULK_CHUNK_SIZE,
+        help="Rows written per transaction; the hub and the culler wait for at most one of these.",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='python -m jhprofilequota', description="Quota db maintenance commands.")
+    subparsers = parser.add_subparsers(dest='command')
+
+    migrate_parser = subparsers.add_parser('migrate', help=migrate.__doc__)
+    add_db_argument(migrate_parser)
+    migrate_parser.add_argument(
+        '--backup',
+        action='store_true',
+        help="Copy the db file to <quota_db_filename>.bak before migrating.",
+    )
+    migrate_parser.set_defaults(func=migrate)
+
+    report_parser = subparsers.add_parser('report', help=report.__doc__)
+    add_db_argument(report_parser)
+    report_parser.add_argument('--start', help="Start of the range (inclusive), as a date or date and time; UTC unless a timezone is given. Defaults to the beginning of the log.")
+    report_parser.add_argument('--end', help="End of the range (exclusive), as a date or date and time; UTC unless a timezone is given. Defaults to the end of today.")
+    report_parser.add_argument('--by', choices=list(REPORT_GROUPINGS), default='user', help="How to group the totals.")
+    report_parser.add_argument('--user', help="Only report usage by this user.")
+    report_parser.add_argument('--profile', help="Only report usage of this profile slug.")
+    report_parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table', help="Output format.")
+    add_archive_dir_argument(report_parser)
+    report_parser.set_defaults(func=report)
+
+    archive_parser = subparsers.add_parser('archive', help=archive_usage.__doc__)
+    add_db_argument(archive_parser)
+    add_archive_dir_argument(archive_parser)
+    archive_parser.add_argument(
+        '--older_than_days',
+        type=float,
+        required=True,
+        help="Archive the whole months of usage that are entirely older than this many days.",
+    )
+    archive_parser.add_argument(
+        '--vacuum',
+        action='store_true',
+        help="VACUUM the quota db afterwards to return the freed space to the filesystem.",
+    )
+    archive_parser.set_defaults(func=archive_usage)
+
+    forecast_parser = subparsers.add_parser('forecast', help=forecast_balances.__doc__)
+    add_db_argument(forecast_parser)
+    forecast_parser.add_argument('--days', type=int, default=28, help="Whole days of usage, up to the start of today, to work out burn rates from.")
+    forecast_parser.add_argument('--horizon', type=float, default=7, help="Days ahead to forecast.")
+    forecast_parser.add_argument('--by', choices=['user', 'profile'], default='user', help="List the balances running out within the horizon, or the projected hours per profile.")
+    forecast_parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table', help="Output format.")
+    forecast_parser.add_argument(
+        '--profiles_json',
+        default=os.environ.get('JUPYTERHUB_PROFILES_JSON'),
+        help="Hub profiles as JSON, for the quota policies.",
+    )
+    forecast_parser.set_defaults(func=forecast_balances)
+
+    admin_parser = subparsers.add_parser('admin', help="Change, export or import balances in bulk")
+    admin_subparsers = admin_parser.add_subparsers(dest='action')
+    admin_subparsers.required = True
+
+    grant_parser = admin_subparsers.add_parser('grant', help=admin_grant.__doc__)
+    add_db_argument(grant_parser)
+    add_selection_arguments(grant_parser)
+    grant_parser.add_argument('--tokens', type=float, required=True, help="Tokens to add; balances stay capped at the profile's maxBalance.")
+    add_chunk_size_argument(grant_parser)
+    grant_parser.set_defaults(func=admin_grant)
+
+    reset_parser = admin_subparsers.add_parser('reset', help=admin_reset.__doc__)
+    add_db_argument(reset_parser)
+    add_selection_arguments(reset_parser)
+    reset_parser.add_argument('--tokens', type=float, help="Balance to set. Defaults to the profile's initial balance (needs --profiles_json).")
+    add_chunk_size_argument(reset_parser)
+    reset_parser.set_defaults(func=admin_reset)
+
+    set_max_parser = admin_subparsers.add_parser('set-max', help=admin_set_max.__doc__)
+    add_db_argument(set_max_parser)
+    add_selection_arguments(set_max_parser)
+    add_chunk_size_argument(set_max_parser)
+    set_max_parser.set_defaults(func=admin_set_max)
+
+    balances_parser = admin_subparsers.add_parser('balances', help=admin_balances.__doc__)
+    add_db_argument(balances_parser)
+    balances_parser.add_argument('--profile', help="Only list balances for this profile slug.")
+    balances_parser.add_argument('--user', action='append', help="A user whose balances to list (initializing any they don't have yet); may be repeated. Defaults to every user with a balance.")
+    balances_parser.add_argument('--users_file', help="File with a user to list per line, or - for stdin.")
+    balances_parser.add_argument(
+        '--profiles_json',
+        default=os.environ.get('JUPYTERHUB_PROFILES_JSON'),
+        help="Hub profiles as JSON, for the quota policies.",
+    )
+    balances_parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table', help="Output format.")
+    balances_parser.set_defaults(func=admin_balances)
+
+    export_parser = admin_subparsers.add_parser('export', help=admin_export.__doc__)
+    add_db_argument(export_parser)
+    export_parser.add_argument('--profile', help="Only export balances for this profile slug.")
+    export_parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help="Output format.")
+    export_parser.add_argument('--output', default='-', help="File to write to, or - for stdout.")
+    export_parser.set_defaults(func=admin_export)
+
+    import_parser = admin_subparsers.add_parser('import', help=admin_import.__doc__)
+    add_db_argument(import_parser)
+    import_parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv', help="Input format.")
+    import_parser.add_argument('--input', default='-', help="File to read from, or - for stdin.")
+    add_chunk_size_argument(import_parser)
+    import_parser.set_defaults(func=admin_import)
+
+    return parser
+
+
+# the subcommand names, so that __main__ can tell them apart from the culler's own options
+COMMANDS: List[str] = ['migrate', 'report', 'archive', 'forecast', 'admin']
+
+
+def main(argv: List[str]) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
@@ -0,0 +1,53 @@
+from typing import Any, Callable, Optional
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+import sqlite3 as sq3
+
+from jhprofilequota import profile_db as db
+from jhprofilequota import metrics
+
+
+# runs quota db work on a single dedicated thread, so that the culler's sqlite calls don't block the IOLoop
+# work is queued with submit(fn, *args), which calls fn(conn, *args) on the db thread and returns a
+# concurrent.futures.Future for its result; coroutines await run(fn, *args) instead
+# the thread holds one pooled connection for as long as the executor is running, so state that lives on the connection,
+# like server runtimes staged with profile_db.stage_server_runtimes, carries over from one call to the next; being the
+# only thread using it, calls run one at a time, in the order they were submitted
+# the time each call takes is recorded in metrics.DB_OPERATION_DURATION_SECONDS under the function's name; with a
+# slow_query_threshold, statements taking that long are logged with the call they were part of (see db.SlowQueryLog)
+class DBExecutor:
+    def __init__(self, db_filename: str, slow_query_threshold: float = 0.0) -> None:
+        self.db_filename: str = db_filename
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="quota-db")
+        self._conn: Optional[sq3.Connection] = None
+        self._slow_queries: Optional[db.SlowQueryLog] = db.SlowQueryLog(slow_query_threshold) if slow_query_threshold else None
+
+    def _run(self, fn: Callable[..., Any], args: Any, kwargs: Any) -> Any:
+        if self._conn is None:
+            self._conn = db.get_connection(self.db_filename)
+            if self._slow_queries is not None:
+                self._slow_queries.install(self._conn)
+        if self._slow_queries is not None:
+            self._slow_queries.start()
+        try:
+            with metrics.DB_OPERATION_DURATION_SECONDS.labels(operation=fn.__name__).time():
+                return fn(self._conn, *args, **kwargs)
+        finally:
+            if self._slow_queries is not None:
+                self._slow_queries.finish(fn.__name__)
+
+    def submit(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Future:
+        return self._executor.submit(self._run, fn, args, kwargs)
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _release(self) -> None:
+        if self._conn is not None:
+            db.close_connection(self._conn)
+            self._conn = None
+
+    # finishes the queued work and hands the connection back to the pool
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.submit(self._release)
+        self._executor.shutdown(wait=wait)
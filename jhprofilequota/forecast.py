@@ -0,0 +1,164 @@
+"""balance forecasting and capacity planning
+
+Works out, from the last `days` whole (UTC) days of usage, how fast each user is spending the tokens of each profile
+(their burn rate), when their balance will run out at that rate under the profile's newTokensPerDay, and how many
+server hours each profile can be expected to serve over the coming days.
+
+Usage is read from the usage_daily rollup table (which archiving never touches) and the balances from usertokens,
+each with a single query, into NumPy arrays; everything after that is vectorized, so a forecast over millions of
+rows takes seconds. Requires numpy.
+
+    from jhprofilequota import forecast
+    f = forecast.forecast(conn, profiles, days=28)
+    f.running_out(within_days=7)    # [(user, profile_slug, balance, burn_tokens_per_day, days_to_zero), ...]
+    f.profile_demand(horizon_days=7)
+"""
+from typing import List, Dict, Tuple, Optional, Union
+import sqlite3 as sq3
+
+import numpy as np
+
+from jhprofilequota import profile_db as db
+from jhprofilequota.policy import QuotaPolicy, QuotaPolicies, compile_policies
+
+
+# a forecast for every (user, profile) balance, as parallel arrays indexed by balance: users[user_index[i]] and
+# profile_slugs[profile_index[i]] name balance i
+class Forecast:
+    def __init__(self, users: List[str], profile_slugs: List[str], user_index: np.ndarray, profile_index: np.ndarray,
+                 is_admin: np.ndarray, balance: np.ndarray, rate: np.ndarray, cost: np.ndarray,
+                 burn_tokens: np.ndarray, burn_hours: np.ndarray) -> None:
+        self.users: List[str] = users
+        self.profile_slugs: List[str] = profile_slugs
+        self.user_index: np.ndarray = user_index
+        self.profile_index: np.ndarray = profile_index
+        self.is_admin: np.ndarray = is_admin
+        # accrued balance as of the forecast, in tokens, and the tokens per day it accrues at
+        self.balance: np.ndarray = balance
+        self.rate: np.ndarray = rate
+        self.cost: np.ndarray = cost
+        # average tokens and server hours used per day over the forecast's window
+        self.burn_tokens: np.ndarray = burn_tokens
+        self.burn_hours: np.ndarray = burn_hours
+
+        # days until the balance reaches zero at the current burn and accrual rates: 0 if it's there already, inf if it
+        # isn't going down
+        net: np.ndarray = self.burn_tokens - self.rate
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.days_to_zero: np.ndarray = np.where(
+                self.balance <= 0, 0.0, np.where(net > 0, self.balance / net, np.inf)
+            )
+
+    def __len__(self) -> int:
+        return len(self.balance)
+
+    # the balances that run out within the given number of days, soonest first, as (user, profile_slug, balance,
+    # burn_tokens_per_day, days_to_zero) tuples
+    def running_out(self, within_days: float) -> List[Tuple[str, str, float, float, float]]:
+        selected: np.ndarray = np.flatnonzero(self.days_to_zero <= within_days)
+        selected = selected[np.argsort(self.days_to_zero[selected], kind='stable')]
+        return [
+            (self.users[u], self.profile_slugs[p], balance, burn, days)
+            for u, p, balance, burn, days in zip(
+                self.user_index[selected].tolist(), self.profile_index[selected].tolist(),
+                self.balance[selected].tolist(), self.burn_tokens[selected].tolist(), self.days_to_zero[selected].tolist(),
+            )
+        ]
+
+    # projected use of each profile over the next horizon_days, as (profile_slug, users, active_users, running_out,
+    # demand_hours, funded_hours, funded_tokens) tuples in profile order: demand is what the users would use at their
+    # burn rates, funded what their balances (and the tokens accruing meanwhile) pay for; active users are those with
+    # any usage in the window, running_out those whose balance runs out within the horizon
+    def profile_demand(self, horizon_days: float) -> List[Tuple[str, int, int, int, float, float, float]]:
+        n_profiles: int = len(self.profile_slugs)
+
+        def per_profile(values: np.ndarray) -> np.ndarray:
+            return np.bincount(self.profile_index, weights=values, minlength=n_profiles)
+
+        demand_tokens: np.ndarray = self.burn_tokens * horizon_days
+        funded_tokens: np.ndarray = np.minimum(demand_tokens, np.maximum(self.balance, 0.0) + self.rate * horizon_days)
+        # free profiles (cost 0) are funded whatever the balance
+        with np.errstate(divide='ignore', invalid='ignore'):
+            funded_hours: np.ndarray = np.where(
+                self.cost > 0, funded_tokens / self.cost, self.burn_hours * horizon_days
+            )
+
+        users: np.ndarray = np.bincount(self.profile_index, minlength=n_profiles)
+        active: np.ndarray = np.bincount(self.profile_index[self.burn_hours > 0], minlength=n_profiles)
+        running_out: np.ndarray = np.bincount(self.profile_index[self.days_to_zero <= horizon_days], minlength=n_profiles)
+        return list(zip(
+            self.profile_slugs, users.tolist(), active.tolist(), running_out.tolist(),
+            per_profile(self.burn_hours * horizon_days).tolist(), per_profile(funded_hours).tolist(),
+            per_profile(funded_tokens).tolist(),
+        ))
+
+
+# the rate, maxBalance and cost of each profile in slugs for one role, as arrays indexed like slugs; balances under
+# inactive quotas don't accrue (see profile_db.accrual_params)
+def _policy_arrays(policies: QuotaPolicies, slugs: List[str], is_admin: bool) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    profile_policies: List[QuotaPolicy] = [policies.get(slug, is_admin) for slug in slugs]
+    params: List[Tuple[float, float]] = [db.accrual_params(policy) for policy in profile_policies]
+    return (
+        np.array([rate for rate, max_balance in params], dtype=float),
+        np.array([max_balance for rate, max_balance in params], dtype=float),
+        np.array([policy.cost for policy in profile_policies], dtype=float),
+    )
+
+
+# forecasts every balance for the profiles with a quota from the usage of the `days` whole days before now (default:
+# the current time)
+def forecast(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], days: int = 28, now: Optional[int] = None) -> Forecast:
+    policies: QuotaPolicies = compile_policies(profiles)
+    if now is None:
+        now = db.now_epoch()
+    end: int = now - now % db.DAY
+    start: int = end - days * db.DAY
+
+    slugs: List[str] = [slug for slug in policies.slugs if slug in policies.quota_slugs]
+    profile_codes: Dict[str, int] = {slug: i for i, slug in enumerate(slugs)}
+    user_codes: Dict[str, int] = {}
+
+    c = conn.cursor()
+    c.execute("SELECT user, profile_slug, is_admin, count, last_add FROM usertokens;")
+    rows: List[Tuple[str, str, int, float, int]] = [row for row in c.fetchall() if row[1] in profile_codes]
+    user_index: np.ndarray = np.fromiter((user_codes.setdefault(row[0], len(user_codes)) for row in rows), dtype=np.int64, count=len(rows))
+    profile_index: np.ndarray = np.fromiter((profile_codes[row[1]] for row in rows), dtype=np.int64, count=len(rows))
+    is_admin: np.ndarray = np.fromiter((row[2] for row in rows), dtype=bool, count=len(rows))
+    count: np.ndarray = np.fromiter((row[3] for row in rows), dtype=float, count=len(rows))
+    last_add: np.ndarray = np.fromiter((row[4] for row in rows), dtype=float, count=len(rows))
+
+    user_params = _policy_arrays(policies, slugs, False)
+    admin_params = _policy_arrays(policies, slugs, True)
+    rate, max_balance, cost = (
+        np.where(is_admin, admin_values[profile_index], user_values[profile_index])
+        for user_values, admin_values in zip(user_params, admin_params)
+    )
+    # the same closed form as profile_db.accrued_balance
+    balance: np.ndarray = np.minimum(count + ((now - last_add) / 3600.0) * rate / 24.0, max_balance)
+
+    # usage summed per balance: each (user, profile) pair gets a key, the usage rows' keys are looked up among the
+    # balances' with a sorted search, and the rows are summed into the balances they found
+    n_profiles: int = max(len(slugs), 1)
+    balance_keys: np.ndarray = user_index * n_profiles + profile_index
+    order: np.ndarray = np.argsort(balance_keys)
+    sorted_keys: np.ndarray = balance_keys[order]
+
+    c.execute("SELECT user, profile_slug, SUM(hours), SUM(tokens) FROM usage_daily WHERE period >= ? AND period < ? GROUP BY user, profile_slug;",
+              (start, end))
+    usage: List[Tuple[str, str, float, float]] = [row for row in c.fetchall() if row[0] in user_codes and row[1] in profile_codes]
+    usage_keys: np.ndarray = np.fromiter((user_codes[row[0]] * n_profiles + profile_codes[row[1]] for row in usage),
+                                         dtype=np.int64, count=len(usage))
+    hours: np.ndarray = np.fromiter((row[2] for row in usage), dtype=float, count=len(usage))
+    tokens: np.ndarray = np.fromiter((row[3] for row in usage), dtype=float, count=len(usage))
+
+    found: np.ndarray = np.searchsorted(sorted_keys, usage_keys)
+    found = np.minimum(found, max(len(sorted_keys) - 1, 0))
+    matched: np.ndarray = sorted_keys[found] == usage_keys if len(sorted_keys) else np.zeros(len(usage_keys), dtype=bool)
+    target: np.ndarray = order[found[matched]] if len(sorted_keys) else found[matched]
+    burn_tokens: np.ndarray = np.bincount(target, weights=tokens[matched], minlength=len(rows)) / days
+    burn_hours: np.ndarray = np.bincount(target, weights=hours[matched], minlength=len(rows)) / days
+
+    users: List[str] = [None] * len(user_codes)
+    for user, code in user_codes.items():
+        users[code] = user
+    return Forecast(users, slugs, user_index, profile_index, is_admin, balance, rate, cost, burn_tokens, burn_hours)
@@ -0,0 +1,136 @@
+"""adaptive request scheduling for the culler's Hub API calls
+
+HubClient.fetch stands in for AsyncHTTPClient.fetch: it limits the requests in flight with an AIMD (additive increase,
+multiplicative decrease) limit, like TCP congestion control, and retries idempotent requests that fail transiently
+after a randomly jittered, exponentially growing delay.
+
+The limit starts at max_concurrency. Each response that comes back within latency_target (in seconds) without a server
+error raises it by 1/limit, so by about one request per round of `limit` requests; a slow response, a 5xx or a
+connection error multiplies it by decrease_factor, at most once per round (requests that were already in flight when
+the limit was last cut don't cut it again). It stays between min_concurrency and max_concurrency, and lives as long as
+the HubClient does, so the service keeps one for all its cycles.
+
+Connections are kept alive and reused by the curl client (see tornado.curl_httpclient), which holds up to its
+max_clients handles open between requests; the service sizes that to --concurrency. tornado's simple client opens a
+connection per request.
+"""
+from typing import Optional
+import asyncio
+import random
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest, HTTPResponse
+from tornado.log import app_log # type: ignore
+
+from jhprofilequota import metrics
+
+# HTTP methods that can be safely sent again when no response (or a transient error) came back
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+
+# response codes worth retrying: tornado's 599 for connection errors and timeouts, rate limiting and unavailable or
+# overloaded gateways
+RETRY_CODES = frozenset([429, 502, 503, 504, 599])
+
+LATENCY_TARGET: float = 2.0
+DECREASE_FACTOR: float = 0.5
+RETRIES: int = 3
+RETRY_DELAY: float = 0.5
+MAX_RETRY_DELAY: float = 30.0
+
+
+# an in-flight limit that can change while requests wait on it; max_concurrency = 0 means no limit
+class AdaptiveLimiter:
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1, latency_target: float = LATENCY_TARGET,
+                 decrease_factor: float = DECREASE_FACTOR) -> None:
+        self.max_concurrency: int = max_concurrency
+        self.min_concurrency: int = max(1, min(min_concurrency, max_concurrency)) if max_concurrency else 0
+        self.latency_target: float = latency_target
+        self.decrease_factor: float = decrease_factor
+
+        self.limit: float = float(max_concurrency)
+        self.in_flight: int = 0
+        # perf_counter time of the last decrease; requests started before it don't decrease the limit again
+        self._last_decrease: float = 0.0
+        self._released: asyncio.Condition = asyncio.Condition()
+        metrics.HUB_API_CONCURRENCY_LIMIT.set(self.limit)
+
+    def _has_room(self) -> bool:
+        return not self.max_concurrency or self.in_flight < int(self.limit)
+
+    async def acquire(self) -> float:
+        """Wait for a free slot; returns the time the request is considered started at"""
+        async with self._released:
+            await self._released.wait_for(self._has_room)
+            self.in_flight += 1
+        return time.perf_counter()
+
+    async def release(self, started: float, latency: float, failed: bool) -> None:
+        """Free a slot, adjusting the limit for how the request went"""
+        self.in_flight -= 1
+        if self.max_concurrency:
+            if failed or (self.latency_target and latency > self.latency_target):
+                if started >= self._last_decrease:
+                    self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+                    self._last_decrease = time.perf_counter()
+                    app_log.debug("Hub API concurrency limit lowered to %i", int(self.limit))
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            metrics.HUB_API_CONCURRENCY_LIMIT.set(self.limit)
+        async with self._released:
+            self._released.notify(max(1, int(self.limit) - self.in_flight))
+
+
+# fetches Hub API requests through an AdaptiveLimiter, retrying the idempotent ones; requests are timed and counted in
+# the Hub API metrics
+class HubClient:
+    def __init__(self, max_concurrency: int = 10, min_concurrency: int = 1, latency_target: float = LATENCY_TARGET,
+                 decrease_factor: float = DECREASE_FACTOR, retries: int = RETRIES, retry_delay: float = RETRY_DELAY,
+                 max_retry_delay: float = MAX_RETRY_DELAY, client: Optional[AsyncHTTPClient] = None) -> None:
+        self.limiter: AdaptiveLimiter = AdaptiveLimiter(max_concurrency, min_concurrency, latency_target, decrease_factor)
+        self.retries: int = retries
+        self.retry_delay: float = retry_delay
+        self.max_retry_delay: float = max_retry_delay
+        self.client: AsyncHTTPClient = client or AsyncHTTPClient()
+
+    # "full jitter": a uniformly random delay up to the exponentially growing cap, so that requests failing together
+    # don't come back together
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_retry_delay, self.retry_delay * 2 ** attempt))
+
+    async def _fetch_once(self, req: HTTPRequest) -> HTTPResponse:
+        started = await self.limiter.acquire()
+        code = 599
+        failed = True
+        try:
+            with metrics.HUB_API_REQUESTS_IN_FLIGHT.track_inprogress():
+                resp = await self.client.fetch(req)
+            code = resp.code
+            failed = False
+            return resp
+        except HTTPClientError as e:
+            code = e.code
+            failed = code >= 500
+            raise
+        finally:
+            latency = time.perf_counter() - started
+            metrics.HUB_API_REQUEST_DURATION_SECONDS.labels(method=req.method, code=code).observe(latency)
+            await self.limiter.release(started, latency, failed)
+
+    async def fetch(self, req: HTTPRequest) -> HTTPResponse:
+        """client.fetch, limited and retried"""
+        retries = self.retries if req.method in IDEMPOTENT_METHODS else 0
+        attempt = 0
+        while True:
+            try:
+                return await self._fetch_once(req)
+            except (HTTPClientError, OSError) as e:
+                code = e.code if isinstance(e, HTTPClientError) else 599
+                if attempt >= retries or code not in RETRY_CODES:
+                    raise
+                delay = self.backoff(attempt)
+                attempt += 1
+                app_log.warning(
+                    "%s %s failed (%s); retrying in %.2fs (%i/%i)", req.method, req.url, e, delay, attempt, retries
+                )
+                metrics.HUB_API_RETRIES.labels(method=req.method, code=code).inc()
+                await asyncio.sleep(delay)
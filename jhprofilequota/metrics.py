@@ -0,0 +1,148 @@
+"""Prometheus metrics for the culler service
+
+The metrics live in prometheus_client's default registry (as JupyterHub's own do) and are served in the Prometheus
+text format by MetricsHandler, at /metrics on the service's --metrics_port:
+
+    python3 -m jhprofilequota --metrics_port=9106 ...
+    curl http://127.0.0.1:9106/metrics
+
+prometheus_client is only needed for serving them: without it the metrics are recorded nowhere (see NullMetric), and
+the culler runs as long as --metrics_port isn't set.
+"""
+from typing import Any, Iterator
+from contextlib import contextmanager
+import sqlite3 as sq3
+
+try:
+    from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+except ImportError:
+    prometheus_client_missing = True
+else:
+    prometheus_client_missing = False
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
+
+from jhprofilequota import profile_db as db
+
+
+# stands in for the Counters, Gauges and Histograms below when prometheus_client isn't installed, ignoring what's recorded
+class NullMetric:
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        pass
+
+    def labels(self, *args: Any, **kwargs: Any) -> "NullMetric":
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def set(self, value: float) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        yield
+
+    @contextmanager
+    def track_inprogress(self) -> Iterator[None]:
+        yield
+
+
+if prometheus_client_missing:
+    Counter = Gauge = Histogram = NullMetric  # type: ignore
+
+
+CULL_CYCLE_DURATION_SECONDS = Histogram(
+    'jhprofilequota_cull_cycle_duration_seconds',
+    "Time taken by a complete cull cycle: listing, charging and culling",
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf")),
+)
+
+SERVER_LATENCY_SECONDS = Histogram(
+    'jhprofilequota_server_latency_seconds',
+    "Time from a charged server's page of the user list arriving to its charge being worked out and handed to the "
+    "account stage, one observation per server (applying and culling are timed by the cycle duration)",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, float("inf")),
+)
+
+HUB_API_REQUEST_DURATION_SECONDS = Histogram(
+    'jhprofilequota_hub_api_request_duration_seconds',
+    "Time taken by requests to the Hub API, by method and response code (599 for connection errors)",
+    ['method', 'code'],
+)
+
+HUB_API_REQUESTS_IN_FLIGHT = Gauge(
+    'jhprofilequota_hub_api_requests_in_flight',
+    "Requests to the Hub API currently in progress",
+)
+
+HUB_API_CONCURRENCY_LIMIT = Gauge(
+    'jhprofilequota_hub_api_concurrency_limit',
+    "The adaptive limit on requests to the Hub API in flight (see hub_client.AdaptiveLimiter)",
+)
+
+HUB_API_RETRIES = Counter(
+    'jhprofilequota_hub_api_retries',
+    "Requests to the Hub API retried after a transient failure, by method and response code (599 for connection errors)",
+    ['method', 'code'],
+)
+
+DB_OPERATION_DURATION_SECONDS = Histogram(
+    'jhprofilequota_db_operation_duration_seconds',
+    "Time taken by quota db operations on the culler's db thread, by profile_db function",
+    ['operation'],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")),
+)
+
+DB_STATEMENTS = Counter(
+    'jhprofilequota_db_statements',
+    "sqlite statements executed by the culler, by kind (SELECT, INSERT, UPDATE, BEGIN, COMMIT, ...)",
+    ['kind'],
+)
+
+SERVERS_CHARGED = Counter(
+    'jhprofilequota_servers_charged',
+    "Server check intervals charged for, by profile",
+    ['profile'],
+)
+
+TOKENS_CHARGED = Counter(
+    'jhprofilequota_tokens_charged',
+    "Tokens charged to users' balances, by profile",
+    ['profile'],
+)
+
+NEGATIVE_BALANCE_USERS = Gauge(
+    'jhprofilequota_negative_balance_users',
+    "Users whose balance is below zero as of the last count (see --negative_balances_interval), by profile",
+    ['profile'],
+)
+
+
+# a profile_db connection hook (see profile_db.add_connection_hook) counting the statements run on the connection in
+# DB_STATEMENTS; executemany counts once per row
+def count_statements(conn: sq3.Connection) -> None:
+    def trace(statement: str) -> None:
+        kind = statement.split(None, 1)[0].upper() if statement.strip() else ""
+        DB_STATEMENTS.labels(kind=kind).inc()
+
+    db.add_trace_callback(conn, trace)
+
+
+class MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header('Content-Type', CONTENT_TYPE_LATEST)
+        self.write(generate_latest(REGISTRY))
+
+
+# serves the metrics at /metrics on the current IOLoop
+def start_metrics_server(port: int, address: str = '127.0.0.1') -> HTTPServer:
+    if prometheus_client_missing:
+        raise RuntimeError("serving metrics needs prometheus_client (pip install prometheus_client)")
+    app: Application = Application([(r'/metrics', MetricsHandler)])
+    server: HTTPServer = HTTPServer(app)
+    server.listen(port, address)
+    return server
@@ -0,0 +1,146 @@
+from typing import List, Dict, Tuple, Optional, Union
+
+# quota settings are given per role inside each profile's "quota" entry, e.g.
+# {"slug": "gpu", "quota": {"costTokensPerHour": 2.0, "minBalanceToSpawn": 1.0,
+#                           "users": {"newTokensPerDay": 4.0, "initialBalance": 8.0, "maxBalance": 24.0},
+#                           "admins": {"newTokensPerDay": 24.0}}}
+ROLE_USERS: str = "users"
+ROLE_ADMINS: str = "admins"
+
+
+def role_for(is_admin: bool) -> str:
+    if is_admin:
+        return ROLE_ADMINS
+    return ROLE_USERS
+
+
+# the quota settings for one (profile slug, role) pair, with the defaults filled in
+# profiles without a quota entry get a policy with has_quota = False: nothing accrues, the balance starts (and stays)
+# infinite, and usage is charged at 1 token per hour
+class QuotaPolicy:
+    __slots__ = ("slug", "role", "has_quota", "rate", "initial", "max_balance", "min_to_spawn", "cost", "active", "disabled")
+
+    def __init__(self, slug: str, role: str, quota: Optional[Dict] = None) -> None:
+        self.slug: str = slug
+        self.role: str = role
+        self.has_quota: bool = quota is not None
+
+        if quota is None:
+            quota = {}
+        role_quota: Dict = quota.get(role, {})
+
+        self.rate: float = role_quota.get("newTokensPerDay", 0.0)
+        self.initial: float = role_quota.get("initialBalance", float("inf"))
+        self.max_balance: float = role_quota.get("maxBalance", float("inf"))
+        self.active: bool = role_quota.get("active", True)  # quotas default to active if not specified
+        self.disabled: bool = role_quota.get("disabled", False)
+        self.min_to_spawn: float = quota.get("minBalanceToSpawn", 0.0)
+        self.cost: float = quota.get("costTokensPerHour", 1.0)
+
+    def __repr__(self) -> str:
+        return "QuotaPolicy(%r, %r, rate=%r, initial=%r, max_balance=%r, min_to_spawn=%r, cost=%r, active=%r, disabled=%r)"%(
+            self.slug, self.role, self.rate, self.initial, self.max_balance, self.min_to_spawn, self.cost, self.active, self.disabled)
+
+
+# the profiles list compiled into a table of QuotaPolicy entries keyed by (slug, role)
+# profiles holds the original profiles list (used for building the spawn form), slugs the unique profile slugs in
+# profile order and quota_slugs the subset of those that have a quota
+# if a slug is listed more than once the last definition wins
+class QuotaPolicies:
+    __slots__ = ("profiles", "slugs", "quota_slugs", "_table", "_by_role")
+
+    def __init__(self, profiles: List) -> None:
+        self.profiles: List = profiles
+        self._table: Dict[Tuple[str, str], QuotaPolicy] = {}
+
+        slugs: Dict[str, None] = {}
+        profile: Dict
+        for profile in profiles:
+            profile_slug: str = profile["slug"]
+            slugs.setdefault(profile_slug, None)
+            for role in (ROLE_USERS, ROLE_ADMINS):
+                self._table[(profile_slug, role)] = QuotaPolicy(profile_slug, role, profile.get("quota", None))
+
+        self.slugs: List[str] = list(slugs)
+        self.quota_slugs: frozenset = frozenset(slug for slug in self.slugs if self._table[(slug, ROLE_USERS)].has_quota)
+        self._by_role: Dict[str, List[QuotaPolicy]] = {
+            role: [self._table[(slug, role)] for slug in self.slugs] for role in (ROLE_USERS, ROLE_ADMINS)
+        }
+
+    # the policy for a profile slug and role; slugs not in the profiles list get the no-quota defaults
+    def get(self, profile_slug: str, is_admin: bool) -> QuotaPolicy:
+        role: str = role_for(is_admin)
+        policy: Optional[QuotaPolicy] = self._table.get((profile_slug, role), None)
+        if policy is None:
+            policy = QuotaPolicy(profile_slug, role)
+        return policy
+
+    # all policies for a role, one per profile slug in profile order
+    def for_role(self, is_admin: bool) -> List[QuotaPolicy]:
+        return self._by_role[role_for(is_admin)]
+
+    def __len__(self) -> int:
+        return len(self.slugs)
+
+
+# compiles a profiles list into a QuotaPolicies table; already-compiled tables are returned as-is, so the db functions
+# accept either and callers that make many calls (like the culler) only pay for compiling once
+def compile_policies(profiles: Union[List, QuotaPolicies]) -> QuotaPolicies:
+    if isinstance(profiles, QuotaPolicies):
+        return profiles
+    return QuotaPolicies(profiles)
+
+
+# the quota settings validate_profiles checks the types of, by where they're given
+PROFILE_QUOTA_NUMBERS: Tuple[str, ...] = ("costTokensPerHour", "minBalanceToSpawn")
+ROLE_QUOTA_NUMBERS: Tuple[str, ...] = ("newTokensPerDay", "initialBalance", "maxBalance")
+ROLE_QUOTA_FLAGS: Tuple[str, ...] = ("active", "disabled")
+
+
+# checks that profiles is a profiles list QuotaPolicies can compile, with quota settings of the right types, raising
+# ValueError for the first problem found; for profiles loaded while the culler runs, which shouldn't take it down
+def validate_profiles(profiles: List) -> None:
+    if not isinstance(profiles, list):
+        raise ValueError("profiles must be a list, not %s" % type(profiles).__name__)
+    i: int
+    for i, profile in enumerate(profiles):
+        if not isinstance(profile, dict):
+            raise ValueError("profile %i must be an object" % i)
+        if not isinstance(profile.get("slug", None), str):
+            raise ValueError("profile %i has no slug" % i)
+        if "quota" not in profile:
+            continue
+        quota = profile["quota"]
+        where: str = "quota of profile %s" % profile["slug"]
+        if not isinstance(quota, dict):
+            raise ValueError("%s must be an object" % where)
+        _validate_settings(quota, PROFILE_QUOTA_NUMBERS, (), where)
+        for role in (ROLE_USERS, ROLE_ADMINS):
+            if role not in quota:
+                continue
+            if not isinstance(quota[role], dict):
+                raise ValueError("%s %s must be an object" % (where, role))
+            _validate_settings(quota[role], ROLE_QUOTA_NUMBERS, ROLE_QUOTA_FLAGS, "%s %s" % (where, role))
+
+
+def _validate_settings(settings: Dict, numbers: Tuple[str, ...], flags: Tuple[str, ...], where: str) -> None:
+    name: str
+    for name in numbers:
+        if name in settings and (isinstance(settings[name], bool) or not isinstance(settings[name], (int, float))):
+            raise ValueError("%s: %s must be a number, not %r" % (where, name, settings[name]))
+    for name in flags:
+        if name in settings and not isinstance(settings[name], bool):
+            raise ValueError("%s: %s must be true or false, not %r" % (where, name, settings[name]))
+
+
+# the profile slugs added, removed and with changed quota settings (for either role) going from old to new
+def diff_policies(old: QuotaPolicies, new: QuotaPolicies) -> Tuple[List[str], List[str], List[str]]:
+    added: List[str] = [slug for slug in new.slugs if slug not in old.slugs]
+    removed: List[str] = [slug for slug in old.slugs if slug not in new.slugs]
+    changed: List[str] = [
+        slug for slug in new.slugs if slug in old.slugs and any(
+            getattr(old.get(slug, is_admin), name) != getattr(new.get(slug, is_admin), name)
+            for is_admin in (False, True) for name in QuotaPolicy.__slots__
+        )
+    ]
+    return added, removed, changed
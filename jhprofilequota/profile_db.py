@@ -1,58 +1,522 @@
-from typing import List, Dict, Tuple, Optional, Union
+from typing import Any, List, Dict, Tuple, Optional, Union, Callable, Sequence, Iterable, Iterator
+from collections import OrderedDict
+import itertools
+import logging
 import sqlite3 as sq3
-import datetime
-import sys
+import threading
+import time
 
+from jhprofilequota.policy import QuotaPolicy, QuotaPolicies, compile_policies
+
+# events are logged with the user/profile they concern as extra record attributes (user, profile_slug, ...), so that
+# structured log handlers can pick them up; per-profile events are at DEBUG level
+log: logging.Logger = logging.getLogger(__name__)
+
+# format of the timestamps stored by schema version 1 dbs; version 2 stores integer unix times (see now_epoch)
 TIME_FMT = "%Y-%m-%d %H:%M:%S"
 
+# the version of the db layout this module reads and writes, kept in the db's user_version pragma
+SCHEMA_VERSION: int = 8
+
+# usage is also kept summed up per (user, profile_slug, period) in these rollup tables, keyed by period length in seconds;
+# periods start at multiples of their length in unix time, i.e. hours and days are UTC
+HOUR: int = 60 * 60
+DAY: int = 24 * HOUR
+ROLLUP_TABLES: Dict[int, str] = {HOUR: "usage_hourly", DAY: "usage_daily"}
+
+def now_epoch() -> int:
+    return int(time.time())
+
+# how long (in seconds) a connection waits on another process's lock before failing with "database is locked"
+BUSY_TIMEOUT: float = 10.0
+
+# WAL lets readers (the hub's spawn page) carry on while a writer (the culler) holds a transaction open;
+# set this to e.g. "DELETE" for db files on filesystems that don't support WAL's shared memory, like NFS
+# the journal mode is a setting of the db file rather than the connection, so it is only set by the culler
+# (configure_pool(journal_mode=...), from --db_journal_mode); other processes' connections use whatever it set
+JOURNAL_MODE: str = "WAL"
+
+
+# functions called with each new pooled connection once it's set up, e.g. to install trace callbacks for instrumentation
+CONNECTION_HOOKS: List[Callable[[sq3.Connection], None]] = []
+
+def add_connection_hook(hook: Callable[[sq3.Connection], None]) -> None:
+    CONNECTION_HOOKS.append(hook)
+
+
+# connections made by the pool remember which db file they belong to (None for in-memory dbs, which aren't pooled),
+# and the trace callbacks sharing the connection's one sqlite trace callback (see add_trace_callback)
+class PooledConnection(sq3.Connection):
+    pool_filename: Optional[str] = None
+    trace_callbacks: Optional[List[Callable[[str], None]]] = None
+
+
+# sqlite takes a single trace callback per connection; connection hooks that want to see the statements run (metrics,
+# the slow query log) add theirs with this, and each is called with every statement
+def add_trace_callback(conn: sq3.Connection, callback: Callable[[str], None]) -> None:
+    callbacks: Optional[List[Callable[[str], None]]] = getattr(conn, "trace_callbacks", None)
+    if callbacks is None:
+        callbacks = []
+        conn.trace_callbacks = callbacks  # type: ignore
+
+        def trace(statement: str) -> None:
+            for callback in callbacks:
+                callback(statement)
+
+        conn.set_trace_callback(trace)
+    callbacks.append(callback)
+
+
+# statements that take longer than a SlowQueryLog's threshold are logged here at WARNING level, with the statement, its
+# duration (in seconds) and the operation it was part of as the extra record attributes "statement", "duration" and
+# "operation"
+slow_query_log: logging.Logger = logging.getLogger(__name__ + ".slow_queries")
+
+
+# times the statements run on one connection, logging those taking threshold seconds or more to slow_query_log
+# the statements are seen through the connection's trace callback as they start (install adds it), and each is taken to
+# run until the next one starts, or until the operation they're part of finishes for the last; the caller marks
+# operations with start and finish (DBExecutor does, around every call), so the time is wall clock time, including
+# waiting on other writers' locks, COMMIT's syncing to disk, and the caller's own work between statements
+# a statement run many times in a row (executemany runs it once per row) is timed and logged once, with the count
+class SlowQueryLog:
+    def __init__(self, threshold: float) -> None:
+        self.threshold: float = threshold
+        # the operation's statements so far, as [statement, started, times run in a row]
+        self._statements: List[List[Any]] = []
+
+    def install(self, conn: sq3.Connection) -> None:
+        add_trace_callback(conn, self._trace)
+
+    def _trace(self, statement: str) -> None:
+        if self._statements and self._statements[-1][0] == statement:
+            self._statements[-1][2] += 1
+        else:
+            self._statements.append([statement, time.perf_counter(), 1])
+
+    def start(self) -> None:
+        self._statements = []
+
+    def finish(self, operation: str) -> None:
+        finished: float = time.perf_counter()
+        i: int
+        for i, (statement, started, times) in enumerate(self._statements):
+            duration: float = (self._statements[i + 1][1] if i + 1 < len(self._statements) else finished) - started
+            if duration >= self.threshold:
+                slow_query_log.warning("Slow statement in %s (%.3fs%s): %s", operation, duration,
+                                       ", %i runs" % times if times > 1 else "", statement[:1000],
+                                       extra={"event": "slow_query", "operation": operation, "statement": statement,
+                                              "duration": duration, "runs": times})
+        self._statements = []
+
+
+# keeps idle connections around per db file so that get_connection doesn't pay for opening the file, loading the 
+# schema and setting up pragmas on every call; connections are created with check_same_thread=False so that one 
+# released on one thread can be picked up by another (only one thread uses a connection at a time)
+# in-memory dbs are never pooled, since every connection to ":memory:" is a different db
+# journal_mode, if given, is set on each new connection's db (see JOURNAL_MODE)
+class ConnectionPool:
+    def __init__(self, busy_timeout: float = BUSY_TIMEOUT, journal_mode: Optional[str] = None, max_idle: int = 4) -> None:
+        self.busy_timeout: float = busy_timeout
+        self.journal_mode: Optional[str] = journal_mode
+        self.max_idle: int = max_idle
+        self._idle: Dict[str, List[PooledConnection]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def _connect(self, db_filename: str) -> PooledConnection:
+        conn: PooledConnection = sq3.connect(db_filename, timeout=self.busy_timeout, check_same_thread=False, factory=PooledConnection)
+        c = conn.cursor()
+        c.execute("PRAGMA busy_timeout = %d;" % int(self.busy_timeout * 1000))
+        if db_filename != ":memory:":
+            conn.pool_filename = db_filename
+            if self.journal_mode is not None:
+                c.execute("PRAGMA journal_mode = %s;" % self.journal_mode)
+        # in WAL mode NORMAL only syncs at checkpoints; it can't corrupt the db, though the last commits may be lost on power failure
+        # (with the culler's charges applied in one commit per cycle, see apply_staged_charges, nothing waits on a sync per charge)
+        c.execute("PRAGMA synchronous = NORMAL;")
+        for hook in CONNECTION_HOOKS:
+            hook(conn)
+        return conn
+
+    def acquire(self, db_filename: str) -> PooledConnection:
+        with self._lock:
+            idle: List[PooledConnection] = self._idle.get(db_filename, [])
+            while idle:
+                conn: PooledConnection = idle.pop()
+                try:
+                    conn.total_changes
+                except sq3.ProgrammingError:
+                    # closed directly by its last user rather than through close_connection
+                    continue
+                return conn
+
+        return self._connect(db_filename)
+
+    # returns a connection to the pool (or closes it, if it isn't pooled or enough connections are idle already);
+    # any transaction still open is rolled back
+    def release(self, conn: sq3.Connection) -> None:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sq3.ProgrammingError:
+            # already closed
+            return
+
+        db_filename: Optional[str] = getattr(conn, "pool_filename", None)
+        if db_filename is not None:
+            with self._lock:
+                idle: List[PooledConnection] = self._idle.setdefault(db_filename, [])
+                if len(idle) < self.max_idle:
+                    idle.append(conn)  # type: ignore
+                    return
+        conn.close()
+
+    # closes all idle connections; connections in use are closed when they are released
+    def close_all(self) -> None:
+        with self._lock:
+            idle_lists: List[List[PooledConnection]] = list(self._idle.values())
+            self._idle = {}
+        for idle in idle_lists:
+            for conn in idle:
+                conn.close()
+
+
+_pool: ConnectionPool = ConnectionPool()
+
+
+# changes the settings used for new pooled connections (idle connections are closed so that the settings apply to all)
+def configure_pool(busy_timeout: Optional[float] = None, journal_mode: Optional[str] = None, max_idle: Optional[int] = None) -> None:
+    if busy_timeout is not None:
+        _pool.busy_timeout = busy_timeout
+    if journal_mode is not None:
+        _pool.journal_mode = journal_mode
+    if max_idle is not None:
+        _pool.max_idle = max_idle
+    _pool.close_all()
+
+# returns a connection from the pool; hand it back with close_connection (which commits) when done
 def get_connection(db_filename: str) -> sq3.Connection:
-    conn: sq3.Connection = sq3.connect(db_filename)
-    return conn
+    return _pool.acquire(db_filename)
 
 def close_connection(conn: sq3.Connection) -> None:
     conn.commit()
-    conn.close()
+    _pool.release(conn)
+
+
+# balances are stored lazily: a usertokens row holds the balance (count) as of last_add, and the tokens accrued since
+# are only added when the balance is read, or written when it changes otherwise (charges, policy changes)
+# since accrual never lowers a balance, accruing over one long interval and capping at maxBalance once gives the same
+# balance as accruing (and capping) over every cycle in between did when balances were rewritten each cycle
+
+# the balance a usertokens row (count, last_add) stands for at time now: the tokens accrued since last_add under policy
+# added, capped at maxBalance (the same computation ACCRUE_SQL stores)
+def accrued_balance(count: float, last_add: int, policy: QuotaPolicy, now: int) -> float:
+    if not policy.active:
+        return count
+    return float(min(count + ((now - last_add) / 3600.0) * policy.rate / 24.0, policy.max_balance))
+
+
+# the (rate, max_balance) that balances accrue at under policy: those of the policy, or none for inactive quotas
+def accrual_params(policy: QuotaPolicy) -> Tuple[float, float]:
+    if not policy.active:
+        return (0.0, float("inf"))
+    return (policy.rate, policy.max_balance)
+
+
+# default bounds for the balance cache (see BalanceCache)
+BALANCE_CACHE_SIZE: int = 4096
+BALANCE_CACHE_TTL: float = 30.0
+
+# an LRU cache of users' usertokens rows, {profile_slug: (count, last_add)}, keyed by (db file, user, is_admin), so that
+# repeated spawn page loads (get_user_balances) don't go back to sqlite for them
+# since balances are accrued from the rows on read, writes that only bring rows up to date leave cached rows valid; every
+# other change to balances (charging tokens, policy changes) bumps the counter in the balance_changes table, and entries are only used while it still
+# holds the value it had when they were read; entries also expire ttl seconds after being read, and beyond max_entries
+# the least recently used are evicted (max_entries = 0 turns caching off)
+class BalanceCache:
+    def __init__(self, max_entries: int = BALANCE_CACHE_SIZE, ttl: float = BALANCE_CACHE_TTL) -> None:
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, key: Tuple[str, str, bool], changes: int) -> Optional[Dict[str, Tuple[float, int]]]:
+        with self._lock:
+            entry: Optional[Tuple[Dict[str, Tuple[float, int]], int, float]] = self._entries.get(key, None)
+            if entry is None:
+                return None
+            rows, entry_changes, expires = entry
+            if entry_changes != changes or expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return rows
+
+    def put(self, key: Tuple[str, str, bool], changes: int, rows: Dict[str, Tuple[float, int]]) -> None:
+        if self.max_entries <= 0:
+            return
+        db_filename, user, is_admin = key
+        with self._lock:
+            # the user's rows now record the other role, so an entry for it would skip putting that back
+            self._entries.pop((db_filename, user, not is_admin), None)
+            self._entries[key] = (rows, changes, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_balance_cache: BalanceCache = BalanceCache()
+
+
+# changes the balance cache's bounds, emptying it
+def configure_balance_cache(max_entries: Optional[int] = None, ttl: Optional[float] = None) -> None:
+    if max_entries is not None:
+        _balance_cache.max_entries = max_entries
+    if ttl is not None:
+        _balance_cache.ttl = ttl
+    _balance_cache.clear()
+
+
+# records a change to balances other than accrual, for the balance cache; call it inside the transaction making it
+def _count_balance_change(c: sq3.Cursor) -> None:
+    c.execute("UPDATE balance_changes SET counter = counter + 1;")
+
+
+# the most ? parameters a statement may have on any sqlite version (SQLITE_MAX_VARIABLE_NUMBER was 999 before 3.32)
+MAX_VARIABLES: int = 999
+
+
+# inserts the initial balance for each profile that each of users, (user, is_admin) pairs, doesn't have a balance for
+# yet, as one multi-row INSERT OR IGNORE (an upsert that leaves existing rows alone, and one that works on older sqlite
+# versions) per MAX_VARIABLES parameters, so a single user takes one statement however many profiles there are
+def _insert_initial_balances(c: sq3.Cursor, policies: QuotaPolicies, users: Sequence[Tuple[str, bool]], nowtimestamp: int) -> None:
+    rows: List[Tuple[str, str, float, int, bool]] = [
+        (user, policy.slug, policy.initial, nowtimestamp, is_admin) for user, is_admin in users for policy in policies.for_role(is_admin)
+    ]
+    per_statement: int = MAX_VARIABLES // 5
+    i: int
+    for i in range(0, len(rows), per_statement):
+        chunk: List[Tuple[str, str, float, int, bool]] = rows[i:i + per_statement]
+        c.execute("INSERT OR IGNORE INTO usertokens (user, profile_slug, count, last_add, is_admin) VALUES " +
+                  ", ".join(["(?, ?, ?, ?, ?)"] * len(chunk)) + ";", [value for row in chunk for value in row])
+
+
+# reads the usertokens rows of users, (user, is_admin) pairs, with one indexed SELECT per MAX_VARIABLES users, as
+# {user: {profile_slug: (count, last_add, recorded is_admin)}}
+def _select_balance_rows(c: sq3.Cursor, users: Sequence[Tuple[str, bool]]) -> Dict[str, Dict[str, Tuple[float, int, bool]]]:
+    names: List[str] = list(dict.fromkeys(user for user, is_admin in users))
+    rows: Dict[str, Dict[str, Tuple[float, int, bool]]] = {user: {} for user in names}
+    i: int
+    for i in range(0, len(names), MAX_VARIABLES):
+        chunk: List[str] = names[i:i + MAX_VARIABLES]
+        c.execute("SELECT user, profile_slug, count, last_add, is_admin FROM usertokens WHERE user IN (" +
+                  ", ".join(["?"] * len(chunk)) + ");", chunk)
+        for user, profile_slug, count, last_add, is_admin in c.fetchall():
+            rows[user][profile_slug] = (float(count), last_add, bool(is_admin))
+    return rows
+
+
+# records the users' roles on their rows where they have changed, bringing those balances up to date under the
+# policies of the role they had until now first; rows are as read by _select_balance_rows, and are updated to match
+def _record_roles(c: sq3.Cursor, policies: QuotaPolicies, users: Sequence[Tuple[str, bool]],
+                  rows: Dict[str, Dict[str, Tuple[float, int, bool]]], nowtimestamp: int) -> None:
+    role_changed: List[Tuple[str, bool, str]] = [
+        (user, is_admin, profile_slug) for user, is_admin in users
+        for profile_slug, (count, last_add, recorded_admin) in rows[user].items() if recorded_admin != bool(is_admin)
+    ]
+    if not role_changed:
+        return
+    c.executemany(ACCRUE_SQL + " AND user = ?;",
+                  [accrual_params(policies.get(profile_slug, not is_admin)) + (nowtimestamp, profile_slug, user)
+                   for user, is_admin, profile_slug in role_changed])
+    c.executemany("UPDATE usertokens SET is_admin = ? WHERE user = ? AND is_admin != ?;",
+                  list(dict.fromkeys((is_admin, user, is_admin) for user, is_admin, profile_slug in role_changed)))
+    _count_balance_change(c)
+    for user, is_admin, profile_slug in role_changed:
+        count, last_add, recorded_admin = rows[user][profile_slug]
+        rows[user][profile_slug] = (accrued_balance(count, last_add, policies.get(profile_slug, not is_admin), nowtimestamp),
+                                    nowtimestamp, bool(is_admin))
+
+
+# the users, (user, is_admin) pairs, whose rows (as read by _select_balance_rows) are missing a balance for one of
+# their role's profiles or record another role
+def _users_to_initialize(policies: QuotaPolicies, users: Sequence[Tuple[str, bool]],
+                         rows: Dict[str, Dict[str, Tuple[float, int, bool]]]) -> List[Tuple[str, bool]]:
+    return [(user, is_admin) for user, is_admin in users
+            if any(policy.slug not in rows[user] for policy in policies.for_role(is_admin))
+            or any(recorded_admin != is_admin for count, last_add, recorded_admin in rows[user].values())]
+
+
+# initializes the missing balances of users, (user, is_admin) pairs, and records their roles (see ensure_initialized),
+# returning their rows as {user: {profile_slug: (count, last_add)}}: a constant number of statements for any number of
+# profiles, and a handful per thousand users; a user listed more than once gets the last role listed
+# the rows are read first, and only users with something to initialize or record are written, so that for users who
+# are all set up (every spawn page after their first) this is a plain read, which doesn't wait on (or hold up) writers
+# in WAL mode
+def _load_balance_rows(c: sq3.Cursor, policies: QuotaPolicies, users: Sequence[Tuple[str, bool]]) -> Dict[str, Dict[str, Tuple[float, int]]]:
+    users = list({user: bool(is_admin) for user, is_admin in users}.items())
+    rows: Dict[str, Dict[str, Tuple[float, int, bool]]] = _select_balance_rows(c, users)
+    to_initialize: List[Tuple[str, bool]] = _users_to_initialize(policies, users, rows)
+    if to_initialize:
+        nowtimestamp: int = now_epoch()
+        _insert_initial_balances(c, policies, to_initialize, nowtimestamp)
+        # reread inside the write transaction, which another writer may have beaten us to
+        rows.update(_select_balance_rows(c, to_initialize))
+        _record_roles(c, policies, to_initialize, rows, nowtimestamp)
+    return _without_roles(rows)
+
+
+# rows as read by _select_balance_rows, without the roles recorded in them
+def _without_roles(rows: Dict[str, Dict[str, Tuple[float, int, bool]]]) -> Dict[str, Dict[str, Tuple[float, int]]]:
+    return {user: {profile_slug: (count, last_add) for profile_slug, (count, last_add, is_admin) in user_rows.items()}
+            for user, user_rows in rows.items()}
+
+
+# returns the current balances of each of users, (user, is_admin) pairs, keyed by user and then profile slug, for the
+# profiles with a quota, initializing any that don't exist yet; for pages listing many users' balances (the spawn page
+# goes through get_user_balances, which caches them); nothing is committed here
+def get_balances(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], users: Sequence[Tuple[str, bool]]) -> Dict[str, Dict[str, float]]:
+    policies: QuotaPolicies = compile_policies(profiles)
+    roles: Dict[str, bool] = {user: bool(is_admin) for user, is_admin in users}
+    rows: Dict[str, Dict[str, Tuple[float, int]]] = _load_balance_rows(conn.cursor(), policies, users)
+
+    nowtimestamp: int = now_epoch()
+    return {user: {profile_slug: accrued_balance(user_rows[profile_slug][0], user_rows[profile_slug][1],
+                                                 policies.get(profile_slug, roles[user]), nowtimestamp)
+                   for profile_slug in policies.quota_slugs if profile_slug in user_rows}
+            for user, user_rows in rows.items()}
+
+
+# every user with a balance, and the role recorded with it, in name order
+def known_users(conn: sq3.Connection) -> List[Tuple[str, bool]]:
+    c = conn.cursor()
+    c.execute("SELECT user, MAX(is_admin) FROM usertokens GROUP BY user ORDER BY user;")
+    return [(user, bool(is_admin)) for user, is_admin in c.fetchall()]
+
+
+# the current value of the balance_changes counter (see BalanceCache)
+def get_balance_changes(conn: sq3.Connection) -> int:
+    c = conn.cursor()
+    c.execute("SELECT counter FROM balance_changes;")
+    return c.fetchone()[0]
+
+
+# initializes the missing balances of users, (user, is_admin) pairs, records their roles (see _load_balance_rows) and
+# commits, returning their rows as {user: (is_admin, {profile_slug: (count, last_add)})} along with the balance_changes
+# counter they go with, for callers keeping the rows in memory and accruing them on read (the balance service)
+# the rows are read in a read transaction of their own first, and the write lock is only taken (waiting on whatever
+# transaction the culler has open) if a user has balances to initialize or a role to record
+def load_balance_rows(conn: sq3.Connection, profiles: Union[List, QuotaPolicies],
+                      users: Sequence[Tuple[str, bool]]) -> Tuple[int, Dict[str, Tuple[bool, Dict[str, Tuple[float, int]]]]]:
+    policies: QuotaPolicies = compile_policies(profiles)
+    roles: Dict[str, bool] = {user: bool(is_admin) for user, is_admin in users}
+    c = conn.cursor()
+    c.execute("BEGIN")
+    try:
+        changes: int = get_balance_changes(conn)
+        read_rows: Dict[str, Dict[str, Tuple[float, int, bool]]] = _select_balance_rows(c, list(roles.items()))
+    finally:
+        conn.commit()
+
+    rows: Dict[str, Dict[str, Tuple[float, int]]]
+    if _users_to_initialize(policies, list(roles.items()), read_rows):
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            rows = _load_balance_rows(c, policies, users)
+            changes = get_balance_changes(conn)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+    else:
+        rows = _without_roles(read_rows)
+    return changes, {user: (roles[user], user_rows) for user, user_rows in rows.items()}
+
+
+# reads the usertokens rows of users as load_balance_rows returns them (with the role recorded in the rows), without
+# initializing or recording anything; users without a balance are left out
+def read_balance_rows(conn: sq3.Connection, users: Sequence[str]) -> Tuple[int, Dict[str, Tuple[bool, Dict[str, Tuple[float, int]]]]]:
+    c = conn.cursor()
+    # one read transaction, so that the counter goes with the rows
+    c.execute("BEGIN")
+    try:
+        changes: int = get_balance_changes(conn)
+        rows: Dict[str, Dict[str, Tuple[float, int, bool]]] = _select_balance_rows(c, [(user, False) for user in users])
+    finally:
+        conn.commit()
+    return changes, {
+        user: (any(is_admin for count, last_add, is_admin in user_rows.values()),
+               {profile_slug: (count, last_add) for profile_slug, (count, last_add, is_admin) in user_rows.items()})
+        for user, user_rows in rows.items() if user_rows
+    }
+
+
+# returns the user's current balances keyed by profile slug, for the profiles with a quota, initializing any that don't
+# exist yet; read through the balance cache for pooled connections
+def get_user_balances(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, is_admin: bool) -> Dict[str, float]:
+    policies: QuotaPolicies = compile_policies(profiles)
+    db_filename: Optional[str] = getattr(conn, "pool_filename", None)
+    key: Tuple[str, str, bool] = (db_filename, user, is_admin)
+
+    c = conn.cursor()
+
+    changes: int = 0
+    rows: Optional[Dict[str, Tuple[float, int]]] = None
+    if db_filename is not None:
+        changes = get_balance_changes(conn)
+        rows = _balance_cache.get(key, changes)
+        if rows is not None and not all(profile_slug in rows for profile_slug in policies.quota_slugs):
+            rows = None
+
+    if rows is None:
+        rows = _load_balance_rows(c, policies, [(user, is_admin)])[user]
+        if db_filename is not None:
+            _balance_cache.put(key, changes, rows)
+
+    nowtimestamp: int = now_epoch()
+    return {profile_slug: accrued_balance(rows[profile_slug][0], rows[profile_slug][1], policies.get(profile_slug, is_admin), nowtimestamp)
+            for profile_slug in policies.quota_slugs if profile_slug in rows}
 
 # returns the profiles list with an extra "disabled" = True or False in each profile dictionary, determined by 
 # the quota metadata in the profiles (minBalanceToSpawn, default to 0.0 if not specified) and the users' balances
 # also an entry for the current "balanceTokens" and "balanceHours" (the latter computed according to the balance in tokens and the
 # profiles cost per hour (if the cost per hour is 0, the balanceHours is set as float("inf"), python's infinity)
 # for profiles without a quota set, entries are not added
-# if the user doesn't have a balance defined, it defaults to 0.0 (thus call update_user_tokens before this to initialize/update balances)
-def get_profiles_by_balance(conn: sq3.Connection, profiles: List, user: str, is_admin: bool) -> List:
-    ensure_initialized(conn, profiles, user, is_admin) 
-    c = conn.cursor()
+# balances come from get_user_balances, so repeated calls for a user are mostly answered from the balance cache
+# profiles may be the raw profiles list or one already compiled with compile_policies (as may all the functions below)
+def get_profiles_by_balance(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, is_admin: bool) -> List:
+    policies: QuotaPolicies = compile_policies(profiles)
+    return profiles_with_balances(policies, get_user_balances(conn, policies, user, is_admin), is_admin)
+
+
+# the profiles list as get_profiles_by_balance returns it, for balances (keyed by profile slug) got some other way,
+# e.g. from the balance service (see balance_client)
+def profiles_with_balances(profiles: Union[List, QuotaPolicies], balances: Dict[str, float], is_admin: bool) -> List:
+    policies: QuotaPolicies = compile_policies(profiles)
 
     return_profiles: List = []
 
     profile: Dict
-    for profile in profiles:
+    for profile in policies.profiles:
         profile_slug: str = profile["slug"]
 
         if "quota" in profile:
-            min_to_spawn: float = profile["quota"].get("minBalanceToSpawn", 0.0)
-            cost_tokens_per_hour: float = profile["quota"].get("costTokensPerHour", 1.0)
-
-            new_tokens_per_day: float = profile["quota"].get("users", {}).get("newTokensPerDay", 0.0)
-            if is_admin:
-                new_tokens_per_day = profile["quota"].get("admins", {}).get("newTokensPerDay", 0.0)
-
-            max_balance: float = profile["quota"].get("users", {}).get("maxBalance", float("inf"))
-            if is_admin:
-                max_balance = profile["quota"].get("admins", {}).get("maxBalance", float("inf"))
-
-            is_disabled: bool = profile["quota"].get("users", {}).get("disabled", False)
-            if is_admin:
-                is_disabled: bool = profile["quota"].get("admins", {}).get("disabled", False)
-
-            c.execute("SELECT count FROM usertokens WHERE user='%s' AND profile_slug='%s';"%(user, profile_slug))
-            res: Optional[Tuple[float]] = c.fetchone()
-            
-            # this is just to shut mypy up - we ensured initialized above
-            balance: float = 0.0
-            if res:
-                balance = res[0]
-                
+            policy: QuotaPolicy = policies.get(profile_slug, is_admin)
+            min_to_spawn: float = policy.min_to_spawn
+            cost_tokens_per_hour: float = policy.cost
+            new_tokens_per_day: float = policy.rate
+            max_balance: float = policy.max_balance
+            is_disabled: bool = policy.disabled
+
+            balance: float = balances.get(profile_slug, 0.0)
+
             balance_hours: Union[float, str] = "Infinite"
             new_hours_per_day: float = 0.0
             min_to_spawn_hours: float = 0.0
@@ -90,165 +554,784 @@ def get_profiles_by_balance(conn: sq3.Connection, profiles: List, user: str, is_
     return return_profiles
 
 
-# returns token count; updating their count based on time elapsed since last update
-# if user is not defined (e.g. if this is the first time they've logged in, or the first time since the db was wiped...), 
-# then returns the initial token count defined in the tokens table
-def update_user_tokens(conn: sq3.Connection, profiles: List, user: str, is_admin: bool) -> None: 
-    ensure_initialized(conn, profiles, user, is_admin)
+# adds the tokens accumulated since last_add (whole seconds elapsed, at newTokensPerDay) to count, capped at maxBalance,
+# and moves last_add up to now; parameters are (rate, max_balance, now, profile_slug) followed by whatever the 
+# appended WHERE clause needs
+ACCRUE_SQL: str = """UPDATE usertokens
+                     SET count = MIN(count + ((?3 - last_add) / 3600.0) * ?1 / 24.0, ?2),
+                         last_add = ?3
+                     WHERE profile_slug = ?4"""
 
-    c = conn.cursor()
+# ACCRUE_SQL that also deducts a charge; parameters are (rate, max_balance, now, profile_slug, tokens, user)
+CHARGE_SQL: str = """UPDATE usertokens
+                     SET count = MIN(count + ((?3 - last_add) / 3600.0) * ?1 / 24.0, ?2) - ?5,
+                         last_add = ?3
+                     WHERE profile_slug = ?4 AND user = ?6;"""
 
-    profile: Dict
-    for profile in profiles:
-        profile_slug: str = profile["slug"]
-        sys.stderr.write("Checking profile " + profile_slug + "\n")
 
-        rate: float = 0.0
-        initial: float = float("inf")
-        max_count: float = float("inf")
-        active: bool = True
+# makes sure the user has a balance for each profile, initializing any that are missing
+# balances accrue on read (see accrued_balance), so there is nothing to write for the ones that exist; this used to
+# rewrite each of them with the tokens accrued since they were last updated
+# goes through the balance cache like get_user_balances (which it is), so that for a user whose rows are cached the
+# spawn hook's update_user_tokens and get_profiles_by_balance only read the balance_changes counter
+def update_user_tokens(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, is_admin: bool) -> None:
+    get_user_balances(conn, profiles, user, is_admin)
 
-        if "quota" in profile:
-            if is_admin:
-                rate = profile["quota"].get("admins", {}).get("newTokensPerDay", 0.0)
-                initial = profile["quota"].get("admins", {}).get("initialBalance", float("inf"))
-                max_count = profile["quota"].get("admins", {}).get("maxBalance", float("inf"))
-                active = profile["quota"].get("admins", {}).get("active", True)  # quotas default to active if not specifid
-            else:
-                rate = profile["quota"].get("users", {}).get("newTokensPerDay", 0.0)
-                initial = profile["quota"].get("users", {}).get("initialBalance", float("inf"))
-                max_count = profile["quota"].get("users", {}).get("maxBalance", float("inf"))
-                active = profile["quota"].get("users", {}).get("active", True)  # quotas default to active if not specifid
-
-        # if the quota isn't active, don't do anything
-        if not active:
-            continue
-         
-        nowtime: datetime.datetime = datetime.datetime.now()
-        nowtimestamp: str = nowtime.strftime(TIME_FMT)
-        
-        c.execute("SELECT count, last_add FROM usertokens WHERE user='%s' AND profile_slug='%s';"%(user, profile_slug))
-        count_lastadd: Optional[Tuple[float, str]] = c.fetchone()
-        
-        # again, just to shut up mypy - ran ensure_initialized above
-        balance: float = 0.0
-        lastadd: str = nowtimestamp
-        if count_lastadd:
-            balance = float(count_lastadd[0])
-            lastadd = count_lastadd[1]
-
-        since_last_duration: datetime.timedelta = nowtime - datetime.datetime.strptime(lastadd, TIME_FMT)
-        since_last_seconds: int = since_last_duration.days * 24 * 60 * 60 + since_last_duration.seconds
-        since_last_hours: float = since_last_seconds / (60 * 60)
-        
-        new_accumulated: float = since_last_hours * rate / 24.0
-        balance = min(balance + new_accumulated, max_count)
-        
-        c.execute("UPDATE usertokens SET count='%s', last_add='%s' WHERE user='%s' AND profile_slug = '%s'"%(balance, nowtimestamp, user, profile_slug))
-      
-
-def get_initial(profiles_list: List, profile_slug: str, is_admin: bool) -> float:
-    profile: Dict
-    initial: float = float("inf")
-    for profile in profiles_list:
-        if "quota" in profile and profile["slug"] == profile_slug:
-            if is_admin:
-                initial = profile["quota"].get("admins", {}).get("initialBalance", float("inf"))
-            else:
-                initial = profile["quota"].get("users", {}).get("initialBalance", float("inf"))
-    return initial
 
+def get_initial(profiles_list: Union[List, QuotaPolicies], profile_slug: str, is_admin: bool) -> float:
+    return compile_policies(profiles_list).get(profile_slug, is_admin).initial
 
-def ensure_initialized(conn: sq3.Connection, profiles: List, user: str, is_admin: bool) -> None:
-    profile: Dict
 
-    c = conn.cursor()
-
-    for profile in profiles:
-        profile_slug = profile["slug"]
-        initial: float = get_initial(profiles, profile_slug, is_admin)
+# inserts the initial balance for each of the user's profiles that doesn't have one yet (see _insert_initial_balances),
+# and records the user's role on their rows if it has changed (bringing the balances up to date under the policies of
+# the role they had until now first)
+def ensure_initialized(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, is_admin: bool) -> None:
+    initialize_balances(conn, profiles, [(user, is_admin)])
 
-        c.execute("SELECT count, last_add FROM usertokens WHERE user='%s' AND profile_slug='%s';"%(user, profile_slug))
-        count_lastadd: Optional[Tuple[float, str]] = c.fetchone()
 
-        if not count_lastadd:
-            nowtime: datetime.datetime = datetime.datetime.now()
-            nowtimestamp: str = nowtime.strftime(TIME_FMT)
-            c.execute("INSERT INTO usertokens (user, profile_slug, count, last_add) VALUES ('%s', '%s', '%s', '%s')"%(user, profile_slug, initial, nowtimestamp))
+# ensure_initialized for many users, (user, is_admin) pairs, at once
+def initialize_balances(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], users: Sequence[Tuple[str, bool]]) -> None:
+    _load_balance_rows(conn.cursor(), compile_policies(profiles), users)
 
 
-def get_balance(conn: sq3.Connection, profiles: List, user: str, profile_slug: str, is_admin: bool) -> float: 
-    ensure_initialized(conn, profiles, user, is_admin)
+def get_balance(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, profile_slug: str, is_admin: bool) -> float: 
+    policies: QuotaPolicies = compile_policies(profiles)
+    ensure_initialized(conn, policies, user, is_admin)
 
     c = conn.cursor()
     
-    c.execute("SELECT count, last_add FROM usertokens WHERE user='%s' AND profile_slug='%s';"%(user, profile_slug))
-    count_lastadd: Optional[Tuple[float, str]] = c.fetchone()
+    c.execute("SELECT count, last_add FROM usertokens WHERE user = ? AND profile_slug = ?;", (user, profile_slug))
+    count_lastadd: Optional[Tuple[float, int]] = c.fetchone()
 
     balance: float = 0.0
     if count_lastadd:
-        balance = count_lastadd[0]
+        balance = accrued_balance(float(count_lastadd[0]), count_lastadd[1], policies.get(profile_slug, is_admin), now_epoch())
     
     return balance
 
-def charge_tokens(conn: sq3.Connection, profiles: List, user: str, profile_slug: str, hours: float, is_admin: bool) -> None:
-    ensure_initialized(conn, profiles, user, is_admin)
 
+# returns the number of users whose balance is below zero, keyed by profile slug (profiles without any are left out)
+# balances are accrued under the policies last recorded by sync_policies
+def count_negative_balances(conn: sq3.Connection) -> Dict[str, int]:
     c = conn.cursor()
+    c.execute('''SELECT t.profile_slug, COUNT(*) FROM usertokens AS t
+                 LEFT JOIN quota_policies AS p ON p.profile_slug = t.profile_slug AND p.is_admin = t.is_admin
+                 WHERE MIN(t.count + ((?1 - t.last_add) / 3600.0) * COALESCE(p.rate, 0.0) / 24.0, COALESCE(p.max_balance, 9e999)) < 0
+                 GROUP BY t.profile_slug;''', (now_epoch(),))
+    return {profile_slug: count for profile_slug, count in c.fetchall()}
 
-    cost_tokens_per_hour: float = 1.0
-    profile: Dict
-    for profile in profiles:
-        if "quota" in profile and profile["slug"] == profile_slug:
-            cost_tokens_per_hour = profile["quota"].get("costTokensPerHour", 1.0)
-    
-    tokens_charged: float = hours * cost_tokens_per_hour
-    new_balance: float = get_balance(conn, profiles, user, profile_slug, is_admin) - tokens_charged
-    c.execute("UPDATE usertokens SET count='%s' WHERE user='%s' AND profile_slug='%s';"%(new_balance, user, profile_slug)) 
-   
 
-def log_usage(conn: sq3.Connection, profiles: List, user: str, profile_slug: str, hours: float, is_admin: bool) -> None:
+# records the accrual parameters of each (profile, role) policy in the quota_policies table, so that a change to them
+# only applies from the time it is made: the balances under a policy whose rate or maxBalance has changed (or that
+# has been removed from the profiles list) are first brought up to date under the parameters recorded before
+# returns the (profile_slug, is_admin) policies whose parameters changed; nothing is committed here
+def sync_policies(conn: sq3.Connection, profiles: Union[List, QuotaPolicies]) -> List[Tuple[str, bool]]:
+    policies: QuotaPolicies = compile_policies(profiles)
+
     c = conn.cursor()
+    c.execute("SELECT profile_slug, is_admin, rate, max_balance FROM quota_policies;")
+    recorded: Dict[Tuple[str, bool], Tuple[float, float]] = {
+        (profile_slug, bool(is_admin)): (rate, max_balance) for profile_slug, is_admin, rate, max_balance in c.fetchall()
+    }
 
-    timestamp: str = datetime.datetime.now().strftime(TIME_FMT)
-    
-    cost_tokens_per_hour: float = 1.0
-    profile: Dict
-    for profile in profiles:
-        if "quota" in profile and profile["slug"] == profile_slug:
-            cost_tokens_per_hour = profile["quota"].get("costTokensPerHour", 1.0)
-    
-    tokens: float = hours * cost_tokens_per_hour
-    cmd: str = "INSERT INTO usage (user, date, profile_slug, hours, tokens) VALUES ('%s', '%s', '%s', '%s', '%s');"%(user, timestamp, profile_slug, hours, tokens)
-    c.execute(cmd)
+    current: Dict[Tuple[str, bool], Tuple[float, float]] = {}
+    is_admin: bool
+    for is_admin in (False, True):
+        policy: QuotaPolicy
+        for policy in policies.for_role(is_admin):
+            current[(policy.slug, is_admin)] = accrual_params(policy)
+    # balances under removed policies stop accruing until they come back
+    key: Tuple[str, bool]
+    for key in recorded:
+        current.setdefault(key, (0.0, float("inf")))
+
+    changed: List[Tuple[str, bool]] = [key for key, params in current.items() if key in recorded and recorded[key] != params]
+    new: List[Tuple[str, bool]] = [key for key in current if key not in recorded]
+    if not changed and not new:
+        return changed
+
+    nowtimestamp: int = now_epoch()
+    profile_slug: str
+    for profile_slug, is_admin in changed:
+        rate, max_balance = recorded[(profile_slug, is_admin)]
+        log.info("Quota policy for profile %s (%s) changed", profile_slug, "admins" if is_admin else "users",
+                 extra={"event": "policy_changed", "profile_slug": profile_slug, "is_admin": is_admin})
+        c.execute(ACCRUE_SQL + " AND is_admin = ?;", (rate, max_balance, nowtimestamp, profile_slug, is_admin))
+
+    c.executemany("INSERT OR REPLACE INTO quota_policies (profile_slug, is_admin, rate, max_balance) VALUES (?, ?, ?, ?);",
+                  [key + current[key] for key in changed + new])
+    if changed:
+        _count_balance_change(c)
+    return changed
+
+
+# records profiles' policies (see sync_policies) in a transaction of its own, e.g. for profiles reloaded while the
+# culler runs; returns the (profile_slug, is_admin) policies that changed
+def update_policies(conn: sq3.Connection, profiles: Union[List, QuotaPolicies]) -> List[Tuple[str, bool]]:
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        changed: List[Tuple[str, bool]] = sync_policies(conn, profiles)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    return changed
+
+
+def charge_tokens(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, profile_slug: str, hours: float, is_admin: bool) -> None:
+    policies: QuotaPolicies = compile_policies(profiles)
+    ensure_initialized(conn, policies, user, is_admin)
+
+    c = conn.cursor()
+
+    policy: QuotaPolicy = policies.get(profile_slug, is_admin)
+    tokens_charged: float = hours * policy.cost
+    c.execute(CHARGE_SQL, accrual_params(policy) + (now_epoch(), profile_slug, tokens_charged, user))
+    _count_balance_change(c)
    
 
-def create_db(filename: str) -> None:
-    conn = sq3.connect(filename)
+def log_usage(conn: sq3.Connection, profiles: Union[List, QuotaPolicies], user: str, profile_slug: str, hours: float, is_admin: bool) -> None:
+    c = conn.cursor()
+
+    timestamp: int = now_epoch()
     
+    tokens: float = hours * compile_policies(profiles).get(profile_slug, is_admin).cost
+    c.execute("INSERT INTO usage (user, date, profile_slug, hours, tokens) VALUES (?, ?, ?, ?, ?);", (user, timestamp, profile_slug, hours, tokens))
+    _add_to_rollups(c, [(user, profile_slug, timestamp, hours, tokens)])
+
+
+# adds usage rows, (user, profile_slug, date, hours, tokens) tuples, to the rollup tables; anything that inserts into usage
+# should call this in the same transaction
+# (INSERT OR IGNORE then UPDATE rather than an ON CONFLICT upsert, which older sqlite versions don't have)
+def _add_to_rollups(c: sq3.Cursor, rows: List[Tuple[str, str, int, float, float]]) -> None:
+    period_length: int
+    table: str
+    for period_length, table in ROLLUP_TABLES.items():
+        totals: Dict[Tuple[str, str, int], List[float]] = {}
+        for user, profile_slug, date, hours, tokens in rows:
+            total: List[float] = totals.setdefault((user, profile_slug, date - date % period_length), [0.0, 0.0])
+            total[0] += hours
+            total[1] += tokens
+
+        c.executemany("INSERT OR IGNORE INTO " + table + " (user, profile_slug, period, hours, tokens) VALUES (?, ?, ?, 0.0, 0.0);", 
+                      list(totals))
+        c.executemany("UPDATE " + table + " SET hours = hours + ?, tokens = tokens + ? WHERE user = ? AND profile_slug = ? AND period = ?;",
+                      [(hours, tokens, user, profile_slug, period) for (user, profile_slug, period), (hours, tokens) in totals.items()])
+
+
+# returns (group columns..., hours, tokens) totals of the usage logged in [start, end) (unix times), grouped by the
+# columns named in group_by ("user" and/or "profile_slug"; with neither there's a single overall row) and optionally
+# restricted to one user and/or profile
+# ranges that line up with days or hours are answered from the rollup tables, others from the usage table itself
+# (which only holds usage that hasn't been archived yet, see jhprofilequota/archive.py)
+def usage_totals(conn: sq3.Connection, start: int, end: int, group_by: Sequence[str] = ("user",),
+                 user: Optional[str] = None, profile_slug: Optional[str] = None) -> List[Tuple]:
+    table: Optional[str] = rollup_table_for(start, end)
+    if table is None:
+        return query_usage_totals(conn, "usage", "date", start, end, group_by, user, profile_slug)
+    return query_usage_totals(conn, table, "period", start, end, group_by, user, profile_slug)
+
+
+# the coarsest rollup table that covers [start, end) exactly, if any
+def rollup_table_for(start: int, end: int) -> Optional[str]:
+    period_length: int
+    for period_length in sorted(ROLLUP_TABLES, reverse = True):
+        if start % period_length == 0 and end % period_length == 0:
+            return ROLLUP_TABLES[period_length]
+    return None
+
+
+# usage_totals against a given table, with date_column holding the time of each row
+def query_usage_totals(conn: sq3.Connection, table: str, date_column: str, start: int, end: int, group_by: Sequence[str],
+                       user: Optional[str] = None, profile_slug: Optional[str] = None) -> List[Tuple]:
+    column: str
+    for column in group_by:
+        if column not in ("user", "profile_slug"):
+            raise ValueError("can't group usage by %r" % column)
+
+    conditions: List[str] = [date_column + " >= ?", date_column + " < ?"]
+    params: List = [start, end]
+    if user is not None:
+        conditions.append("user = ?")
+        params.append(user)
+    if profile_slug is not None:
+        conditions.append("profile_slug = ?")
+        params.append(profile_slug)
+
+    columns: str = "".join(column + ", " for column in group_by)
+    query: str = "SELECT " + columns + "SUM(hours), SUM(tokens) FROM " + table + " WHERE " + " AND ".join(conditions)
+    if group_by:
+        query += " GROUP BY " + ", ".join(group_by) + " ORDER BY " + ", ".join(group_by)
+
     c = conn.cursor()
+    c.execute(query + ";", params)
+    return [row for row in c.fetchall() if row[-1] is not None]
 
-    c.execute('''CREATE TABLE IF NOT EXISTS usage (
-              user TEXT NOT NULL,
-              date TEXT NOT NULL,
-              profile_slug TEXT NOT NULL,
-              hours TEXT NOT NULL,
-              tokens TEXT NOT NULL
-              );
-              ''')
 
-    c.execute('''CREATE TABLE IF NOT EXISTS usertokens (
-              user TEXT NOT NULL,
-              profile_slug TEXT NOT NULL,
-              count REAL NOT NULL,
-              last_add TEXT NOT NULL
-              );''')
+# a cull cycle's charges are staged in a temp table as they come in and applied all at once at the end of the cycle
+# by apply_staged_charges; temp tables are private to the connection, so staging doesn't lock the db for anyone else
+def _create_staging(c: sq3.Cursor) -> None:
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS pending_charges (
+                 user TEXT NOT NULL,
+                 is_admin INTEGER NOT NULL,
+                 profile_slug TEXT NOT NULL,
+                 date INTEGER NOT NULL,
+                 hours REAL NOT NULL,
+                 tokens REAL NOT NULL
+                 );''')
+    c.execute("CREATE INDEX IF NOT EXISTS temp.idx_pending_charges_user ON pending_charges(user, profile_slug);")
+    c.execute('''CREATE TEMP TABLE IF NOT EXISTS pending_servers (
+                 user TEXT NOT NULL,
+                 is_admin INTEGER NOT NULL,
+                 server_name TEXT NOT NULL,
+                 profile_slug TEXT NOT NULL,
+                 started INTEGER NOT NULL,
+                 since INTEGER NOT NULL,
+                 seen INTEGER NOT NULL,
+                 new INTEGER NOT NULL
+                 );''')
 
 
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_usertokens_user ON usertokens(user);''')
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_usage_user ON usage(user);''')
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_usage_profile_slug ON usage(profile_slug);''')
-    c.execute('''CREATE INDEX IF NOT EXISTS idx_usertokens_profile_slug ON usertokens(profile_slug);''')
+# stages sightings of running servers, (user, is_admin, server_name, profile_slug, started, since, seen, new) tuples, for
+# the next apply_staged_charges on this connection, which charges each server for the time it has run since it was last 
+# charged (see _charge_server_runtimes); started identifies the server's session (the unix time it started, 0 if 
+# unknown), since is the time to charge from if the session hasn't been charged before (normally started), and seen
+# the time the server was seen running
+# new is False for servers known to have been charged before in the same session, under the same profile and role,
+# whose users' balances don't need initializing (beyond the one being charged)
+def stage_server_runtimes(conn: sq3.Connection, servers: List[Tuple[str, bool, str, str, int, int, int, bool]]) -> None:
+    c = conn.cursor()
+    _create_staging(c)
 
+    c.executemany('''INSERT INTO temp.pending_servers (user, is_admin, server_name, profile_slug, started, since, seen, new) 
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?);''', servers)
     conn.commit()
-    conn.close()
+
+
+# throws away whatever is staged on this connection, e.g. by a cycle that was cancelled before applying it
+def discard_staged_charges(conn: sq3.Connection) -> None:
+    c = conn.cursor()
+    _create_staging(c)
+    c.execute("DELETE FROM temp.pending_charges;")
+    c.execute("DELETE FROM temp.pending_servers;")
+    conn.commit()
+
+
+# how long the charging watermark of a server that is no longer seen running is kept; watermarks aren't dropped as soon
+# as a server goes missing from a listing, since paging through users as others stop can skip a running server for a
+# cycle, and it would be charged again from its start when it shows up in the next; a restarted server has a new
+# started, so a stale watermark never applies to it
+WATERMARK_RETENTION: int = 7 * DAY
+
+
+# turns the staged server sightings into charges for the time each server has run since its watermark (the time it was
+# last charged up to, kept per (user, server_name) in server_watermarks along with the session it belongs to), and moves
+# the watermarks up; servers in a session without a watermark are charged from since, but not from before the db started
+# charging by runtime (runtime_charging_since in quota_meta), so servers already running when it did aren't charged twice
+# watermarks of servers that weren't seen for WATERMARK_RETENTION are dropped
+def _charge_server_runtimes(c: sq3.Cursor, policies: QuotaPolicies) -> None:
+    c.execute("SELECT value FROM quota_meta WHERE name = 'runtime_charging_since';")
+    charging_since: int = c.fetchone()[0]
+
+    c.execute('''SELECT w.user, w.server_name, w.started, w.charged_until FROM server_watermarks AS w
+                 JOIN (SELECT DISTINCT user, server_name FROM temp.pending_servers) AS p
+                 ON w.user = p.user AND w.server_name = p.server_name;''')
+    watermarks: Dict[Tuple[str, str], Tuple[int, int]] = {(user, server_name): (started, charged_until)
+                                                          for user, server_name, started, charged_until in c.fetchall()}
+
+    charges: List[Tuple[str, int, str, int, float, float]] = []
+    c.execute('''SELECT user, is_admin, server_name, profile_slug, started, since, seen FROM temp.pending_servers
+                 ORDER BY user, server_name, seen;''')
+    for user, is_admin, server_name, profile_slug, started, since, seen in c.fetchall():
+        watermark: Optional[Tuple[int, int]] = watermarks.get((user, server_name), None)
+        charge_from: int
+        if watermark is not None and watermark[0] == started:
+            charge_from = watermark[1]
+        else:
+            charge_from = max(since, charging_since)
+
+        if seen > charge_from:
+            hours: float = (seen - charge_from) / 3600.0
+            charges.append((user, is_admin, profile_slug, seen, hours, hours * policies.get(profile_slug, bool(is_admin)).cost))
+        watermarks[(user, server_name)] = (started, max(seen, charge_from))
+
+    c.executemany("INSERT INTO temp.pending_charges (user, is_admin, profile_slug, date, hours, tokens) VALUES (?, ?, ?, ?, ?, ?);",
+                  charges)
+    c.executemany("INSERT OR REPLACE INTO server_watermarks (user, server_name, started, charged_until) VALUES (?, ?, ?, ?);",
+                  [key + watermark for key, watermark in watermarks.items()])
+    c.execute("DELETE FROM server_watermarks WHERE charged_until < ?;", (now_epoch() - WATERMARK_RETENTION,))
+
+
+# applies the charges staged on this connection: policy changes are recorded (see sync_policies), the charged users'
+# balances are initialized where needed, staged server sightings are turned into charges, then every charge is logged to the usage table and deducted from usertokens 
+# with bulk statements; only the charged balances are written
+# everything happens inside a single transaction that is committed at the end (and rolled back on error), so a crash 
+# part-way through leaves the db as it was before the cycle; after an error the charges are still staged, and the
+# culler discards them (see discard_staged_charges) rather than retrying: the watermarks haven't moved, so the next
+# cycle charges the servers it sees for the time they have run since, including this cycle's
+# returns the resulting balances keyed by (user, profile_slug), for every balance charged or with a server sighted;
+# if totals is given, the {profile_slug: [charges, hours, tokens]} charged are added to it
+def apply_staged_charges(conn: sq3.Connection, profiles: Union[List, QuotaPolicies],
+                         totals: Optional[Dict[str, List[float]]] = None) -> Dict[Tuple[str, str], float]:
+    policies: QuotaPolicies = compile_policies(profiles)
+
+    balances: Dict[Tuple[str, str], float] = {}
+
+    c = conn.cursor()
+    _create_staging(c)
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        sync_policies(conn, policies)
+
+        c.execute('''SELECT DISTINCT user, is_admin FROM temp.pending_charges 
+                     UNION SELECT DISTINCT user, is_admin FROM temp.pending_servers WHERE new;''')
+        users: List[Tuple[str, int]] = c.fetchall()
+
+        initialize_balances(conn, policies, [(user, bool(is_admin)) for user, is_admin in users])
+
+        # the balances of continuing servers only need to exist (they may have been removed since)
+        c.execute("SELECT DISTINCT user, is_admin, profile_slug FROM temp.pending_servers WHERE NOT new;")
+        nowtimestamp: int = now_epoch()
+        c.executemany("INSERT OR IGNORE INTO usertokens (user, profile_slug, count, last_add, is_admin) VALUES (?, ?, ?, ?, ?);",
+                      [(user, profile_slug, policies.get(profile_slug, bool(is_admin)).initial, nowtimestamp, is_admin)
+                       for user, is_admin, profile_slug in c.fetchall()])
+
+        _charge_server_runtimes(c, policies)
+
+        c.execute('''INSERT INTO usage (user, date, profile_slug, hours, tokens)
+                     SELECT user, date, profile_slug, hours, tokens FROM temp.pending_charges ORDER BY rowid;''')
+        c.execute('''SELECT user, profile_slug, date - date % ?, SUM(hours), SUM(tokens) FROM temp.pending_charges 
+                     GROUP BY user, profile_slug, date - date % ?;''', (HOUR, HOUR))
+        _add_to_rollups(c, c.fetchall())
+        # a user may have several named servers running the same profile
+        c.execute("SELECT user, MAX(is_admin), profile_slug, SUM(tokens) FROM temp.pending_charges GROUP BY user, profile_slug;")
+        c.executemany(CHARGE_SQL, [accrual_params(policies.get(profile_slug, bool(is_admin))) + (nowtimestamp, profile_slug, tokens, user)
+                                   for user, is_admin, profile_slug, tokens in c.fetchall()])
+        _count_balance_change(c)
+
+        if totals is not None:
+            c.execute("SELECT profile_slug, COUNT(*), SUM(hours), SUM(tokens) FROM temp.pending_charges GROUP BY profile_slug;")
+            for profile_slug, charged, hours, tokens in c.fetchall():
+                total: List[float] = totals.setdefault(profile_slug, [0, 0.0, 0.0])
+                total[0] += charged
+                total[1] += hours
+                total[2] += tokens
+
+        c.execute('''SELECT t.user, t.profile_slug, t.count, t.last_add, t.is_admin
+                     FROM (SELECT user, profile_slug FROM temp.pending_charges 
+                           UNION SELECT user, profile_slug FROM temp.pending_servers) AS p
+                     JOIN usertokens AS t ON t.user = p.user AND t.profile_slug = p.profile_slug;''')
+        profile_slug: str
+        count: float
+        last_add: int
+        for user, profile_slug, count, last_add, is_admin in c.fetchall():
+            balances[(user, profile_slug)] = accrued_balance(count, last_add, policies.get(profile_slug, bool(is_admin)), nowtimestamp)
+
+        c.execute("DELETE FROM temp.pending_charges;")
+        c.execute("DELETE FROM temp.pending_servers;")
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+    return balances
+
+
+# bulk balance changes (grants, resets, imports) are applied this many rows per transaction, so that other writers (the
+# hub setting up a balance on the spawn page, the culler) never wait on more than one chunk
+BULK_CHUNK_SIZE: int = 1000
+
+# the rate and maxBalance a usertokens row accrues at, as last recorded by sync_policies; the rate is NULL for policies
+# that haven't been recorded (e.g. before the culler first runs), whose accrual is unknown, and there is no maxBalance
+POLICY_RATE_SQL: str = '''(SELECT p.rate FROM quota_policies AS p
+                           WHERE p.profile_slug = usertokens.profile_slug AND p.is_admin = usertokens.is_admin)'''
+POLICY_MAX_SQL: str = '''COALESCE((SELECT p.max_balance FROM quota_policies AS p
+                                   WHERE p.profile_slug = usertokens.profile_slug AND p.is_admin = usertokens.is_admin), 9e999)'''
+
+# adds tokens (which may be negative) to the accrued balance, capped at maxBalance (as it would be on read anyway);
+# balances under a policy that hasn't been recorded get the tokens added with last_add left alone, so that what they
+# have accrued since isn't lost; parameters are (now, tokens, profile_slug, user)
+GRANT_SQL: str = ('''UPDATE usertokens
+                     SET count = MIN(count + COALESCE(((?1 - last_add) / 3600.0) * ''' + POLICY_RATE_SQL + ''' / 24.0, 0.0) + ?2,
+                                     ''' + POLICY_MAX_SQL + '''),
+                         last_add = CASE WHEN ''' + POLICY_RATE_SQL + ''' IS NULL THEN last_add ELSE ?1 END
+                     WHERE profile_slug = ?3 AND user = ?4;''')
+
+# sets the balance, to one value for users and another for admins; parameters are (now, tokens, profile_slug, user,
+# admin_tokens)
+SET_BALANCE_SQL: str = '''UPDATE usertokens
+                          SET count = CASE WHEN is_admin THEN ?5 ELSE ?2 END,
+                              last_add = ?1
+                          WHERE profile_slug = ?3 AND user = ?4;'''
+
+# sets the balance to maxBalance, leaving those without one alone; parameters are (now, profile_slug, user)
+FILL_BALANCE_SQL: str = ('''UPDATE usertokens
+                            SET count = ''' + POLICY_MAX_SQL + ''',
+                                last_add = ?1
+                            WHERE profile_slug = ?2 AND user = ?3 AND ''' + POLICY_MAX_SQL + ''' < 9e999;''')
+
+
+# runs sql with executemany over rows (any iterable, consumed as it goes) in transactions of chunk_size rows, counting
+# each as a balance change; returns the number of rows changed
+def _executemany_chunked(conn: sq3.Connection, sql: str, rows: Iterable[Tuple], chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    c = conn.cursor()
+    changed: int = 0
+    row_iter: Iterator[Tuple] = iter(rows)
+    while True:
+        chunk: List[Tuple] = list(itertools.islice(row_iter, chunk_size))
+        if not chunk:
+            return changed
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.executemany(sql, chunk)
+            changed += c.rowcount
+            _count_balance_change(c)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+# the users with a balance for the profile, or those of users that have one
+def _users_with_balances(conn: sq3.Connection, profile_slug: str, users: Optional[List[str]]) -> List[str]:
+    c = conn.cursor()
+    c.execute("SELECT user FROM usertokens WHERE profile_slug = ?;", (profile_slug,))
+    existing: List[str] = [user for (user,) in c.fetchall()]
+    if users is None:
+        return existing
+    existing_set = set(existing)
+    return [user for user in users if user in existing_set]
+
+
+# with profiles, records their policies (see sync_policies) and gives the users that don't have a balance for the
+# profile yet their initial one, as the spawn page would (as users; ensure_initialized sorts out admins' when they
+# next spawn); returns users as a list without duplicates
+def _prepare_bulk(conn: sq3.Connection, profiles: Optional[Union[List, QuotaPolicies]], profile_slug: str,
+                  users: Optional[Iterable[str]], chunk_size: int) -> Optional[List[str]]:
+    user_list: Optional[List[str]] = list(dict.fromkeys(users)) if users is not None else None
+    if profiles is None:
+        return user_list
+    policies: QuotaPolicies = compile_policies(profiles)
+    update_policies(conn, policies)
+
+    if user_list is not None and profile_slug in policies.quota_slugs:
+        initial: float = policies.get(profile_slug, False).initial
+        nowtimestamp: int = now_epoch()
+        _executemany_chunked(conn, "INSERT OR IGNORE INTO usertokens (user, profile_slug, count, last_add, is_admin) VALUES (?, ?, ?, ?, 0);",
+                             ((user, profile_slug, initial, nowtimestamp) for user in user_list), chunk_size)
+    return user_list
+
+
+# adds tokens (negative to take them away) to the balances of users (all that have one if None) for a profile, capped
+# at the profile's maxBalance; returns the number of balances changed
+# balances are brought up to date under the policies recorded by sync_policies; with profiles, those are recorded
+# first, and listed users without a balance get their initial one before the grant
+def grant_tokens(conn: sq3.Connection, profile_slug: str, tokens: float, users: Optional[Iterable[str]] = None,
+                 profiles: Optional[Union[List, QuotaPolicies]] = None, chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    user_list: Optional[List[str]] = _prepare_bulk(conn, profiles, profile_slug, users, chunk_size)
+    nowtimestamp: int = now_epoch()
+    return _executemany_chunked(conn, GRANT_SQL, ((nowtimestamp, tokens, profile_slug, user)
+                                                  for user in _users_with_balances(conn, profile_slug, user_list)), chunk_size)
+
+
+# sets the balances of users (all that have one if None) for a profile to tokens, or if tokens is None to the profile's
+# initial balance for their role under profiles; returns the number of balances changed
+def reset_balances(conn: sq3.Connection, profile_slug: str, tokens: Optional[float] = None, users: Optional[Iterable[str]] = None,
+                   profiles: Optional[Union[List, QuotaPolicies]] = None, chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    user_tokens: float
+    admin_tokens: float
+    if tokens is None:
+        if profiles is None:
+            raise ValueError("resetting balances to their initial value needs the profiles list")
+        policies: QuotaPolicies = compile_policies(profiles)
+        user_tokens, admin_tokens = policies.get(profile_slug, False).initial, policies.get(profile_slug, True).initial
+    else:
+        user_tokens, admin_tokens = tokens, tokens
+    user_list: Optional[List[str]] = _prepare_bulk(conn, profiles, profile_slug, users, chunk_size)
+    nowtimestamp: int = now_epoch()
+    return _executemany_chunked(conn, SET_BALANCE_SQL, ((nowtimestamp, user_tokens, profile_slug, user, admin_tokens)
+                                                        for user in _users_with_balances(conn, profile_slug, user_list)), chunk_size)
+
+
+# tops the balances of users (all that have one if None) for a profile up to its maxBalance; balances under policies
+# without one are left alone; returns the number of balances changed
+def fill_balances(conn: sq3.Connection, profile_slug: str, users: Optional[Iterable[str]] = None,
+                  profiles: Optional[Union[List, QuotaPolicies]] = None, chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    user_list: Optional[List[str]] = _prepare_bulk(conn, profiles, profile_slug, users, chunk_size)
+    nowtimestamp: int = now_epoch()
+    return _executemany_chunked(conn, FILL_BALANCE_SQL, ((nowtimestamp, profile_slug, user)
+                                                         for user in _users_with_balances(conn, profile_slug, user_list)), chunk_size)
+
+
+# yields (user, profile_slug, is_admin, count, last_add, balance) for every usertokens row (or those of one profile),
+# ordered by user, as the query produces them; balance is the accrued balance as of now, or None for rows under a
+# policy that hasn't been recorded (see sync_policies)
+# in WAL mode the read doesn't hold up writers, however long the rows take to consume
+def iter_balances(conn: sq3.Connection, profile_slug: Optional[str] = None) -> Iterator[Tuple[str, str, bool, float, int, Optional[float]]]:
+    c = conn.cursor()
+    c.execute('''SELECT user, profile_slug, is_admin, count, last_add,
+                        MIN(count + ((?1 - last_add) / 3600.0) * ''' + POLICY_RATE_SQL + ''' / 24.0, ''' + POLICY_MAX_SQL + ''')
+                 FROM usertokens WHERE ?2 IS NULL OR profile_slug = ?2
+                 ORDER BY user, profile_slug;''', (now_epoch(), profile_slug))
+    for user, slug, is_admin, count, last_add, balance in c:
+        yield (user, slug, bool(is_admin), count, last_add, balance)
+
+
+# writes (user, profile_slug, is_admin, count, last_add) rows (any iterable, e.g. a generator reading a file) into
+# usertokens, replacing the balances that exist; returns the number of rows written
+def import_balances(conn: sq3.Connection, rows: Iterable[Tuple[str, str, bool, float, int]], chunk_size: int = BULK_CHUNK_SIZE) -> int:
+    return _executemany_chunked(conn, "INSERT OR REPLACE INTO usertokens (user, profile_slug, is_admin, count, last_add) VALUES (?, ?, ?, ?, ?);",
+                                rows, chunk_size)
+
+
+# the layout of each of the ROLLUP_TABLES (substituted for %s); rows are keyed by user first, and the indexes cover
+# per-profile and all-user reports over a range of periods
+ROLLUP_SCHEMA_SQL: List[str] = [
+    '''CREATE TABLE IF NOT EXISTS %s (
+       user TEXT NOT NULL,
+       profile_slug TEXT NOT NULL,
+       period INTEGER NOT NULL,
+       hours REAL NOT NULL,
+       tokens REAL NOT NULL,
+       PRIMARY KEY (user, profile_slug, period)
+       ) WITHOUT ROWID;''',
+    '''CREATE INDEX IF NOT EXISTS idx_%s_profile_slug_period ON %s(profile_slug, period, user, hours, tokens);''',
+    '''CREATE INDEX IF NOT EXISTS idx_%s_period ON %s(period, user, profile_slug, hours, tokens);''',
+]
+
+
+# the server_watermarks and quota_meta tables, added in schema version 8
+SERVER_WATERMARKS_SQL: List[str] = [
+    '''CREATE TABLE IF NOT EXISTS server_watermarks (
+       user TEXT NOT NULL,
+       server_name TEXT NOT NULL,
+       started INTEGER NOT NULL,
+       charged_until INTEGER NOT NULL,
+       PRIMARY KEY (user, server_name)
+       ) WITHOUT ROWID;''',
+    '''CREATE TABLE IF NOT EXISTS quota_meta (
+       name TEXT NOT NULL PRIMARY KEY,
+       value
+       );''',
+    '''INSERT OR IGNORE INTO quota_meta (name, value) VALUES ('runtime_charging_since', CAST(strftime('%s', 'now') AS INTEGER));''',
+]
+
+
+# the db layout for SCHEMA_VERSION
+# usertokens is keyed (and clustered) by (user, profile_slug), and records whether the user was last seen as an admin
+# (so that balances can be accrued under the right policy for users the culler doesn't see); the usage indexes lead
+# with (user, date) and (profile_slug, date) and carry the remaining columns so that per-user and per-profile reports
+# over a date range can be answered from the index alone; usage_archives records the months of usage that have been
+# moved out to archive files (see jhprofilequota/archive.py), keyed by the unix time the month starts at;
+# balance_changes holds a single counter bumped by every change to balances other than accrual (see BalanceCache);
+# quota_policies records the parameters balances were last accrued under (see sync_policies); server_watermarks the
+# time each running server has been charged up to (see _charge_server_runtimes); quota_meta holds named values, like
+# the time the db started charging servers by runtime
+SCHEMA_SQL: List[str] = [
+    '''CREATE TABLE IF NOT EXISTS usage (
+       user TEXT NOT NULL,
+       date INTEGER NOT NULL,
+       profile_slug TEXT NOT NULL,
+       hours REAL NOT NULL,
+       tokens REAL NOT NULL
+       );''',
+    '''CREATE TABLE IF NOT EXISTS usertokens (
+       user TEXT NOT NULL,
+       profile_slug TEXT NOT NULL,
+       count REAL NOT NULL,
+       last_add INTEGER NOT NULL,
+       is_admin INTEGER NOT NULL DEFAULT 0,
+       PRIMARY KEY (user, profile_slug)
+       ) WITHOUT ROWID;''',
+    '''CREATE INDEX IF NOT EXISTS idx_usertokens_profile_slug ON usertokens(profile_slug);''',
+    '''CREATE INDEX IF NOT EXISTS idx_usage_user_date ON usage(user, date, profile_slug, hours, tokens);''',
+    '''CREATE INDEX IF NOT EXISTS idx_usage_profile_slug_date ON usage(profile_slug, date, user, hours, tokens);''',
+    '''CREATE TABLE IF NOT EXISTS usage_archives (
+       month INTEGER PRIMARY KEY,
+       filename TEXT NOT NULL,
+       rows INTEGER NOT NULL,
+       archived INTEGER NOT NULL
+       );''',
+    '''CREATE TABLE IF NOT EXISTS balance_changes (
+       id INTEGER PRIMARY KEY CHECK (id = 0),
+       counter INTEGER NOT NULL
+       );''',
+    '''INSERT OR IGNORE INTO balance_changes (id, counter) VALUES (0, 0);''',
+    '''CREATE TABLE IF NOT EXISTS quota_policies (
+       profile_slug TEXT NOT NULL,
+       is_admin INTEGER NOT NULL,
+       rate REAL NOT NULL,
+       max_balance REAL NOT NULL,
+       PRIMARY KEY (profile_slug, is_admin)
+       ) WITHOUT ROWID;''',
+] + SERVER_WATERMARKS_SQL + [statement.replace("%s", table) for table in ROLLUP_TABLES.values() for statement in ROLLUP_SCHEMA_SQL]
+
+
+# returns the schema version of the db: the user_version pragma, except that dbs created before the schema was
+# versioned report 1 (and brand new, empty dbs 0)
+def get_schema_version(conn: sq3.Connection) -> int:
+    c = conn.cursor()
+    c.execute("PRAGMA user_version;")
+    version: int = c.fetchone()[0]
+    if version == 0:
+        c.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'usertokens';")
+        if c.fetchone():
+            version = 1
+    return version
+
+
+# version 1 -> 2: usertokens gets its (user, profile_slug) primary key, usage its REAL amounts, and both tables
+# integer unix times in place of the TIME_FMT strings (which were written in local time)
+# duplicated usertokens rows keep the most recently written one, and infinite balances stored as the text 'inf' become REAL
+def _migrate_v1_to_v2(c: sq3.Cursor) -> None:
+    nowtimestamp: int = now_epoch()
+
+    c.execute("ALTER TABLE usertokens RENAME TO usertokens_v1;")
+    c.execute("ALTER TABLE usage RENAME TO usage_v1;")
+    c.execute("DROP INDEX IF EXISTS idx_usertokens_user;")
+    c.execute("DROP INDEX IF EXISTS idx_usertokens_profile_slug;")
+    c.execute("DROP INDEX IF EXISTS idx_usage_user;")
+    c.execute("DROP INDEX IF EXISTS idx_usage_profile_slug;")
+
+    # the version 2 layout, spelled out since SCHEMA_SQL has moved on since
+    c.execute('''CREATE TABLE usage (
+                 user TEXT NOT NULL,
+                 date INTEGER NOT NULL,
+                 profile_slug TEXT NOT NULL,
+                 hours REAL NOT NULL,
+                 tokens REAL NOT NULL
+                 );''')
+    c.execute('''CREATE TABLE usertokens (
+                 user TEXT NOT NULL,
+                 profile_slug TEXT NOT NULL,
+                 count REAL NOT NULL,
+                 last_add INTEGER NOT NULL,
+                 PRIMARY KEY (user, profile_slug)
+                 ) WITHOUT ROWID;''')
+    c.execute("CREATE INDEX idx_usertokens_profile_slug ON usertokens(profile_slug);")
+    c.execute("CREATE INDEX idx_usage_user_date ON usage(user, date, profile_slug, hours, tokens);")
+    c.execute("CREATE INDEX idx_usage_profile_slug_date ON usage(profile_slug, date, user, hours, tokens);")
+
+    c.execute('''INSERT OR REPLACE INTO usertokens (user, profile_slug, count, last_add)
+                 SELECT user, profile_slug,
+                        CASE count WHEN 'inf' THEN 9e999 WHEN '-inf' THEN -9e999 ELSE CAST(count AS REAL) END,
+                        COALESCE(CAST(strftime('%s', last_add, 'utc') AS INTEGER), ?)
+                 FROM usertokens_v1 ORDER BY rowid;''', (nowtimestamp,))
+    c.execute('''INSERT INTO usage (user, date, profile_slug, hours, tokens)
+                 SELECT user, COALESCE(CAST(strftime('%s', date, 'utc') AS INTEGER), ?), profile_slug, 
+                        CAST(hours AS REAL), CAST(tokens AS REAL)
+                 FROM usage_v1 ORDER BY rowid;''', (nowtimestamp,))
+
+    c.execute("DROP TABLE usertokens_v1;")
+    c.execute("DROP TABLE usage_v1;")
+
+
+# version 2 -> 3: usertokens records each user's role; existing rows are taken to be non-admins until the user is next
+# seen by the hub or the culler
+def _migrate_v2_to_v3(c: sq3.Cursor) -> None:
+    c.execute("ALTER TABLE usertokens ADD COLUMN is_admin INTEGER NOT NULL DEFAULT 0;")
+
+
+# version 3 -> 4: adds the usage rollup tables, filled in from the existing usage rows
+def _migrate_v3_to_v4(c: sq3.Cursor) -> None:
+    period_length: int
+    table: str
+    for period_length, table in ROLLUP_TABLES.items():
+        for statement in ROLLUP_SCHEMA_SQL:
+            c.execute(statement.replace("%s", table))
+        c.execute("INSERT INTO " + table + " (user, profile_slug, period, hours, tokens) "
+                  "SELECT user, profile_slug, date - date % ?, SUM(hours), SUM(tokens) FROM usage GROUP BY user, profile_slug, date - date % ?;",
+                  (period_length, period_length))
+
+
+# version 4 -> 5: adds the usage_archives table
+def _migrate_v4_to_v5(c: sq3.Cursor) -> None:
+    c.execute('''CREATE TABLE usage_archives (
+                 month INTEGER PRIMARY KEY,
+                 filename TEXT NOT NULL,
+                 rows INTEGER NOT NULL,
+                 archived INTEGER NOT NULL
+                 );''')
+
+
+# version 5 -> 6: adds the balance_changes counter
+def _migrate_v5_to_v6(c: sq3.Cursor) -> None:
+    c.execute('''CREATE TABLE balance_changes (
+                 id INTEGER PRIMARY KEY CHECK (id = 0),
+                 counter INTEGER NOT NULL
+                 );''')
+    c.execute("INSERT INTO balance_changes (id, counter) VALUES (0, 0);")
+
+
+# version 6 -> 7: adds the quota_policies table; balances were accrued every cycle until now, so the first 
+# sync_policies can take them to be up to date under the current policies
+def _migrate_v6_to_v7(c: sq3.Cursor) -> None:
+    c.execute('''CREATE TABLE quota_policies (
+                 profile_slug TEXT NOT NULL,
+                 is_admin INTEGER NOT NULL,
+                 rate REAL NOT NULL,
+                 max_balance REAL NOT NULL,
+                 PRIMARY KEY (profile_slug, is_admin)
+                 ) WITHOUT ROWID;''')
+
+
+# version 7 -> 8: adds server_watermarks and quota_meta; servers have been charged per cycle until now, so runtime
+# charging starts from the time of the migration
+def _migrate_v7_to_v8(c: sq3.Cursor) -> None:
+    for statement in SERVER_WATERMARKS_SQL:
+        c.execute(statement)
+
+
+# the migration that takes a db from each schema version to the next
+MIGRATIONS: Dict[int, Callable[[sq3.Cursor], None]] = {
+    1: _migrate_v1_to_v2,
+    2: _migrate_v2_to_v3,
+    3: _migrate_v3_to_v4,
+    4: _migrate_v4_to_v5,
+    5: _migrate_v5_to_v6,
+    6: _migrate_v6_to_v7,
+    7: _migrate_v7_to_v8,
+}
+
+
+# brings a db created by an older version of this module up to SCHEMA_VERSION, in place and in a single transaction
+# (so an interrupted migration leaves the db as it was); returns the version the db was at before
+def migrate_db(conn: sq3.Connection) -> int:
+    original_version: int = get_schema_version(conn)
+    if original_version > SCHEMA_VERSION:
+        raise RuntimeError("quota db has schema version %s, newer than the supported version %s" % (original_version, SCHEMA_VERSION))
+    if original_version in (0, SCHEMA_VERSION):
+        return original_version
+
+    c = conn.cursor()
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        version: int = original_version
+        while version < SCHEMA_VERSION:
+            MIGRATIONS[version](c)
+            version += 1
+        c.execute("PRAGMA user_version = %d;" % SCHEMA_VERSION)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+    return original_version
+
+
+# creates the tables if they don't exist yet, migrating dbs created by older versions of this module
+def create_db(filename: str) -> None:
+    conn = sq3.connect(filename)
+
+    try:
+        if get_schema_version(conn) == 0:
+            c = conn.cursor()
+            for statement in SCHEMA_SQL:
+                c.execute(statement)
+            c.execute("PRAGMA user_version = %d;" % SCHEMA_VERSION)
+            conn.commit()
+        else:
+            migrate_db(conn)
+    finally:
+        conn.close()
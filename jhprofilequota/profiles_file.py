@@ -0,0 +1,84 @@
+"""the profiles list, from a JSON file that may change while the culler runs
+
+    profiles = ProfilesFile("/etc/jupyterhub/profiles.json")
+    profiles.load()                 # at startup; raises if the file is missing or invalid
+    ...
+    update = profiles.check()       # between cull cycles: the new policies if the file has changed, else None
+    if update is not None:
+        ...                         # record them in the db (profile_db.update_policies)
+        profiles.accept(*update)
+
+The file is read whole, validated (policy.validate_profiles) and compiled before anything sees it, so a cycle always
+runs under either the old policies or the new ones; a file that doesn't parse or validate (say, half written) is
+logged and skipped until it changes again. Changes are spotted by the file's modification time, size and inode, so
+files replaced by renaming one over them (as editors and config management tools do) are picked up too.
+"""
+from typing import List, Optional, Tuple
+import json
+import logging
+import os
+
+from jhprofilequota.policy import QuotaPolicies, diff_policies, validate_profiles
+
+log: logging.Logger = logging.getLogger(__name__)
+
+# what identifies a version of the file: (st_mtime_ns, st_size, st_ino)
+Stamp = Tuple[int, int, int]
+
+
+class ProfilesFile:
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.policies: Optional[QuotaPolicies] = None
+        self._stamp: Optional[Stamp] = None
+        # the last version found invalid, and whether the file was missing last time, so that they're reported once
+        self._rejected: Optional[Stamp] = None
+        self._missing: bool = False
+
+    def _stat(self) -> Stamp:
+        st: os.stat_result = os.stat(self.path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    # reads, validates and compiles the file as it is now, with the stamp of the version read (taken first, so that a
+    # change made while reading shows up as another one); raises OSError or ValueError
+    def read(self) -> Tuple[Stamp, QuotaPolicies]:
+        stamp: Stamp = self._stat()
+        with open(self.path) as f:
+            profiles: List = json.load(f)
+        validate_profiles(profiles)
+        return stamp, QuotaPolicies(profiles)
+
+    def load(self) -> QuotaPolicies:
+        stamp, policies = self.read()
+        self.accept(stamp, policies)
+        return policies
+
+    # the new version of the file, as read returns it, if it has changed since the one accepted, else None
+    def check(self) -> Optional[Tuple[Stamp, QuotaPolicies]]:
+        try:
+            stamp: Stamp = self._stat()
+        except OSError as e:
+            if not self._missing:
+                log.error("Can't reload profiles from %s: %s", self.path, e, extra={"event": "profiles_rejected"})
+                self._missing = True
+            return None
+        self._missing = False
+        if stamp == self._stamp or stamp == self._rejected:
+            return None
+        try:
+            return self.read()
+        except (OSError, ValueError) as e:
+            log.error("Not reloading profiles from %s: %s", self.path, e, extra={"event": "profiles_rejected"})
+            self._rejected = stamp
+            return None
+
+    # makes a version returned by check the current one
+    def accept(self, stamp: Stamp, policies: QuotaPolicies) -> None:
+        if self.policies is not None:
+            added, removed, changed = diff_policies(self.policies, policies)
+            log.info("Reloaded profiles from %s: added %s, removed %s, changed %s", self.path,
+                     ", ".join(added) or "none", ", ".join(removed) or "none", ", ".join(changed) or "none",
+                     extra={"event": "profiles_reloaded", "added": added, "removed": removed, "changed": changed})
+        self.policies = policies
+        self._stamp = stamp
+        self._rejected = None
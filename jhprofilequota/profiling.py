@@ -0,0 +1,109 @@
+"""opt-in profiling of cull cycles
+
+A CycleProfiler writes one file per cull cycle into a directory, keeping the newest `keep` of them:
+
+  - in "spans" mode, cycle-<time>.json: for each named span of the cycle (listing pages, staging and applying the
+    charges, culling) and of handle_server (parsing the start date, looking up the policy, a sample of sample_rate of
+    the servers), how many times it ran and its total, mean and longest time in seconds
+  - in "cprofile" mode, cycle-<time>.prof: a cProfile dump of everything run on the IOLoop's thread during the cycle,
+    for `python -m pstats` or snakeviz; the db thread's work shows up as the time spent waiting for it
+
+The culler service turns it on with --profile_dir; see also profile_db.SlowQueryLog (--slow_query_threshold) for the
+db side.
+"""
+from typing import Dict, List, Iterator
+from contextlib import contextmanager
+import cProfile
+import json
+import os
+import random
+import time
+
+MODES: List[str] = ["spans", "cprofile"]
+
+KEEP: int = 20
+SAMPLE_RATE: float = 0.01
+
+
+# spans that aren't recorded, for the servers left out of the sample and cycles that aren't profiled
+class NullSpans:
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        yield
+
+
+NULL_SPANS: NullSpans = NullSpans()
+
+
+class CycleProfiler:
+    def __init__(self, directory: str, mode: str = "spans", keep: int = KEEP, sample_rate: float = SAMPLE_RATE) -> None:
+        if mode not in MODES:
+            raise ValueError("profiling mode must be one of %s, not %r" % (", ".join(MODES), mode))
+        self.directory: str = directory
+        self.mode: str = mode
+        self.keep: int = keep
+        self.sample_rate: float = sample_rate
+        # name: [count, total, longest]
+        self._spans: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        start: float = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed: float = time.perf_counter() - start
+            stats: List[float] = self._spans.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    # the spans to time one server's handling with: this profiler for a sample of them in spans mode, NULL_SPANS otherwise
+    def server_spans(self):
+        if self.mode == "spans" and random.random() < self.sample_rate:
+            return self
+        return NULL_SPANS
+
+    # profiles the code run inside it as one cycle, and writes the result out when it's done
+    @contextmanager
+    def cycle(self) -> Iterator[None]:
+        self._spans = {}
+        profile: cProfile.Profile = cProfile.Profile() if self.mode == "cprofile" else None
+        started: float = time.time()
+        if profile is not None:
+            profile.enable()
+        try:
+            with self.span("cycle"):
+                yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self._write(started, profile)
+
+    def _write(self, started: float, profile: cProfile.Profile) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        name: str = "cycle-%s-%03d" % (time.strftime("%Y%m%dT%H%M%S", time.gmtime(started)), int(started * 1000) % 1000)
+        if profile is not None:
+            profile.dump_stats(os.path.join(self.directory, name + ".prof"))
+        else:
+            path: str = os.path.join(self.directory, name + ".json")
+            with open(path + ".tmp", "w") as f:
+                json.dump({
+                    "started": started,
+                    "sample_rate": self.sample_rate,
+                    "spans": {
+                        span: {"count": count, "total": total, "mean": total / count, "max": longest}
+                        for span, (count, total, longest) in sorted(self._spans.items())
+                    },
+                }, f, indent=2)
+            os.replace(path + ".tmp", path)
+        self._rotate()
+
+    # removes all but the newest `keep` cycle files
+    def _rotate(self) -> None:
+        dumps: List[str] = sorted(
+            filename for filename in os.listdir(self.directory)
+            if filename.startswith("cycle-") and filename.endswith((".json", ".prof"))
+        )
+        for filename in dumps[:max(len(dumps) - self.keep, 0)]:
+            os.remove(os.path.join(self.directory, filename))
@@ -0,0 +1,124 @@
+import pytest
+
+from jhprofilequota import profile_db as db
+
+
+PROFILES = [
+    {"slug": "gpu", "quota": {"costTokensPerHour": 2.0, "users": {"newTokensPerDay": 0.0, "initialBalance": 100.0}}},
+    {"slug": "free"},
+]
+
+
+@pytest.fixture
+def db_filename(tmp_path):
+    filename = str(tmp_path / "quotas.db")
+    db.create_db(filename)
+    conn = db.get_connection(filename)
+    try:
+        # charge servers from whenever they started, rather than from the db's creation
+        conn.execute("UPDATE quota_meta SET value = 0 WHERE name = 'runtime_charging_since';")
+    finally:
+        db.close_connection(conn)
+    yield filename
+    db.configure_pool()
+    db.configure_balance_cache()
+
+
+# runs a cull cycle's charging for servers, (user, server_name, started, seen, new) tuples, on a connection of its own
+# (a culler started afresh has no snapshot, so every server is new to it)
+def charge_cycle(db_filename, servers):
+    conn = db.get_connection(db_filename)
+    try:
+        db.discard_staged_charges(conn)
+        db.stage_server_runtimes(conn, [(user, False, server_name, "gpu", started, started, seen, new)
+                                        for user, server_name, started, seen, new in servers])
+        return db.apply_staged_charges(conn, PROFILES)
+    finally:
+        db.close_connection(conn)
+
+
+def charged_hours(db_filename, user):
+    conn = db.get_connection(db_filename)
+    try:
+        return conn.execute("SELECT COALESCE(SUM(hours), 0.0) FROM usage WHERE user = ?;", (user,)).fetchone()[0]
+    finally:
+        db.close_connection(conn)
+
+
+def test_runtime_charged_once_across_restart(db_filename):
+    started = db.now_epoch() - 4 * db.HOUR
+
+    balances = charge_cycle(db_filename, [("alice", "", started, started + db.HOUR, True)])
+    assert balances[("alice", "gpu")] == pytest.approx(98.0)
+
+    # the culler restarts: new connections, no snapshot, and the same server seen again
+    db.configure_pool()
+    balances = charge_cycle(db_filename, [("alice", "", started, started + 3 * db.HOUR, True)])
+    assert balances[("alice", "gpu")] == pytest.approx(94.0)
+    assert charged_hours(db_filename, "alice") == pytest.approx(3.0)
+
+    # seeing it again at a time already charged for charges nothing
+    db.configure_pool()
+    balances = charge_cycle(db_filename, [("alice", "", started, started + 3 * db.HOUR, True)])
+    assert balances[("alice", "gpu")] == pytest.approx(94.0)
+    assert charged_hours(db_filename, "alice") == pytest.approx(3.0)
+
+
+def test_restarted_server_charged_from_its_new_start(db_filename):
+    started = db.now_epoch() - 4 * db.HOUR
+    charge_cycle(db_filename, [("alice", "", started, started + db.HOUR, True)])
+
+    # stopped and started again; the old session's watermark doesn't apply
+    restarted = started + 2 * db.HOUR
+    balances = charge_cycle(db_filename, [("alice", "", restarted, restarted + db.HOUR // 2, True)])
+    assert balances[("alice", "gpu")] == pytest.approx(97.0)
+    assert charged_hours(db_filename, "alice") == pytest.approx(1.5)
+
+
+def test_server_missing_from_a_listing_keeps_its_watermark(db_filename):
+    started = db.now_epoch() - 4 * db.HOUR
+    charge_cycle(db_filename, [("alice", "", started, started + db.HOUR, True)])
+    # a cycle that doesn't list alice's server
+    charge_cycle(db_filename, [("bob", "", started, started + db.HOUR, True)])
+    charge_cycle(db_filename, [("alice", "", started, started + 2 * db.HOUR, False)])
+    assert charged_hours(db_filename, "alice") == pytest.approx(2.0)
+
+
+def test_balance_cache_invalidated_by_charges(db_filename):
+    started = db.now_epoch() - 4 * db.HOUR
+    # the hub's connection, reading through the cache
+    hub = db.get_connection(db_filename)
+    try:
+        assert db.get_user_balances(hub, PROFILES, "alice", False) == {"gpu": 100.0}
+        hub.commit()
+        changes = db.get_balance_changes(hub)
+        assert db._balance_cache.get((db_filename, "alice", False), changes) is not None
+
+        charge_cycle(db_filename, [("alice", "", started, started + db.HOUR, True)])
+
+        assert db.get_user_balances(hub, PROFILES, "alice", False) == {"gpu": pytest.approx(98.0)}
+    finally:
+        db.close_connection(hub)
+
+
+def test_balance_cache_invalidated_by_grants(db_filename):
+    hub = db.get_connection(db_filename)
+    try:
+        assert db.get_user_balances(hub, PROFILES, "alice", False) == {"gpu": 100.0}
+        hub.commit()
+
+        admin = db.get_connection(db_filename)
+        try:
+            assert db.grant_tokens(admin, "gpu", -25.0, ["alice"], profiles=PROFILES) == 1
+        finally:
+            db.close_connection(admin)
+        assert db.get_user_balances(hub, PROFILES, "alice", False) == {"gpu": pytest.approx(75.0)}
+
+        admin = db.get_connection(db_filename)
+        try:
+            assert db.reset_balances(admin, "gpu", profiles=PROFILES) == 1
+        finally:
+            db.close_connection(admin)
+        assert db.get_user_balances(hub, PROFILES, "alice", False) == {"gpu": pytest.approx(100.0)}
+    finally:
+        db.close_connection(hub)
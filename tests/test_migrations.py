@@ -0,0 +1,151 @@
+import sqlite3 as sq3
+import time
+
+import pytest
+
+from jhprofilequota import profile_db as db
+
+
+# the layout written by the first release of profile_db (schema version 1), with its string-formatted values
+V1_SCHEMA_SQL = [
+    '''CREATE TABLE IF NOT EXISTS usage (
+       user TEXT NOT NULL,
+       date TEXT NOT NULL,
+       profile_slug TEXT NOT NULL,
+       hours TEXT NOT NULL,
+       tokens TEXT NOT NULL
+       );''',
+    '''CREATE TABLE IF NOT EXISTS usertokens (
+       user TEXT NOT NULL,
+       profile_slug TEXT NOT NULL,
+       count REAL NOT NULL,
+       last_add TEXT NOT NULL
+       );''',
+    '''CREATE INDEX IF NOT EXISTS idx_usertokens_user ON usertokens(user);''',
+    '''CREATE INDEX IF NOT EXISTS idx_usage_user ON usage(user);''',
+    '''CREATE INDEX IF NOT EXISTS idx_usage_profile_slug ON usage(profile_slug);''',
+    '''CREATE INDEX IF NOT EXISTS idx_usertokens_profile_slug ON usertokens(profile_slug);''',
+]
+
+
+@pytest.fixture
+def local_time(monkeypatch):
+    # version 1 wrote local times; migrating them has to go by the local time zone, so use one that isn't UTC
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def local_epoch(timestamp):
+    return int(time.mktime(time.strptime(timestamp, db.TIME_FMT)))
+
+
+def make_v1_db(filename):
+    conn = sq3.connect(filename)
+    c = conn.cursor()
+    for statement in V1_SCHEMA_SQL:
+        c.execute(statement)
+    # as version 1 wrote them: every value formatted with '%s', so infinite balances are the text 'inf'
+    rows = [
+        ("alice", "gpu", "12.5", "2020-09-01 08:30:00"),
+        ("alice", "free", "inf", "2020-09-01 08:30:00"),
+        ("bob", "gpu", "-3.0", "2020-07-15 23:59:59"),
+        # duplicated by the unkeyed table; the most recently written row wins
+        ("bob", "gpu", "4.0", "2020-07-16 00:10:00"),
+    ]
+    for user, profile_slug, count, last_add in rows:
+        c.execute("INSERT INTO usertokens (user, profile_slug, count, last_add) VALUES ('%s', '%s', '%s', '%s')"
+                  % (user, profile_slug, count, last_add))
+    usage = [
+        ("alice", "2020-09-01 08:30:00", "gpu", "0.5", "1.0"),
+        ("alice", "2020-09-01 09:10:00", "gpu", "1.0", "2.0"),
+        ("bob", "2020-07-15 23:59:59", "gpu", "2.0", "4.0"),
+    ]
+    for user, date, profile_slug, hours, tokens in usage:
+        c.execute("INSERT INTO usage (user, date, profile_slug, hours, tokens) VALUES ('%s', '%s', '%s', '%s', '%s');"
+                  % (user, date, profile_slug, hours, tokens))
+    conn.commit()
+    conn.close()
+
+
+def test_migrate_v1_to_current(tmp_path, local_time):
+    filename = str(tmp_path / "v1.db")
+    make_v1_db(filename)
+
+    before = db.now_epoch()
+    db.create_db(filename)
+
+    conn = sq3.connect(filename)
+    try:
+        assert conn.execute("PRAGMA user_version;").fetchone()[0] == db.SCHEMA_VERSION
+        assert db.get_schema_version(conn) == db.SCHEMA_VERSION
+
+        rows = {(user, profile_slug): (count, last_add, is_admin) for user, profile_slug, count, last_add, is_admin in
+                conn.execute("SELECT user, profile_slug, count, last_add, is_admin FROM usertokens;")}
+        assert rows == {
+            ("alice", "gpu"): (12.5, local_epoch("2020-09-01 08:30:00"), 0),
+            ("alice", "free"): (float("inf"), local_epoch("2020-09-01 08:30:00"), 0),
+            ("bob", "gpu"): (4.0, local_epoch("2020-07-16 00:10:00"), 0),
+        }
+        assert conn.execute("SELECT typeof(count) FROM usertokens WHERE profile_slug = 'free';").fetchone()[0] == "real"
+
+        usage = conn.execute("SELECT user, date, profile_slug, hours, tokens FROM usage ORDER BY date;").fetchall()
+        assert usage == [
+            ("bob", local_epoch("2020-07-15 23:59:59"), "gpu", 2.0, 4.0),
+            ("alice", local_epoch("2020-09-01 08:30:00"), "gpu", 0.5, 1.0),
+            ("alice", local_epoch("2020-09-01 09:10:00"), "gpu", 1.0, 2.0),
+        ]
+
+        # the rollups are filled in from the migrated usage, in UTC periods
+        assert db.usage_totals(conn, 0, 2 * 10 ** 9, group_by=("user",)) == [("alice", 1.5, 3.0), ("bob", 2.0, 4.0)]
+        day = local_epoch("2020-07-15 23:59:59") // db.DAY * db.DAY
+        assert conn.execute("SELECT user, period, hours FROM usage_daily WHERE user = 'bob';").fetchall() == [("bob", day, 2.0)]
+
+        assert conn.execute("SELECT counter FROM balance_changes;").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM quota_policies;").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM usage_archives;").fetchone()[0] == 0
+        charging_since = conn.execute("SELECT value FROM quota_meta WHERE name = 'runtime_charging_since';").fetchone()[0]
+        assert before <= charging_since <= db.now_epoch()
+    finally:
+        conn.close()
+
+    # migrating again changes nothing
+    conn = sq3.connect(filename)
+    try:
+        assert db.migrate_db(conn) == db.SCHEMA_VERSION
+    finally:
+        conn.close()
+
+
+def test_migrated_db_reads_balances(tmp_path, local_time):
+    filename = str(tmp_path / "v1.db")
+    make_v1_db(filename)
+    db.create_db(filename)
+
+    profiles = [
+        {"slug": "gpu", "quota": {"costTokensPerHour": 2.0, "users": {"newTokensPerDay": 0.0, "initialBalance": 10.0}}},
+        {"slug": "free"},
+    ]
+    conn = sq3.connect(filename)
+    try:
+        assert db.get_balances(conn, profiles, [("alice", False), ("bob", False)]) == {
+            "alice": {"gpu": 12.5},
+            "bob": {"gpu": 4.0},
+        }
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def test_newer_schema_is_refused(tmp_path):
+    filename = str(tmp_path / "new.db")
+    db.create_db(filename)
+    conn = sq3.connect(filename)
+    try:
+        conn.execute("PRAGMA user_version = %d;" % (db.SCHEMA_VERSION + 1))
+        with pytest.raises(RuntimeError):
+            db.migrate_db(conn)
+    finally:
+        conn.close()